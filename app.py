@@ -1,13 +1,417 @@
-from flask import Flask, request, send_file
+from flask import Flask, Response, g, request, stream_with_context
 from flask_cors import CORS
-from generators.gradient_text import generate_gradient_text, generate_animated_gradient_text
-from generators.neon_text import generate_neon_text
+from generators.gradient_text import (generate_gradient_text, generate_animated_gradient_text,
+                                      iter_animated_gradient_text)
+from generators.neon_text import generate_neon_text, GLOW_COLOR, GLOW_RADIUS, GLOW_LAYERS
 from generators.rainbow_wave import generate_rainbow_wave
-from generators.glitch_text import generate_glitch_text
+from generators.glitch_text import generate_glitch_text, iter_glitch_text
+from generators.fonts import font_registry
+from generators.cache import render_cache, make_key
+from generators.executor import render_executor, RenderRejected
+from generators.instrumentation import render_metrics, server_timing
+from generators.admission import admit, quality_header, canvas_size, DEFAULT_PARAMS, RenderTooLarge
+from generators.formats import (STILL_FORMATS, ANIMATED_FORMATS, FRAME_FORMATS, NEGOTIATED_ANIMATED_FORMATS,
+                                MIMETYPES, EXTENSIONS, make_encoding)
+from generators.sprites import frame_manifest
+from generators.utils import prepare_text_layout
+from generators.startup import startup_timer
+from io import RawIOBase
+from werkzeug.wsgi import wrap_file
+import json
 import os
+import time
+import unicodedata
+import urllib.parse
+import uuid
+import zipfile
 
 app = Flask(__name__)
-CORS(app)  # Enable CORS for all routes
+CORS(app, expose_headers=['X-TextFX-Frames'])  # Enable CORS for all routes
+
+# Images never change for a given URL and Accept header (the renderer
+# version is part of the ETag), so clients may keep them for this long
+HTTP_MAX_AGE = int(os.environ.get('TEXTFX_HTTP_MAX_AGE', 365 * 24 * 3600))
+
+# Degraded images are replaced by full quality ones once load drops
+DEGRADED_MAX_AGE = 60
+
+def lookup(effect, text, params):
+    """
+    Find an image in the output cache, or admit its render. Under load the
+    render may be degraded, which the X-TextFX-Quality header reports.
+    Returns (cached bytes or None, cache key, params to render with).
+    """
+    key = make_key(effect, text, params)
+    g.etag = key
+    data = render_cache.get(key)
+    if data is None:
+        try:
+            params, degraded = admit(effect, text, params, render_executor.queue_wait())
+        except RenderTooLarge:
+            render_metrics.count_admission(effect, 'refused')
+            raise
+        if degraded:
+            render_metrics.count_admission(effect, 'degraded')
+            g.quality = quality_header(degraded)
+            key = g.etag = make_key(effect, text, params)
+            data = render_cache.get(key)
+    if data is not None:
+        record_timing(effect, 'hit')
+    if params.get('encoding', {}).get('format') in FRAME_FORMATS:
+        g.frames = json.dumps(frames_manifest(effect, text, params), separators=(',', ':'))
+    return data, key, params
+
+def frames_manifest(effect, text, params):
+    """Manifest of an animation rendered in one of the FRAME_FORMATS."""
+    _, width, height, _, _ = prepare_text_layout(text)
+    width, height = canvas_size(effect, width, height)
+    params = dict(DEFAULT_PARAMS[effect], **params)
+    return frame_manifest(params['encoding']['format'], width, height,
+                          params['num_frames'], params['duration'])
+
+def render(effect, generator, text, **params):
+    """
+    Render through the shared output cache; misses run on the render
+    executor's worker processes. Returns the encoded bytes.
+    """
+    data, key, params = lookup(effect, text, params)
+    if data is not None:
+        return data
+    started = time.perf_counter()
+    data, stages = render_executor.render(generator, text, params)
+    total = time.perf_counter() - started
+    render_cache.put(key, data)
+    render_metrics.observe_render(effect, stages, total, len(data))
+    record_timing(effect, 'miss', stages, total)
+    return data
+
+def not_modified(effect, text, params):
+    """
+    Answer If-None-Match before rendering: the ETag is the cache key of
+    the image. Returns a 304 response, or None when the image is needed.
+    """
+    key = make_key(effect, text, params)
+    if not request.if_none_match.contains_weak(key):
+        return None
+    g.etag = key
+    record_timing(effect, 'not_modified')
+    return Response(status=304)
+
+def image_response(image, image_format, name=None):
+    """
+    Response for rendered bytes (with an exact Content-Length), a
+    ChunkReader streaming a render or any other, possibly async, iterable
+    of chunks. name sets the download file name.
+    """
+    if isinstance(image, bytes):
+        response = Response(image, mimetype=MIMETYPES[image_format])
+        # Serve byte ranges against the image's ETag
+        response.set_etag(g.etag)
+        response = response.make_conditional(request, accept_ranges=True,
+                                              complete_length=len(image))
+    elif isinstance(image, ChunkReader):
+        response = Response(wrap_file(request.environ, image), mimetype=MIMETYPES[image_format],
+                            direct_passthrough=True)
+    else:
+        response = Response(image, mimetype=MIMETYPES[image_format], direct_passthrough=True)
+    if name is not None:
+        try:
+            name.encode('ascii')
+            names = {'filename': name}
+        except UnicodeEncodeError:
+            # ASCII fallback plus the full name for clients that read it
+            simple = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
+            names = {'filename': simple, 'filename*': "UTF-8''" + urllib.parse.quote(name, safe='')}
+        response.headers.set('Content-Disposition', 'inline', **names)
+    return response
+
+def record_timing(effect, cache, stages=None, total=None):
+    """Count the image and keep its timing for the Server-Timing header."""
+    render_metrics.count_request(effect, cache)
+    g.server_timing = server_timing(stages or {}, total, cache)
+
+@app.after_request
+def add_render_headers(response):
+    timing = g.pop('server_timing', None)
+    if timing:
+        response.headers['Server-Timing'] = timing
+    quality = g.pop('quality', None)
+    if quality:
+        response.headers['X-TextFX-Quality'] = quality
+    frames = g.pop('frames', None)
+    if frames:
+        response.headers['X-TextFX-Frames'] = frames
+    if g.pop('negotiated', False):
+        response.vary.add('Accept')
+    etag = g.pop('etag', None)
+    if etag and response.status_code in (200, 206, 304):
+        response.set_etag(etag)
+        if quality:
+            response.cache_control.public = True
+            response.cache_control.max_age = DEGRADED_MAX_AGE
+        else:
+            response.headers['Cache-Control'] = f'public, max-age={HTTP_MAX_AGE}, immutable'
+    return response
+
+class ChunkReader(RawIOBase):
+    """
+    Readable file over an iterator of byte chunks, so a response streams
+    a render while it is being encoded. on_complete(data, size) is called
+    once the last chunk was read, with the whole output (None when it grew
+    past keep_bytes) and its size.
+    """
+
+    def __init__(self, chunks, on_complete=None, keep_bytes=0):
+        self._chunks = iter(chunks)
+        self._on_complete = on_complete
+        self._keep_bytes = keep_bytes
+        self._kept = []
+        self.size = 0
+        # Start the render now, so a failure before the first frame still
+        # becomes an error response; a later one can only cut the body short
+        self._current = memoryview(self._next_chunk() or b'')
+
+    def _next_chunk(self):
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            if self._on_complete is not None:
+                data = b''.join(self._kept) if self._kept is not None else None
+                self._on_complete(data, self.size)
+            self._on_complete = None
+            return None
+        self.size += len(chunk)
+        if self._kept is not None:
+            if self.size > self._keep_bytes:
+                self._kept = None
+            else:
+                self._kept.append(chunk)
+        return chunk
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._current:
+            chunk = self._next_chunk()
+            if chunk is None:
+                return 0
+            self._current = memoryview(chunk)
+        size = min(len(b), len(self._current))
+        b[:size] = self._current[:size]
+        self._current = self._current[size:]
+        return size
+
+    def close(self):
+        # Stops the render when the client goes away mid-stream
+        if hasattr(self._chunks, 'close'):
+            self._chunks.close()
+        super().close()
+
+def render_stream(effect, streamer, text, **params):
+    """
+    Like render(), but a cache miss is streamed: the returned ChunkReader
+    yields the image while the worker is still encoding it, and the
+    complete output is cached at the end. streamer yields encoded chunks.
+    Cache hits are returned as bytes.
+    """
+    data, key, params = lookup(effect, text, params)
+    if data is not None:
+        return data
+
+    # Stage times only arrive with the end of the stream, after the headers
+    # went out: they feed /metrics, the header reports the first chunk
+    started = time.perf_counter()
+    timings = {}
+
+    def complete(data, size):
+        if data is not None:
+            render_cache.put(key, data)
+        render_metrics.observe_render(effect, timings.get('stages', {}),
+                                      time.perf_counter() - started, size)
+
+    reader = ChunkReader(
+        render_executor.stream(streamer, text, params,
+                               lambda stages: timings.update(stages=stages)),
+        complete,
+        render_cache.max_bytes
+    )
+    render_metrics.count_request(effect, 'miss')
+    g.server_timing = server_timing({}, cache='miss', first_chunk=time.perf_counter() - started)
+    return reader
+
+def download_name(prefix, text, extension):
+    """File name for an image: the effect and the start of its text."""
+    # Newlines and other control characters are not allowed in headers
+    name = ''.join(c if c.isprintable() else ' ' for c in text[:30])
+    return f'{prefix}_{name}.{extension}'
+
+def error_response(e):
+    """
+    JSON error for a failed request: 429/503 when the render was turned
+    away, 413 when it is too large to render at all.
+    """
+    if isinstance(e, RenderRejected):
+        return {'error': str(e)}, e.status, {'Retry-After': str(e.retry_after)}
+    if isinstance(e, RenderTooLarge):
+        return {'error': str(e)}, e.status
+    return {'error': str(e)}, 400
+
+def int_arg(name, default, minimum, maximum, args=None):
+    """Read an integer parameter (query string by default) within [minimum, maximum]."""
+    value = (request.args if args is None else args).get(name)
+    if value is None:
+        return default
+    # JSON params: 2.9 or true must not slip through int() as 2 or 1
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f"'{name}' must be an integer")
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError(f"'{name}' must be an integer")
+    if not minimum <= value <= maximum:
+        raise ValueError(f"'{name}' must be between {minimum} and {maximum}")
+    return value
+
+def bool_arg(name, default, args=None):
+    """Read a true/false (or 1/0) parameter."""
+    value = (request.args if args is None else args).get(name)
+    if value is None or isinstance(value, bool):
+        return default if value is None else value
+    if str(value).lower() in ('true', '1'):
+        return True
+    if str(value).lower() in ('false', '0'):
+        return False
+    raise ValueError(f"'{name}' must be true or false")
+
+def color_arg(name, default, args=None):
+    """Read an RRGGBB or RRGGBBAA hex color parameter as an RGBA tuple."""
+    value = (request.args if args is None else args).get(name)
+    if value is None:
+        return default
+    if not isinstance(value, str):
+        raise ValueError(f"'{name}' must be a hex color like 00ffff or 00ffff32")
+    value = value.lstrip('#')
+    if len(value) not in (6, 8):
+        raise ValueError(f"'{name}' must be a hex color like 00ffff or 00ffff32")
+    try:
+        channels = bytes.fromhex(value)
+    except ValueError:
+        raise ValueError(f"'{name}' must be a hex color like 00ffff or 00ffff32")
+    if len(channels) == 3:
+        channels += bytes([255])
+    return tuple(channels)
+
+def negotiated_formats(formats):
+    """
+    The formats of an effect the Accept header may pick, the default first.
+    Frame formats, and animations other than GIF, are only given when asked
+    for by name.
+    """
+    if formats[0] in ANIMATED_FORMATS:
+        return NEGOTIATED_ANIMATED_FORMATS
+    return tuple(f for f in formats if f not in FRAME_FORMATS)
+
+def encoding_arg(formats, args=None, accept=None):
+    """
+    Read the output format and encoder options. The format is the 'format'
+    parameter, else the best match for the Accept header among
+    negotiated_formats(), else the first of formats. Returns (format,
+    encoding) where encoding is None for the default format with default
+    options.
+    """
+    args = request.args if args is None else args
+    image_format = args.get('format')
+    if image_format is None:
+        image_format = formats[0]
+        if accept:
+            # Highest q-value wins; ties go to the default, which is the
+            # smaller and faster encoding for these images
+            image_format = max(negotiated_formats(formats),
+                               key=lambda f: accept.quality(MIMETYPES[f]))
+    elif image_format not in formats:
+        raise ValueError(f"'format' must be one of {', '.join(formats)}")
+
+    options = {}
+    lossless = bool_arg('lossless', None, args)
+    if lossless is not None:
+        options['lossless'] = lossless
+    quality = int_arg('quality', None, 0, 100, args)
+    if quality is not None:
+        options['quality'] = quality
+    effort = int_arg('effort', None, 0, 6, args)
+    if effort is not None:
+        options['effort'] = effort
+    if image_format == formats[0] and not options:
+        return image_format, None
+    return image_format, make_encoding(image_format, animated=formats[0] in ANIMATED_FORMATS,
+                                       **options)
+
+def effect_params(effect, args=None, accept=None):
+    """
+    Read the render parameters of an effect, including its encoding.
+    Returns (format, params).
+    """
+    args = request.args if args is None else args
+    _, read_params, formats = EFFECTS[effect]
+    params = read_params(args)
+    image_format, encoding = encoding_arg(formats, args, accept)
+    if encoding is not None:
+        params['encoding'] = encoding
+    return image_format, params
+
+def negotiated_params(effect):
+    """effect_params() of the current request, negotiating the format from Accept."""
+    g.negotiated = len(negotiated_formats(EFFECTS[effect][2])) > 1
+    return effect_params(effect, request.args, request.accept_mimetypes)
+
+def no_params(args):
+    """Effects without render parameters."""
+    return {}
+
+def animated_gradient_params(args):
+    """Render parameters of the animated gradient."""
+    return {
+        'num_frames': int_arg('frames', 30, 2, 120, args),
+        'duration': int_arg('duration', 50, 20, 1000, args)
+    }
+
+def glitch_params(args):
+    """Render parameters of the glitch effect."""
+    seed = int_arg('seed', None, 0, 2**32 - 1, args)
+    # Without a seed the generator hashes the text
+    return {} if seed is None else {'seed': seed}
+
+def neon_params(args):
+    """Render parameters of the neon glow."""
+    return {
+        'glow_color': color_arg('color', GLOW_COLOR, args),
+        'radius': int_arg('radius', GLOW_RADIUS, 0, 16, args),
+        'layers': int_arg('layers', GLOW_LAYERS, 1, 8, args)
+    }
+
+# Effects by name: (generator, parameter reader, output formats with the
+# default first)
+EFFECTS = {
+    'gradient': (generate_gradient_text, no_params, STILL_FORMATS),
+    'animated_gradient': (generate_animated_gradient_text, animated_gradient_params,
+                          ANIMATED_FORMATS + FRAME_FORMATS),
+    'neon': (generate_neon_text, neon_params, STILL_FORMATS),
+    'rainbow_wave': (generate_rainbow_wave, no_params, STILL_FORMATS),
+    'glitch': (generate_glitch_text, glitch_params, ANIMATED_FORMATS + FRAME_FORMATS)
+}
+
+# Largest number of items accepted by /api/v1/batch
+BATCH_MAX_ITEMS = int(os.environ.get('TEXTFX_BATCH_MAX_ITEMS', 1000))
+
+# Renders sent to a worker at once by /api/v1/batch
+BATCH_JOB_RENDERS = 16
+
+# Renders run by warm_up(): a JSON file of {effect, text, params} items in
+# the /api/v1/batch format, by default every effect on WARMUP_TEXTS
+# (TEXTFX_WARMUP=0 turns them off)
+WARMUP = os.environ.get('TEXTFX_WARMUP', '1') != '0'
+WARMUP_FILE = os.environ.get('TEXTFX_WARMUP_FILE')
+WARMUP_TEXTS = ('TextFX', 'Warm up\nTextFX')
 
 @app.route('/')
 def home():
@@ -28,7 +432,9 @@ def home():
                 'description': 'Generate animated scrolling RGB gradient text effect (GIF)',
                 'method': 'GET',
                 'params': {
-                    'text': 'Text to display with animated gradient effect'
+                    'text': 'Text to display with animated gradient effect',
+                    'frames': 'Number of animation frames, 2-120 (default 30)',
+                    'duration': 'Delay between frames in milliseconds, 20-1000 (default 50)'
                 }
             },
             {
@@ -36,7 +442,10 @@ def home():
                 'description': 'Generate text with neon glow effect',
                 'method': 'GET',
                 'params': {
-                    'text': 'Text to display with neon effect'
+                    'text': 'Text to display with neon effect',
+                    'color': 'Glow color as hex RRGGBB or RRGGBBAA (default 00ffff32)',
+                    'radius': 'Blur radius of the widest glow layer, 0-16 (default 2)',
+                    'layers': 'Number of glow layers, 1-8 (default 3)'
                 }
             },
             {
@@ -52,69 +461,354 @@ def home():
                 'description': 'Generate animated glitch text effect (GIF)',
                 'method': 'GET',
                 'params': {
-                    'text': 'Text to display with glitch/corruption effect'
+                    'text': 'Text to display with glitch/corruption effect',
+                    'seed': 'Random seed, 0-4294967295 (default: a hash of the text)'
+                }
+            },
+            {
+                'path': '/api/v1/batch',
+                'description': 'Render many images in one request, returned as a zip (or multipart/mixed) stream',
+                'method': 'POST',
+                'params': {
+                    'items': 'JSON list of {"effect", "text", "params"}; effect is one of ' + ', '.join(EFFECTS),
+                    'format': '"zip" (default, with manifest.json) or "multipart"'
                 }
+            },
+            {
+                'path': '/api/v1/stats',
+                'description': 'Runtime statistics (font registry, render cache and render executor counters, startup timing)',
+                'method': 'GET',
+                'params': {}
+            },
+            {
+                'path': '/metrics',
+                'description': 'Prometheus metrics (render stage times, output sizes, cache and queue counters)',
+                'method': 'GET',
+                'params': {}
             }
-        ]
+        ],
+        'encoding': {
+            'description': 'Optional parameters of every image endpoint',
+            'params': {
+                'format': 'Still images: png (default) or webp; animations: gif (default), webp or apng, '
+                          'or their frames as sprite-png, sprite-webp or rgba, described by the '
+                          'X-TextFX-Frames header. Without it, the best match for the Accept header is used',
+                'lossless': 'WebP only: true (default) or false',
+                'quality': 'WebP only: 0-100 (default 80)',
+                'effort': 'Encoder effort, 0-6 (default 4)'
+            }
+        }
+    }
+
+@app.route('/api/v1/stats')
+def stats():
+    return {
+        'fonts': font_registry.stats(),
+        'cache': render_cache.stats(),
+        'executor': render_executor.stats(),
+        'startup': startup_timer.stats()
     }
 
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics of this process."""
+    cache = render_cache.stats()
+    executor = render_executor.stats()
+    fonts = font_registry.stats()
+    startup = startup_timer.stats()
+    samples = [
+        ('textfx_cache_hits_total', 'counter', 'Render cache memory hits.', cache['hits']),
+        ('textfx_cache_disk_hits_total', 'counter', 'Render cache disk hits.', cache['disk_hits']),
+        ('textfx_cache_misses_total', 'counter', 'Render cache misses.', cache['misses']),
+        ('textfx_cache_evictions_total', 'counter', 'Render cache evictions.', cache['evictions']),
+        ('textfx_cache_entries', 'gauge', 'Images in the memory cache.', cache['entries']),
+        ('textfx_cache_bytes', 'gauge', 'Bytes held by the memory cache.', cache['bytes']),
+        ('textfx_executor_workers', 'gauge', 'Render worker processes.', executor['workers']),
+        ('textfx_executor_pending', 'gauge', 'Renders running or queued.', executor['pending']),
+        ('textfx_executor_queue_limit', 'gauge', 'Renders allowed to wait for a worker.', executor['max_queue']),
+        ('textfx_executor_completed_total', 'counter', 'Renders finished by the workers.', executor['completed']),
+        ('textfx_executor_rejected_total', 'counter', 'Renders turned away with 429.', executor['rejected']),
+        ('textfx_executor_timeouts_total', 'counter', 'Renders that exceeded the timeout.', executor['timeouts']),
+        ('textfx_fonts_loaded', 'gauge', 'Font faces loaded.', fonts['loaded']),
+        ('textfx_startup_seconds', 'gauge', 'Seconds this process took to get ready to serve.',
+         startup['ready_seconds']),
+        ('textfx_warmup_seconds', 'gauge', 'Seconds of warmup renders before serving.',
+         startup['phases'].get('warmup', 0)),
+    ]
+    if startup['first_request_seconds'] is not None:
+        samples.append(('textfx_first_request_seconds', 'gauge', 'Seconds of the first request of this process.',
+                        startup['first_request_seconds']))
+    return Response(render_metrics.prometheus(samples),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/api/v1/gradient-text')
 def gradient_text():
     text = request.args.get('text', 'Hello, World!')
     try:
-        image_data = generate_gradient_text(text)
-        return send_file(
-            image_data, 
-            mimetype='image/png',
-            download_name=f'gradient_{text[:30]}.png'
-        )
+        image_format, params = negotiated_params('gradient')
+        unchanged = not_modified('gradient', text, params)
+        if unchanged is not None:
+            return unchanged
+        image = render('gradient', generate_gradient_text, text, **params)
+        return image_response(image, image_format,
+                              download_name('gradient', text, EXTENSIONS[image_format]))
     except Exception as e:
-        return {'error': str(e)}, 400
+        return error_response(e)
 
 @app.route('/api/v1/gradient-text.gif')
 def animated_gradient_text():
     text = request.args.get('text', 'Hello, World!')
     try:
-        image_data = generate_animated_gradient_text(text)
-        return send_file(
-            image_data, 
-            mimetype='image/gif',
-            download_name=f'gradient_{text[:30]}.gif'
-        )
+        image_format, params = negotiated_params('animated_gradient')
+        unchanged = not_modified('animated_gradient', text, params)
+        if unchanged is not None:
+            return unchanged
+        image = render_stream('animated_gradient', iter_animated_gradient_text, text, **params)
+        return image_response(image, image_format,
+                              download_name('gradient', text, EXTENSIONS[image_format]))
     except Exception as e:
-        return {'error': str(e)}, 400
+        return error_response(e)
 
 @app.route('/api/v1/neon')
 def neon_text():
     text = request.args.get('text', 'Hello, World!')
     try:
-        image_data = generate_neon_text(text)
-        return send_file(image_data, mimetype='image/png')
+        image_format, params = negotiated_params('neon')
+        unchanged = not_modified('neon', text, params)
+        if unchanged is not None:
+            return unchanged
+        image = render('neon', generate_neon_text, text, **params)
+        return image_response(image, image_format)
     except Exception as e:
-        return {'error': str(e)}, 400
+        return error_response(e)
 
 @app.route('/api/v1/rainbow-wave')
 def rainbow_wave_text():
     text = request.args.get('text', 'Hello, World!')
     try:
-        image_data = generate_rainbow_wave(text)
-        return send_file(image_data, mimetype='image/png')
+        image_format, params = negotiated_params('rainbow_wave')
+        unchanged = not_modified('rainbow_wave', text, params)
+        if unchanged is not None:
+            return unchanged
+        image = render('rainbow_wave', generate_rainbow_wave, text, **params)
+        return image_response(image, image_format)
     except Exception as e:
-        return {'error': str(e)}, 400
+        return error_response(e)
 
 @app.route('/api/v1/glitch.gif')
 def glitch_text():
     text = request.args.get('text', 'Hello, World!')
     try:
-        image_data = generate_glitch_text(text)
-        return send_file(
-            image_data, 
-            mimetype='image/gif',
-            download_name=f'glitch_{text[:30]}.gif'  # Add a proper filename
-        )
+        image_format, params = negotiated_params('glitch')
+        unchanged = not_modified('glitch', text, params)
+        if unchanged is not None:
+            return unchanged
+        image = render_stream('glitch', iter_glitch_text, text, **params)
+        return image_response(image, image_format,
+                              download_name('glitch', text, EXTENSIONS[image_format]))
+    except Exception as e:
+        return error_response(e)
+
+def parse_batch(body):
+    """
+    Validate a batch request body: a list of {effect, text, params} items,
+    or {"items": [...], "format": "zip" | "multipart"}.
+    Returns (items, format) where each item is a dict with index, effect
+    and either text and params or the error that makes it unrenderable.
+    """
+    output = 'zip'
+    if isinstance(body, dict):
+        output = body.get('format', 'zip')
+        body = body.get('items')
+    if not isinstance(body, list):
+        raise ValueError("Expected a JSON list of {effect, text, params} items")
+    if output not in ('zip', 'multipart'):
+        raise ValueError("'format' must be 'zip' or 'multipart'")
+    if len(body) > BATCH_MAX_ITEMS:
+        raise ValueError(f"A batch holds at most {BATCH_MAX_ITEMS} items")
+
+    items = []
+    for index, entry in enumerate(body):
+        item = {'index': index, 'effect': None}
+        try:
+            if not isinstance(entry, dict):
+                raise ValueError("Item must be an object")
+            item['effect'] = entry.get('effect')
+            if not isinstance(item['effect'], str):
+                raise ValueError("'effect' must be a string")
+            if item['effect'] not in EFFECTS:
+                raise ValueError(f"Unknown effect {item['effect']!r}")
+            text = entry.get('text', 'Hello, World!')
+            if not isinstance(text, str):
+                raise ValueError("'text' must be a string")
+            params = entry.get('params', {})
+            if not isinstance(params, dict):
+                raise ValueError("'params' must be an object")
+            item['text'] = text
+            item['format'], item['params'] = effect_params(item['effect'], params)
+            # Batches are never degraded, only held to the cost ceiling
+            admit(item['effect'], text, item['params'])
+            if item['format'] in FRAME_FORMATS:
+                item['frames'] = frames_manifest(item['effect'], text, item['params'])
+        except ValueError as e:
+            item['error'] = str(e)
+        items.append(item)
+    return items, output
+
+def warm_up():
+    """
+    Load the fonts and run the warmup renders in this process, so the cold
+    paths of a first render (font parsing, layout caches, NumPy and encoder
+    setup) are paid before serving. Processes forked afterwards inherit the
+    warm state. Returns the number of renders run.
+    """
+    with startup_timer.phase('fonts'):
+        font_registry.preload()
+    if not WARMUP:
+        return 0
+    if WARMUP_FILE:
+        with open(WARMUP_FILE, encoding='utf-8') as f:
+            items, _ = parse_batch(json.load(f))
+    else:
+        items, _ = parse_batch([{'effect': effect, 'text': text}
+                                for effect in EFFECTS for text in WARMUP_TEXTS])
+    for item in items:
+        if 'error' in item:
+            raise ValueError(f"Warmup item {item['index']}: {item['error']}")
+    with startup_timer.phase('warmup'):
+        for item in items:
+            EFFECTS[item['effect']][0](item['text'], **item['params'])
+    return len(items)
+
+def render_batch(items):
+    """
+    Render batch items, yielding (item, ok, bytes or error message) as
+    results become available: cache hits first, then renders as the
+    executor finishes them. Items of the same text are rendered together
+    so they share one layout; identical items are rendered once.
+    """
+    misses = {}  # cache key -> items waiting for it
+    jobs = {}    # text -> [(generator, params, cache key)]
+    for item in items:
+        if 'error' in item:
+            yield item, False, item['error']
+            continue
+        effect, text, params = item['effect'], item['text'], item['params']
+        key = make_key(effect, text, params)
+        if key in misses:
+            misses[key].append(item)
+            continue
+        data = render_cache.get(key)
+        if data is not None:
+            render_metrics.count_request(effect, 'hit')
+            yield item, True, data
+            continue
+        misses[key] = [item]
+        jobs.setdefault(text, []).append((EFFECTS[effect][0], params, key))
+
+    # Pack texts into jobs of about BATCH_JOB_RENDERS renders each
+    batch_jobs = [[]]
+    keys = [[]]
+    for text, renders in jobs.items():
+        if keys[-1] and len(keys[-1]) + len(renders) > BATCH_JOB_RENDERS:
+            batch_jobs.append([])
+            keys.append([])
+        batch_jobs[-1].append((text, [(generator, params) for generator, params, _ in renders]))
+        keys[-1].extend(key for _, _, key in renders)
+    if not keys[-1]:
+        return
+
+    for job_index, results in render_executor.render_batch(batch_jobs):
+        for key, (ok, result, stages) in zip(keys[job_index], results):
+            effect = misses[key][0]['effect']
+            if ok:
+                render_cache.put(key, result)
+                render_metrics.observe_render(effect, stages, None, len(result))
+            render_metrics.count_request(effect, 'miss')
+            for item in misses[key]:
+                yield item, ok, result
+
+class ChunkWriter:
+    """Write-only file object handing out what was written since the last take()."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def batch_file_name(item):
+    return f"{item['index']:04d}_{item['effect']}.{EXTENSIONS[item['format']]}"
+
+def stream_batch_zip(results):
+    """Stream results as a zip archive with a manifest.json of every item."""
+    out = ChunkWriter()
+    manifest = []
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_STORED) as archive:
+        for item, ok, result in results:
+            entry = {'index': item['index'], 'effect': item['effect']}
+            if ok:
+                entry['file'] = batch_file_name(item)
+                archive.writestr(entry['file'], result)
+                if 'frames' in item:
+                    entry['frames'] = item['frames']
+            else:
+                entry['error'] = result
+            manifest.append(entry)
+            yield out.take()
+        manifest.sort(key=lambda entry: entry['index'])
+        archive.writestr('manifest.json', json.dumps({'items': manifest}, indent=2))
+    yield out.take()
+
+def stream_batch_multipart(results, boundary):
+    """Stream results as multipart/mixed parts, one per item."""
+    for item, ok, result in results:
+        headers = [f"X-Item-Index: {item['index']}"]
+        if ok:
+            headers += [
+                f"Content-Type: {MIMETYPES[item['format']]}",
+                f'Content-Disposition: attachment; filename="{batch_file_name(item)}"'
+            ]
+            if 'frames' in item:
+                headers.append(f"X-TextFX-Frames: {json.dumps(item['frames'], separators=(',', ':'))}")
+            body = result
+        else:
+            headers += ['Content-Type: application/json', 'X-Item-Status: 400']
+            body = json.dumps({'error': result}).encode('utf-8')
+        head = f"--{boundary}\r\n" + "\r\n".join(headers) + "\r\n\r\n"
+        yield head.encode('utf-8') + body + b'\r\n'
+    yield f"--{boundary}--\r\n".encode('utf-8')
+
+@app.route('/api/v1/batch', methods=['POST'])
+def batch():
+    try:
+        items, output = parse_batch(request.get_json(silent=True))
     except Exception as e:
-        return {'error': str(e)}, 400
+        return error_response(e)
+
+    results = render_batch(items)
+    if output == 'multipart':
+        boundary = uuid.uuid4().hex
+        return Response(
+            stream_with_context(stream_batch_multipart(results, boundary)),
+            content_type=f'multipart/mixed; boundary={boundary}'
+        )
+    return Response(
+        stream_with_context(stream_batch_zip(results)),
+        mimetype='application/zip',
+        headers={'Content-Disposition': 'attachment; filename=textfx_batch.zip'}
+    )
 
 if __name__ == '__main__':
+    warm_up()
     port = int(os.environ.get('PORT', 1754))
     app.run(host='0.0.0.0', port=port, debug=True) 
\ No newline at end of file
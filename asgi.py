@@ -0,0 +1,484 @@
+"""
+ASGI entry point serving the same routes as app.py from an asyncio loop.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 1754
+
+Image requests are handled on the event loop. Their parameters, cache
+lookup and renders run on threads and the render executor's worker
+processes and are awaited, so slow clients, slow disks and long GIF
+renders no longer hold up the loop or a thread each. Concurrent requests
+for the same image share one render: later ones join it and replay what it
+has produced so far. A streamed render stops being shared once its output
+passes FLIGHT_MAX_BYTES; from then on it keeps only what its clients have
+yet to read. A render whose clients have all disconnected stops at its
+next frame.
+
+Every other route (/, stats, metrics, batch) runs the Flask app on a
+thread, so both entry points answer with the same headers and errors.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import contextvars
+import io
+import os
+import sys
+import time
+
+from flask import g, request
+from app import (app as flask_app, EFFECTS, lookup, not_modified, image_response, error_response,
+                 record_timing, negotiated_params, download_name, warm_up)
+from generators.cache import render_cache
+from generators.executor import render_executor, RenderCancelled
+from generators.formats import EXTENSIONS
+from generators.gradient_text import iter_animated_gradient_text
+from generators.glitch_text import iter_glitch_text
+from generators.instrumentation import render_metrics, server_timing
+
+# Image routes served on the loop: path -> (effect, streaming generator or
+# None for renders sent in one piece, download name prefix or None)
+IMAGE_ROUTES = {
+    '/api/v1/gradient-text': ('gradient', None, 'gradient'),
+    '/api/v1/gradient-text.gif': ('animated_gradient', iter_animated_gradient_text, 'gradient'),
+    '/api/v1/neon': ('neon', None, None),
+    '/api/v1/rainbow-wave': ('rainbow_wave', None, None),
+    '/api/v1/glitch.gif': ('glitch', iter_glitch_text, 'glitch'),
+}
+
+# Bytes of a streamed render kept for clients that join it late. Past this
+# the render is neither shared nor cached, and waits for its slowest client
+# once that many bytes are unread
+FLIGHT_MAX_BYTES = int(os.environ.get('TEXTFX_FLIGHT_MAX_BYTES', 16 * 1024 * 1024))
+
+# Threads that wait on blocking calls for the loop: cache lookups, reading
+# streamed chunks from a worker, inline renders, disk cache writes and
+# Flask routes.
+# Renders are bounded by the executor's slots, so this is enough for all
+# of them to wait at once
+_threads = ThreadPoolExecutor(
+    max_workers=max(8, render_executor.workers + render_executor.max_queue + 4),
+    thread_name_prefix='textfx-asgi')
+
+
+class ClientGone(Exception):
+    """The client disconnected before its response was complete."""
+
+
+class Flight:
+    """
+    One render shared by every request for the same image. Its chunks are
+    kept, so requests that join late replay them from the start. A
+    streamed render stops being shared (shared turns False) once its
+    output passes FLIGHT_MAX_BYTES. It then drops the chunks every client
+    has read, and add() waits while FLIGHT_MAX_BYTES are unread.
+    """
+
+    def __init__(self, effect, key, streaming=False):
+        self.effect = effect
+        self.key = key
+        self.streaming = streaming
+        self.chunks = []   # chunks from number self.first on
+        self.first = 0
+        self.count = 0     # chunks added
+        self.size = 0      # bytes added
+        self.kept = 0      # bytes in chunks
+        self.shared = True
+        self.done = False
+        self.error = None
+        self.stages = {}
+        self.started = time.perf_counter()
+        self.total = None
+        self.clients = 0
+        self.task = None
+        self._readers = {}  # reader -> number of its next chunk
+        self._changed = asyncio.Condition()
+
+    async def add(self, chunk):
+        async with self._changed:
+            self.chunks.append(chunk)
+            self.count += 1
+            self.size += len(chunk)
+            self.kept += len(chunk)
+            if self.streaming and self.size > FLIGHT_MAX_BYTES:
+                self.shared = False
+            self._changed.notify_all()
+            if not self.shared:
+                await self._changed.wait_for(self._drained)
+
+    def _drained(self):
+        # Drop the chunks every client has read; clients that have not
+        # started reading yet still need them all
+        if len(self._readers) == self.clients:
+            read = min(self._readers.values(), default=self.count)
+            del self.chunks[:read - self.first]
+            self.first = max(self.first, read)
+            self.kept = sum(map(len, self.chunks))
+        return self.kept <= FLIGHT_MAX_BYTES or self.clients == 0
+
+    async def finish(self, error=None):
+        async with self._changed:
+            self.done = True
+            self.error = error
+            self.total = time.perf_counter() - self.started
+            self._changed.notify_all()
+
+    async def leave(self):
+        """A client is done with the flight; the last one to leave cancels an unfinished render."""
+        async with self._changed:
+            self.clients -= 1
+            self._changed.notify_all()
+        if self.clients == 0 and not self.done:
+            self.task.cancel()
+
+    async def read(self):
+        """Chunks from the start as they arrive; raises the render's error."""
+        reader = object()
+        self._readers[reader] = self.first
+        try:
+            while True:
+                async with self._changed:
+                    await self._changed.wait_for(lambda: self._readers[reader] < self.count or self.done)
+                    index = self._readers[reader]
+                    if index < self.count:
+                        chunk = self.chunks[index - self.first]
+                        self._readers[reader] = index + 1
+                        self._changed.notify_all()
+                    elif self.error is not None:
+                        raise self.error
+                    else:
+                        return
+                yield chunk
+        finally:
+            del self._readers[reader]
+
+    async def result(self):
+        """The whole output once the render is done."""
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.done)
+        if self.error is not None:
+            raise self.error
+        return b''.join(self.chunks)
+
+    async def first_chunk(self):
+        """Wait for the first chunk (or the end), raising errors from before it."""
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.count or self.done)
+        if not self.count and self.error is not None:
+            raise self.error
+
+
+_flights = {}  # cache key -> Flight
+
+
+def join_flight(effect, key, generator, streamer, text, params):
+    """
+    The flight rendering key, started when there is none.
+    Returns (flight, whether this request started it).
+    """
+    flight = _flights.get(key)
+    started = flight is None or not flight.shared
+    if started:
+        flight = _flights[key] = Flight(effect, key, streamer is not None)
+        if streamer is None:
+            run = _render(flight, generator, text, params)
+        else:
+            run = _stream(flight, streamer, text, params)
+        flight.task = asyncio.ensure_future(_fly(flight, run))
+    flight.clients += 1
+    return flight, started
+
+
+def _land(flight):
+    # A flight that stopped being shared may have a successor by now
+    if _flights.get(flight.key) is flight:
+        del _flights[flight.key]
+
+
+async def _fly(flight, run):
+    try:
+        await run
+    except asyncio.CancelledError:
+        _land(flight)
+        await flight.finish(ClientGone())
+        raise
+    except Exception as e:
+        _land(flight)
+        await flight.finish(e)
+        return
+    await flight.finish()
+    render_metrics.observe_render(flight.effect, flight.stages, flight.total, flight.size)
+    if flight.shared:
+        # The render stays joinable until it is in the cache
+        await asyncio.get_running_loop().run_in_executor(_threads, render_cache.put, flight.key,
+                                                         b''.join(flight.chunks))
+    _land(flight)
+
+
+async def _render(flight, generator, text, params):
+    loop = asyncio.get_running_loop()
+    if render_executor.workers <= 0:
+        data, flight.stages = await loop.run_in_executor(
+            _threads, render_executor.render, generator, text, params)
+    else:
+        future = render_executor.submit(generator, text, params)
+        try:
+            data, flight.stages = await asyncio.wait_for(asyncio.wrap_future(future),
+                                                         render_executor.timeout)
+        except asyncio.TimeoutError:
+            render_executor.cancel(future)
+            raise render_executor.timed_out()
+        except RenderCancelled:
+            # The worker reached the deadline before we did
+            raise render_executor.timed_out()
+        except asyncio.CancelledError:
+            # Every client left: stop the render at its next frame
+            render_executor.cancel(future)
+            raise
+        except BrokenProcessPool:
+            raise render_executor.pool_broken()
+    await flight.add(data)
+
+
+async def _stream(flight, streamer, text, params):
+    chunks = render_executor.stream(streamer, text, params,
+                                    lambda stages: setattr(flight, 'stages', stages))
+    # Every step runs in one context, wherever the thread reading it is
+    context = contextvars.copy_context()
+    pending = None
+    try:
+        while True:
+            pending = _threads.submit(context.run, next, chunks, None)
+            chunk = await asyncio.wrap_future(pending)
+            if chunk is None:
+                break
+            await flight.add(chunk)
+    finally:
+        # Closing the stream stops the worker, once the thread reading it
+        # is done with its chunk
+        _threads.submit(_close_stream, context, pending, chunks)
+
+
+def _close_stream(context, pending, chunks):
+    if pending is not None:
+        try:
+            pending.result()
+        except Exception:
+            pass
+    context.run(chunks.close)
+
+
+async def _until_connected(awaitable, disconnected):
+    """Await awaitable, raising ClientGone (and cancelling it) if the client leaves first."""
+    task = asyncio.ensure_future(awaitable)
+    done, _ = await asyncio.wait({task, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+    if task in done:
+        return task.result()
+    task.cancel()
+    # Let it unwind, so what it was awaiting can be closed
+    await asyncio.wait({task})
+    raise ClientGone()
+
+
+async def _watch_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def _read_body(receive):
+    body = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ClientGone()
+        body.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(body)
+
+
+def wsgi_environ(scope, body):
+    """WSGI environ of an ASGI HTTP request."""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client')
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': client[0] if client else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = f'{environ[name]},{value}'
+        environ[name] = value
+    # The body was read in full, chunked or not
+    environ['CONTENT_LENGTH'] = str(len(body))
+    environ.pop('HTTP_TRANSFER_ENCODING', None)
+    return environ
+
+
+async def _start(send, status, headers):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in headers],
+    })
+
+
+def look_up(effect, text):
+    """
+    The blocking start of an image request: read its parameters, answer
+    If-None-Match and look the image up in the cache (admission estimates
+    the layout, and the disk tier reads files).
+    Returns (format, 304 response or None, cached bytes or None, key, params).
+    """
+    image_format, params = negotiated_params(effect)
+    response = not_modified(effect, text, params)
+    if response is not None:
+        return image_format, response, None, None, params
+    data, key, params = lookup(effect, text, params)
+    return image_format, None, data, key, params
+
+
+async def image_request(scope, receive, send, route):
+    """Serve an image route on the loop, sharing renders of the same image."""
+    effect, streamer, prefix = route
+    loop = asyncio.get_running_loop()
+    disconnected = asyncio.ensure_future(_watch_disconnect(receive))
+    flight = reader = None
+    try:
+        with flask_app.request_context(wsgi_environ(scope, b'')):
+            text = request.args.get('text', 'Hello, World!')
+            body = None
+            # The lookup runs on a thread in this request's context
+            context = contextvars.copy_context()
+            try:
+                image_format, response, data, key, params = await loop.run_in_executor(
+                    _threads, context.run, look_up, effect, text)
+                if response is None:
+                    if data is None:
+                        flight, started = join_flight(effect, key, EFFECTS[effect][0],
+                                                      streamer, text, params)
+                        cache = 'miss' if started else 'coalesced'
+                        if streamer is None:
+                            data = await _until_connected(flight.result(), disconnected)
+                            record_timing(effect, cache, flight.stages, flight.total)
+                        else:
+                            await _until_connected(flight.first_chunk(), disconnected)
+                            render_metrics.count_request(effect, cache)
+                            g.server_timing = server_timing(
+                                {}, cache=cache, first_chunk=time.perf_counter() - flight.started)
+                            body = reader = flight.read()
+                    name = None
+                    if prefix is not None:
+                        name = download_name(prefix, text, EXTENSIONS[image_format])
+                    response = image_response(data if body is None else body, image_format, name)
+            except ClientGone:
+                raise
+            except Exception as e:
+                response = flask_app.make_response(error_response(e))
+            response = flask_app.process_response(response)
+
+        await _start(send, response.status_code, response.headers.items())
+        if scope['method'] == 'HEAD':
+            body = None
+        elif body is None:
+            body = response.iter_encoded()
+            await send({'type': 'http.response.body', 'body': b''.join(body)})
+            return
+        if body is not None:
+            chunks = body.__aiter__()
+            while True:
+                try:
+                    chunk = await _until_connected(chunks.__anext__(), disconnected)
+                except StopAsyncIteration:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    except ClientGone:
+        pass
+    finally:
+        if reader is not None:
+            await reader.aclose()
+        if flight is not None:
+            await flight.leave()
+        disconnected.cancel()
+
+
+async def wsgi_request(scope, receive, send):
+    """Serve a request through the Flask app on a thread."""
+    loop = asyncio.get_running_loop()
+    try:
+        body = await _read_body(receive)
+    except ClientGone:
+        return
+    disconnected = asyncio.ensure_future(_watch_disconnect(receive))
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = headers
+
+    # Streamed responses keep the request context in context variables, so
+    # each step of the response runs in the same context
+    context = contextvars.copy_context()
+    result = await loop.run_in_executor(_threads, context.run, flask_app,
+                                        wsgi_environ(scope, body), start_response)
+    chunks = iter(result)
+    try:
+        await _start(send, started['status'], started['headers'])
+        while not disconnected.done():
+            # A chunk of a streamed batch can take a render to arrive
+            chunk = await loop.run_in_executor(_threads, context.run, next, chunks, None)
+            if chunk is None:
+                break
+            if chunk and scope['method'] != 'HEAD':
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnected.cancel()
+        if hasattr(result, 'close'):
+            await loop.run_in_executor(_threads, context.run, result.close)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Serve the first request at steady-state latency
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(_threads, warm_up)
+            render_executor.start()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            _threads.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """The ASGI application."""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    route = IMAGE_ROUTES.get(scope['path'])
+    if route is not None and scope['method'] in ('GET', 'HEAD'):
+        await image_request(scope, receive, send, route)
+    else:
+        await wsgi_request(scope, receive, send)
@@ -0,0 +1 @@
+"""Benchmark and regression suite (python -m benchmarks.bench)."""
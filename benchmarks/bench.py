@@ -0,0 +1,296 @@
+"""
+Benchmark and regression suite for the generators and API routes.
+
+Runs every generate_* function and every render route (through the Flask
+test client) over a matrix of texts that crosses the font size and width
+thresholds of get_dynamic_dimensions, plus multi-line and emoji/unicode
+input. Each case records wall time percentiles, time per frame, peak
+traced memory, frame count, encoded size and the time spent quantizing and encoding. Format
+cases render the same images as WebP and APNG, and a summary compares
+their size and encode time with the default PNG and GIF output.
+
+    python -m benchmarks.bench --output results.json
+    python -m benchmarks.bench --compare results.json
+
+With --compare the run exits with status 1 when a case regresses against
+the stored results.
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+# Render in this process so tracemalloc sees the work (before app is imported)
+os.environ.setdefault('TEXTFX_WORKERS', '0')
+
+import numpy as np
+import PIL
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generators import RENDERER_VERSION
+from generators.basic import generate_basic_image
+from generators.gradient_text import generate_gradient_text, generate_animated_gradient_text
+from generators.neon_text import generate_neon_text
+from generators.rainbow_wave import generate_rainbow_wave
+from generators.glitch_text import generate_glitch_text
+from generators.formats import make_encoding
+from generators.instrumentation import collect
+
+_WORDS = ("quick brown fox jumps over the lazy dog while neon signs flicker "
+          "across a rainy street full of glitching pixels").split()
+
+
+def _words(length):
+    # Deterministic prose of exactly length characters
+    text = ""
+    i = 0
+    while len(text) < length:
+        text += _WORDS[i % len(_WORDS)] + " "
+        i += 1
+    return text[:length].strip().ljust(length, "x")
+
+
+# Text matrix: get_dynamic_dimensions switches font size at 100 and 200
+# characters and stops sizing to the full width above 200
+CASES = {
+    'short': _words(40),
+    'medium': _words(150),
+    'long': _words(350),
+    'very_long': _words(800),
+    'multiline': "First line of text\nSecond line\n\nFourth line after a blank one\n" + _words(120),
+    'unicode': "Grüße aus Zürich — naïve café ✨🚀🔥 日本語のテキスト " + _words(60),
+}
+
+GENERATORS = {
+    'generate_basic_image': generate_basic_image,
+    'generate_gradient_text': generate_gradient_text,
+    'generate_animated_gradient_text': generate_animated_gradient_text,
+    'generate_neon_text': generate_neon_text,
+    'generate_rainbow_wave': generate_rainbow_wave,
+    'generate_glitch_text': generate_glitch_text,
+}
+
+# Encodings compared against each generator's default format
+ENCODINGS = {
+    'webp': make_encoding('webp'),
+    'webp_lossy': make_encoding('webp', lossless=False),
+    'webp_animated': make_encoding('webp', animated=True),
+    'apng': make_encoding('apng'),
+    'sprite_png': make_encoding('sprite-png'),
+    'sprite_webp': make_encoding('sprite-webp'),
+    'rgba': make_encoding('rgba'),
+}
+
+FORMAT_GENERATORS = {
+    'generate_gradient_text': ('webp', 'webp_lossy'),
+    'generate_neon_text': ('webp', 'webp_lossy'),
+    'generate_animated_gradient_text': ('webp_animated', 'webp', 'apng', 'sprite_png', 'sprite_webp', 'rgba'),
+    'generate_glitch_text': ('webp_animated', 'webp', 'apng', 'sprite_png', 'sprite_webp', 'rgba'),
+}
+
+ROUTES = [
+    '/api/v1/gradient-text',
+    '/api/v1/gradient-text.gif',
+    '/api/v1/neon',
+    '/api/v1/rainbow-wave',
+    '/api/v1/glitch.gif',
+    '/api/v1/batch',
+]
+
+BATCH_EFFECTS = ['gradient', 'animated_gradient', 'neon', 'rainbow_wave', 'glitch']
+
+# Regression thresholds used by --compare
+TIME_TOLERANCE = 0.25      # relative slowdown of p50
+TIME_FLOOR_MS = 2.0        # ignore slowdowns smaller than this
+MEMORY_TOLERANCE = 0.25    # relative growth of peak memory
+SIZE_TOLERANCE = 0.10      # relative growth of the encoded output
+
+
+def frame_count(data):
+    """Frames in an encoded image (1 for still images and archives)."""
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            return getattr(img, 'n_frames', 1)
+    except Exception:
+        return 1
+
+
+def measure(run, repeat):
+    """Time run() repeat times after a warmup, then trace one more call."""
+    data = run()
+    times = []
+    encode_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with collect() as timings:
+            run()
+        times.append((time.perf_counter() - start) * 1000)
+        encode_times.append((timings.stages.get('quantize', 0) + timings.stages.get('encode', 0)) * 1000)
+
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    frames = frame_count(data)
+    return {
+        'p50_ms': round(float(np.percentile(times, 50)), 3),
+        'p90_ms': round(float(np.percentile(times, 90)), 3),
+        'p99_ms': round(float(np.percentile(times, 99)), 3),
+        'mean_ms': round(float(np.mean(times)), 3),
+        'frame_ms': round(float(np.percentile(times, 50)) / frames, 3),
+        'peak_bytes': peak,
+        'frames': frames,
+        'bytes': len(data),
+        # Only seen for renders in this thread (not inside routes)
+        'encode_ms': round(float(np.median(encode_times)), 3),
+    }
+
+
+def generator_runner(generator, text, encoding=None):
+    if encoding is not None:
+        return lambda: generator(text, encoding=encoding).getvalue()
+    return lambda: generator(text).getvalue()
+
+
+def route_runner(client, path, text):
+    if path == '/api/v1/batch':
+        items = [{'effect': effect, 'text': text} for effect in BATCH_EFFECTS]
+        return lambda: _checked(client.post(path, json=items))
+    return lambda: _checked(client.get(path, query_string={'text': text}))
+
+
+def _checked(response):
+    if response.status_code != 200:
+        raise RuntimeError(f'{response.status_code}: {response.get_data(as_text=True)[:200]}')
+    return response.get_data()
+
+
+def run_suite(repeat, only=None):
+    """Run every case (or those whose name contains only). Returns results."""
+    from app import app
+    from generators.cache import render_cache
+
+    # Measure rendering, not the output cache
+    render_cache.max_bytes = 0
+    render_cache.disk_dir = None
+    client = app.test_client()
+
+    cases = []
+    for name, generator in GENERATORS.items():
+        for case, text in CASES.items():
+            cases.append((f'generator:{name}:{case}', text, generator_runner(generator, text)))
+    for name, encodings in FORMAT_GENERATORS.items():
+        for encoding in encodings:
+            for case, text in CASES.items():
+                cases.append((f'format:{name}:{encoding}:{case}', text,
+                              generator_runner(GENERATORS[name], text, ENCODINGS[encoding])))
+    for path in ROUTES:
+        for case, text in CASES.items():
+            cases.append((f'route:{path}:{case}', text, route_runner(client, path, text)))
+
+    results = {}
+    for name, text, run in cases:
+        if only and only not in name:
+            continue
+        result = dict(measure(run, repeat), chars=len(text))
+        results[name] = result
+        print(f"{name:60s} p50 {result['p50_ms']:9.2f} ms  {result['frame_ms']:7.2f} ms/frame  peak {result['peak_bytes'] / 1024:9.0f} KiB"
+              f"  {result['frames']:3d} frames  {result['bytes']:9d} bytes", flush=True)
+    return results
+
+
+def format_summary(results):
+    """
+    Size and encode time of every format case against the default format
+    of the same generator and text. Returns report lines.
+    """
+    lines = []
+    for name, result in results.items():
+        if not name.startswith('format:'):
+            continue
+        _, generator, encoding, case = name.split(':')
+        base = results.get(f'generator:{generator}:{case}')
+        if base is None:
+            continue
+        lines.append(f"{generator + ' ' + encoding + ' ' + case:60s}"
+                     f" size {result['bytes'] / max(1, base['bytes']):5.2f}x"
+                     f"  encode {result['encode_ms']:8.2f} ms (default {base['encode_ms']:7.2f} ms)"
+                     f"  p50 {result['p50_ms'] / max(1e-9, base['p50_ms']):5.2f}x")
+    return lines
+
+
+def compare(results, baseline):
+    """Return a list of regression messages against baseline results."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        slower = result['p50_ms'] - base['p50_ms']
+        if slower > TIME_FLOOR_MS and result['p50_ms'] > base['p50_ms'] * (1 + TIME_TOLERANCE):
+            regressions.append(f"{name}: p50 {base['p50_ms']:.2f} -> {result['p50_ms']:.2f} ms")
+        if result['peak_bytes'] > base['peak_bytes'] * (1 + MEMORY_TOLERANCE):
+            regressions.append(f"{name}: peak memory {base['peak_bytes']} -> {result['peak_bytes']} bytes")
+        if result['bytes'] > base['bytes'] * (1 + SIZE_TOLERANCE):
+            regressions.append(f"{name}: output {base['bytes']} -> {result['bytes']} bytes")
+        if result['frames'] != base['frames']:
+            regressions.append(f"{name}: frames {base['frames']} -> {result['frames']}")
+    return regressions
+
+
+def metadata(repeat):
+    return {
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'renderer_version': RENDERER_VERSION,
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'repeat': repeat,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per case (default 5)')
+    parser.add_argument('--only', help='run only cases whose name contains this')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='fail when results regress against this JSON file')
+    args = parser.parse_args(argv)
+
+    results = run_suite(args.repeat, args.only)
+    summary = format_summary(results)
+    if summary:
+        print("\nFormats against the default PNG/GIF output:")
+        for line in summary:
+            print(f"  {line}")
+    report = {'meta': metadata(args.repeat), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline['results'])
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) against {args.compare}:")
+            for message in regressions:
+                print(f"  {message}")
+            return 1
+        print(f"\nNo regressions against {args.compare}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,260 @@
+"""
+Render many images to a directory without going through the HTTP API.
+
+Reads JSON lines from a file (or stdin with -), one item per line:
+
+    {"effect": "neon", "text": "Player One", "params": {"color": "ff00ff"}, "name": "p1.png"}
+
+effect defaults to --effect, params takes the same parameters as the
+matching endpoint and name is the output file (default: the effect and
+content hash). Items are rendered across a pool of worker processes that
+write the files themselves. An item whose output exists and was rendered
+from the same content (effect, text, params and renderer version) is
+skipped, so rerunning a job only renders what changed. A name repeated
+within the input is skipped when its content is the same and fails
+otherwise.
+
+    python bulk_render.py banners.jsonl --output out/
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+
+# Renders run in the pool below, not on the server's executor
+os.environ.setdefault('TEXTFX_WORKERS', '0')
+# Every core already runs its own renders
+os.environ.setdefault('TEXTFX_FRAME_THREADS', '1')
+
+from app import EFFECTS, effect_params
+from generators.cache import make_key
+from generators.fonts import font_registry
+from generators.formats import EXTENSIONS
+
+# Content hash of every output, by file name, kept in the output directory
+INDEX_FILE = '.textfx-index.json'
+
+# Items sent to a worker at once
+CHUNK_ITEMS = 32
+
+# Seconds between progress reports
+REPORT_SECONDS = 5
+
+
+def read_items(lines, default_effect):
+    """Yield (line number, item dict or error message) of JSON lines."""
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError as e:
+            yield number, f'invalid JSON: {e}'
+            continue
+        if not isinstance(item, dict):
+            yield number, 'expected a JSON object'
+            continue
+        item.setdefault('effect', default_effect)
+        yield number, item
+
+
+def prepare_item(item):
+    """
+    Validate an item like the API does.
+    Returns (file name, content hash, generator, text, params).
+    """
+    effect = item['effect']
+    if not isinstance(effect, str):
+        raise ValueError("'effect' must be a string")
+    if effect not in EFFECTS:
+        raise ValueError(f'Unknown effect {effect!r}')
+    text = item.get('text', 'Hello, World!')
+    if not isinstance(text, str):
+        raise ValueError("'text' must be a string")
+    params = item.get('params', {})
+    if not isinstance(params, dict):
+        raise ValueError("'params' must be an object")
+    image_format, params = effect_params(effect, params)
+    key = make_key(effect, text, params)
+    name = item.get('name') or f'{effect}_{key[:16]}.{EXTENSIONS[image_format]}'
+    if not isinstance(name, str) or os.path.isabs(name) or '..' in name.replace('\\', '/').split('/'):
+        raise ValueError("'name' must be a relative path inside the output directory")
+    return name, key, EFFECTS[effect][0], text, params
+
+
+def _init_worker():
+    font_registry.preload()
+
+
+def render_chunk(output, tasks):
+    """
+    Render tasks of (name, key, generator, text, params) into output.
+    Returns [(name, key, bytes written or None, error or None), ...].
+    """
+    results = []
+    for name, key, generator, text, params in tasks:
+        path = os.path.join(output, name)
+        try:
+            data = generator(text, **params).getvalue()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Readers never see a half written file
+            temp = f'{path}.{os.getpid()}.tmp'
+            with open(temp, 'wb') as f:
+                f.write(data)
+            os.replace(temp, path)
+            results.append((name, key, len(data), None))
+        except Exception as e:
+            results.append((name, key, None, str(e)))
+    return results
+
+
+def load_index(output):
+    try:
+        with open(os.path.join(output, INDEX_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_index(output, index):
+    path = os.path.join(output, INDEX_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f, separators=(',', ':'))
+    os.replace(path + '.tmp', path)
+
+
+class Progress:
+    """Counts items and prints throughput to stderr."""
+
+    def __init__(self, quiet=False):
+        self.quiet = quiet
+        self.started = self.reported = time.perf_counter()
+        self.rendered = self.skipped = self.failed = 0
+        self.bytes = 0
+
+    def report(self, final=False):
+        now = time.perf_counter()
+        if not final and now - self.reported < REPORT_SECONDS:
+            return
+        self.reported = now
+        elapsed = max(now - self.started, 1e-9)
+        line = (f'{self.rendered} rendered, {self.skipped} skipped, {self.failed} failed'
+                f' in {elapsed:.1f}s: {self.rendered / elapsed:.1f} images/s,'
+                f' {self.bytes / elapsed / 1e6:.2f} MB/s')
+        if final or not self.quiet:
+            print(line, file=sys.stderr, flush=True)
+
+
+def run(lines, output, workers, default_effect='gradient', force=False,
+        max_tasks_per_child=None, quiet=False):
+    """Render every item of lines into output. Returns a Progress."""
+    os.makedirs(output, exist_ok=True)
+    # Hashes of earlier runs, moved to index as their names come up
+    previous = load_index(output)
+    index = {}
+    progress = Progress(quiet)
+    # At most two chunks per worker are in flight, so memory stays flat
+    # however many items the input holds
+    window = max(1, workers) * 2
+
+    def collect(results):
+        for name, key, size, error in results:
+            del in_flight[name]
+            if error is None:
+                index[name] = key
+                progress.rendered += 1
+                progress.bytes += size
+            else:
+                progress.failed += 1
+                print(f'{name}: {error}', file=sys.stderr)
+        progress.report()
+
+    pool = multiprocessing.Pool(max(1, workers), initializer=_init_worker,
+                                maxtasksperchild=max_tasks_per_child)
+    # Results of the chunks in flight, and the hash of each name in them.
+    # A name repeated in this run is skipped if its content is the same
+    # and fails otherwise, so the file never flips between two renders
+    pending = deque()
+    in_flight = {}
+    chunk = []
+    try:
+        items = read_items(lines, default_effect)
+        while True:
+            entry = next(items, None)
+            if entry is not None:
+                number, item = entry
+                try:
+                    if isinstance(item, str):
+                        raise ValueError(item)
+                    task = prepare_item(item)
+                except ValueError as e:
+                    progress.failed += 1
+                    print(f'line {number}: {e}', file=sys.stderr)
+                    continue
+                name, key = task[:2]
+                seen = in_flight.get(name, index.get(name))
+                if seen is not None:
+                    if seen == key:
+                        progress.skipped += 1
+                    else:
+                        progress.failed += 1
+                        print(f'line {number}: duplicate name {name!r} with different content',
+                              file=sys.stderr)
+                    continue
+                unchanged = (previous.pop(name, None) == key
+                             and os.path.exists(os.path.join(output, name)))
+                if unchanged and not force:
+                    index[name] = key
+                    progress.skipped += 1
+                    continue
+                in_flight[name] = key
+                chunk.append(task)
+            if chunk and (len(chunk) >= CHUNK_ITEMS or entry is None):
+                pending.append(pool.apply_async(render_chunk, (output, chunk)))
+                chunk = []
+            while pending and (len(pending) >= window or entry is None):
+                collect(pending.popleft().get())
+            if entry is None:
+                break
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        previous.update(index)
+        save_index(output, previous)
+    progress.report(final=True)
+    return progress
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('input', help='JSON lines file of items, or - for stdin')
+    parser.add_argument('--output', '-o', required=True, help='directory to write images to')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='render processes (default: one per CPU core)')
+    parser.add_argument('--effect', default='gradient', choices=sorted(EFFECTS),
+                        help='effect of items without one (default gradient)')
+    parser.add_argument('--force', action='store_true', help='render unchanged items again')
+    parser.add_argument('--max-tasks-per-child', type=int,
+                        help=f'restart a worker after this many chunks of {CHUNK_ITEMS} items')
+    parser.add_argument('--quiet', '-q', action='store_true', help='only print the final summary')
+    args = parser.parse_args(argv)
+
+    if args.input == '-':
+        progress = run(sys.stdin, args.output, args.workers, args.effect, args.force,
+                       args.max_tasks_per_child, args.quiet)
+    else:
+        with open(args.input, encoding='utf-8') as lines:
+            progress = run(lines, args.output, args.workers, args.effect, args.force,
+                           args.max_tasks_per_child, args.quiet)
+    return 1 if progress.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
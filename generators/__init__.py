@@ -1,3 +1,6 @@
 """
 TextFX image generator modules
-""" 
\ No newline at end of file
+"""
+
+# Bump whenever a change alters rendered output, so cached images are not reused
+RENDERER_VERSION = '5'
@@ -0,0 +1,162 @@
+"""
+Cost-based admission control.
+
+Before a render starts, its cost is estimated from the text layout as
+canvas pixels x frames x a per-effect weight. The weights are render
+times in nanoseconds per pixel and frame, so a cost reads as seconds of
+render time. Renders above a hard ceiling are refused. Under load, when
+the wait for a worker plus the cost would exceed the latency budget,
+effects that have a degraded mode render with cheaper parameters instead.
+"""
+import os
+from .utils import prepare_text_layout
+from .glitch_text import GLITCH_FRAMES, FRAME_DURATION, PADDING, PALETTE_COLORS
+from .neon_text import GLOW_LAYERS
+from .formats import WEBP_FORMATS
+
+# Longest text accepted; checked before the layout is computed
+MAX_TEXT_CHARS = int(os.environ.get('TEXTFX_MAX_TEXT_CHARS', 20000))
+
+# Largest estimated render time in seconds accepted
+MAX_RENDER_COST = float(os.environ.get('TEXTFX_MAX_RENDER_COST', 5))
+
+# Seconds a render may take, waiting included, before it is degraded
+# under load (0 never degrades)
+LATENCY_BUDGET = float(os.environ.get('TEXTFX_LATENCY_BUDGET', 2))
+
+# Nanoseconds per pixel and frame, measured with benchmarks/bench.py on
+# long texts (the neon weight is per glow layer)
+EFFECT_WEIGHTS = {
+    'gradient': 250,
+    'animated_gradient': 20,
+    'neon': 200,
+    'rainbow_wave': 250,
+    'glitch': 180,
+}
+
+# Extra nanoseconds per pixel and frame of each encoder per unit of
+# effort, over the default PNG and GIF encoders
+ENCODING_WEIGHTS = {
+    ('webp', True): 500,
+    ('webp', False): 60,
+    ('apng', True): 30,
+    ('png', True): 0,
+    ('gif', True): 0,
+    ('sprite-webp', True): 500,
+    ('sprite-webp', False): 120,
+    # About the GIF encoder's cost on glitch frames, more than the palette
+    # GIF of the animated gradient
+    ('sprite-png', True): 5,
+    ('rgba', True): 0,
+}
+
+# Seconds every render costs regardless of its size
+BASE_COST = 0.002
+
+# Parameters the generators default to, where they affect the cost
+DEFAULT_PARAMS = {
+    'animated_gradient': {'num_frames': 30, 'duration': 50},
+    'neon': {'layers': GLOW_LAYERS},
+    'glitch': {'num_frames': GLITCH_FRAMES, 'duration': FRAME_DURATION,
+               'colors': PALETTE_COLORS, 'bloom': True},
+}
+
+# Canvas padding added around the text layout
+EFFECT_PADDING = {'glitch': PADDING}
+
+# Degraded animations keep half their frames (shown twice as long)
+DEGRADED_FRAMES = 0.5
+DEGRADED_COLORS = 64
+DEGRADED_EFFORT = 1
+
+
+class RenderTooLarge(ValueError):
+    """A render whose estimated cost is above the hard ceiling."""
+
+    status = 413
+
+
+def render_cost(effect, text, params):
+    """Estimated render time in seconds of effect for text and params."""
+    _, width, height, _, _ = prepare_text_layout(text)
+    return estimate_cost(effect, width, height, params)
+
+
+def estimate_cost(effect, width, height, params):
+    """Estimated render time in seconds on a width x height text layout."""
+    params = dict(DEFAULT_PARAMS.get(effect, {}), **params)
+    width, height = canvas_size(effect, width, height)
+    pixels = width * height
+    weight = EFFECT_WEIGHTS[effect] * params.get('layers', 1)
+    encoding = params.get('encoding')
+    if encoding is not None:
+        lossless = encoding['lossless'] or encoding['format'] not in WEBP_FORMATS
+        weight += ENCODING_WEIGHTS[encoding['format'], lossless] * encoding['effort']
+    return BASE_COST + pixels * params.get('num_frames', 1) * weight * 1e-9
+
+
+def canvas_size(effect, width, height):
+    """Canvas (width, height) of effect on a width x height text layout."""
+    padding = EFFECT_PADDING.get(effect, 0)
+    return width + padding, height + padding
+
+
+def degrade(effect, params):
+    """
+    Cheaper parameters for effect: fewer frames, a smaller palette, no
+    bloom and less encoder effort. Returns only the parameters that
+    changed (empty when the effect has no degraded mode or params are
+    already cheaper).
+    """
+    params = dict(DEFAULT_PARAMS.get(effect, {}), **params)
+    encoding = params.get('encoding')
+    changes = {}
+    if 'num_frames' in params:
+        frames = max(2, int(params['num_frames'] * DEGRADED_FRAMES))
+        if frames < params['num_frames']:
+            # Keep the loop as long as before
+            changes['num_frames'] = frames
+            changes['duration'] = round(params['duration'] * params['num_frames'] / frames)
+    gif = encoding is None or encoding['format'] == 'gif'
+    if params.get('colors', 0) > DEGRADED_COLORS and gif:
+        # Only the GIF encoder has a palette
+        changes['colors'] = DEGRADED_COLORS
+    if params.get('bloom'):
+        changes['bloom'] = False
+    if params.get('layers', 1) > 1:
+        changes['layers'] = 1
+    if not gif and encoding['format'] != 'rgba' and encoding['effort'] > DEGRADED_EFFORT:
+        changes['encoding'] = dict(encoding, effort=DEGRADED_EFFORT)
+    return changes
+
+
+def admit(effect, text, params, queue_wait=None):
+    """
+    Check a render before it is queued. Raises RenderTooLarge when the
+    text or the estimated cost is above the limits. With queue_wait, the
+    seconds until a worker is free, renders that would miss the latency
+    budget are degraded.
+    Returns (params to render with, degraded parameter changes).
+    """
+    if len(text) > MAX_TEXT_CHARS:
+        raise RenderTooLarge(f"'text' is limited to {MAX_TEXT_CHARS} characters")
+    cost = render_cost(effect, text, params)
+    if cost > MAX_RENDER_COST:
+        raise RenderTooLarge(
+            f"Render too large: estimated {cost:.1f}s exceeds the {MAX_RENDER_COST:g}s limit, "
+            f"use shorter text or fewer frames")
+    if queue_wait and LATENCY_BUDGET > 0 and queue_wait + cost > LATENCY_BUDGET:
+        changes = degrade(effect, params)
+        if changes:
+            return dict(params, **changes), changes
+    return params, {}
+
+
+def quality_header(changes):
+    """X-TextFX-Quality header value of a render with degraded changes."""
+    values = []
+    for name, value in sorted(changes.items()):
+        if name == 'encoding':
+            name, value = 'effort', value['effort']
+        values.append(f'{name}={int(value) if isinstance(value, bool) else value}')
+    return '; '.join(['degraded'] + values)
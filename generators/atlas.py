@@ -0,0 +1,122 @@
+"""
+Glyph atlas for compositing many small glyphs without FreeType.
+
+Each glyph of a font face is rasterized once and stored as the list of its
+inked pixels relative to the pen, so a whole run of glyphs can be blitted
+onto a coverage buffer with a single NumPy scatter.
+"""
+import threading
+import numpy as np
+from .instrumentation import timed
+
+
+class GlyphAtlas:
+    """Rasterized glyphs of one font face, added on first use."""
+
+    def __init__(self, font):
+        self.font = font
+        self._index = {}
+        self._glyphs = []  # (rows, columns, 1 - coverage, advance) per glyph
+        self._lock = threading.Lock()
+        # Snapshot read by stamp(): inked pixels of all glyphs back to back
+        # (row, column, 1 - coverage), where each glyph's pixels start, how
+        # many it has, the pen advance (26.6) of each glyph and the rows its
+        # ink spans (top, bottom)
+        empty = np.zeros(0, dtype=np.int64)
+        self._state = (empty, empty, np.zeros(0, dtype=np.float32), empty, empty, empty,
+                       empty, empty)
+
+    def lookup(self, chars):
+        """Return the atlas indices of chars, rasterizing unseen glyphs."""
+        index = self._index
+        missing = [char for char in set(chars) if char not in index]
+        if missing:
+            with self._lock:
+                missing = [char for char in missing if char not in self._index]
+                if missing:
+                    self._add(missing)
+        index = self._index
+        return np.fromiter((index[char] for char in chars), dtype=np.int64, count=len(chars))
+
+    def _add(self, chars):
+        # Callers must hold the lock
+        for char in chars:
+            mask, offset = self.font.getmask2(char, mode='L')
+            bitmap = np.array(mask, dtype=np.uint8).reshape(mask.size[1], mask.size[0])
+            rows, cols = np.nonzero(bitmap)
+            self._glyphs.append((
+                rows + offset[1],
+                cols + offset[0],
+                1 - bitmap[rows, cols].astype(np.float32) / 255,
+                int(round(self.font.getlength(char) * 64))
+            ))
+
+        sizes = np.array([len(glyph[0]) for glyph in self._glyphs], dtype=np.int64)
+        self._state = (
+            np.concatenate([glyph[0] for glyph in self._glyphs]).astype(np.int64),
+            np.concatenate([glyph[1] for glyph in self._glyphs]).astype(np.int64),
+            np.concatenate([glyph[2] for glyph in self._glyphs]),
+            np.cumsum(sizes) - sizes,
+            sizes,
+            np.array([glyph[3] for glyph in self._glyphs], dtype=np.int64),
+            np.array([glyph[0].min() if len(glyph[0]) else 0 for glyph in self._glyphs], dtype=np.int64),
+            np.array([glyph[0].max() + 1 if len(glyph[0]) else 0 for glyph in self._glyphs], dtype=np.int64)
+        )
+        index = dict(self._index)
+        for char in chars:
+            index[char] = len(index)
+        self._index = index
+
+    def advances(self, ids):
+        """Pen advance (26.6 fixed point) of each glyph in ids."""
+        return self._state[5][ids]
+
+    @timed('rasterize')
+    def stamp(self, transmittance, xs, ys, ids):
+        """
+        Blit glyphs onto a float32 transmittance buffer (1 - coverage).
+        Overlapping glyphs combine like Pillow combines them within one
+        string: coverage a and b give a + b - a * b.
+
+        xs and ys are the pen positions of each glyph in buffer coordinates
+        and ids their atlas indices. Glyphs are clipped to the buffer.
+        """
+        rows, cols, keep, starts, sizes, _, tops, bottoms = self._state
+        height, width = transmittance.shape
+        # Glyphs entirely above or below the buffer, as when it is one strip
+        # of a canvas, are left out before their pixels are gathered
+        xs, ys, ids = np.broadcast_arrays(xs, ys, ids)
+        reach = (ys + tops[ids] < height) & (ys + bottoms[ids] > 0)
+        if not reach.all():
+            xs, ys, ids = xs[reach], ys[reach], ids[reach]
+        lengths = sizes[ids]
+        total = int(lengths.sum())
+        if total == 0:
+            return transmittance
+        # Gather the inked pixels of every glyph in one pass
+        glyph = np.repeat(np.arange(len(ids)), lengths)
+        first = np.cumsum(lengths) - lengths
+        pixels = np.arange(total) - np.repeat(first - starts[ids], lengths)
+
+        y = rows[pixels] + ys[glyph]
+        x = cols[pixels] + xs[glyph]
+        inside = (y >= 0) & (y < height) & (x >= 0) & (x < width)
+        np.multiply.at(transmittance.reshape(-1), y[inside] * width + x[inside], keep[pixels][inside])
+        return transmittance
+
+
+_atlases = {}
+_atlases_lock = threading.Lock()
+
+
+def get_atlas(font):
+    """Get the shared glyph atlas of a font face."""
+    key = (getattr(font, 'path', None), getattr(font, 'size', None), id(font))
+    atlas = _atlases.get(key)
+    if atlas is None:
+        with _atlases_lock:
+            atlas = _atlases.get(key)
+            if atlas is None:
+                atlas = GlyphAtlas(font)
+                _atlases[key] = atlas
+    return atlas
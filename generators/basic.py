@@ -1,13 +1,12 @@
-from PIL import Image, ImageDraw, ImageFont
-import io
+from PIL import Image, ImageDraw
 import hashlib
-import os
 from .utils import prepare_text_layout, calculate_text_dimensions
+from .formats import encode_image
 
-def generate_basic_image(text):
+def generate_basic_image(text, encoding=None):
     """
     Generate a basic image with colored background based on text input.
-    Returns a BytesIO object containing the PNG image.
+    Returns a BytesIO object containing the PNG (or encoding's) image.
     """
     # Convert the text into a color by hashing it
     hash_object = hashlib.md5(text.encode())
@@ -33,9 +32,4 @@ def generate_basic_image(text):
         draw.text((x + shadow_offset, y + shadow_offset), line, fill=(0, 0, 0), font=font)
         draw.text((x, y), line, fill=(255, 255, 255), font=font)
     
-    # Save the image to a BytesIO object
-    img_io = io.BytesIO()
-    img.save(img_io, format='PNG')
-    img_io.seek(0)
-    
-    return img_io 
\ No newline at end of file
+    return encode_image(img, encoding) 
\ No newline at end of file
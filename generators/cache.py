@@ -0,0 +1,208 @@
+"""
+Content-addressed cache for rendered images.
+
+Encoded PNG/GIF bytes are stored under a hash of (effect, text, render
+parameters, renderer version). The in-memory tier is an LRU bounded by a byte
+budget; the optional disk tier survives restarts and is shared by every
+worker process pointed at the same directory.
+"""
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from . import RENDERER_VERSION
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_DISK_MAX_BYTES = 1024 * 1024 * 1024
+
+# Disk usage is checked every this many writes
+DISK_PRUNE_INTERVAL = 100
+
+
+def make_key(effect, text, params=None):
+    """Build the cache key for an effect, its text and render parameters."""
+    payload = json.dumps(
+        [RENDERER_VERSION, effect, text, params or {}],
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(',', ':')
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class RenderCache:
+    """LRU cache of encoded images with an optional on-disk tier."""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, disk_dir=None,
+                 disk_max_bytes=DEFAULT_DISK_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._disk_writes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @classmethod
+    def from_env(cls):
+        """Create a cache configured through TEXTFX_CACHE_* variables."""
+        return cls(
+            max_bytes=int(os.environ.get('TEXTFX_CACHE_BYTES', DEFAULT_MAX_BYTES)),
+            disk_dir=os.environ.get('TEXTFX_CACHE_DIR') or None,
+            disk_max_bytes=int(os.environ.get('TEXTFX_CACHE_DISK_BYTES', DEFAULT_DISK_MAX_BYTES))
+        )
+
+    def get(self, key):
+        """Return cached bytes for key, or None."""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+
+        data = self._disk_get(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._memory_put(key, data)
+        return data
+
+    def put(self, key, data):
+        """Store encoded bytes under key."""
+        with self._lock:
+            self._memory_put(key, data)
+        self._disk_put(key, data)
+
+    def get_or_render(self, effect, text, params, render):
+        """
+        Return the cached image for (effect, text, params), calling render()
+        to produce the bytes on a miss.
+        """
+        key = make_key(effect, text, params)
+        data = self.get(key)
+        if data is None:
+            data = render()
+            self.put(key, data)
+        return data
+
+    def _memory_put(self, key, data):
+        # Callers must hold the lock
+        if self.max_bytes <= 0 or len(data) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= len(old)
+        self._entries[key] = data
+        self._size += len(data)
+        while self._size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+            self.evictions += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key)
+
+    def _disk_get(self, key):
+        if not self.disk_dir:
+            return None
+        try:
+            with open(self._disk_path(key), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _disk_put(self, key, data):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename so other workers never read a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError:
+            return
+
+        with self._lock:
+            self._disk_writes += 1
+            prune = self._disk_writes % DISK_PRUNE_INTERVAL == 0
+        if prune:
+            self.prune_disk()
+
+    def prune_disk(self):
+        """Delete the oldest disk entries until the disk tier fits its budget."""
+        if not self.disk_dir:
+            return
+        files = []
+        total = 0
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        if total <= self.disk_max_bytes:
+            return
+        # Trim to 90% of the budget so pruning does not run on every write
+        target = self.disk_max_bytes * 0.9
+        for _, size, path in sorted(files):
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+    def clear(self):
+        """Drop every in-memory entry."""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        """Return hit/miss/eviction counters and memory usage."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'disk_dir': self.disk_dir
+            }
+
+    def _after_fork(self):
+        # Entries are inherited; counters restart per worker
+        self._lock = threading.Lock()
+        self.hits = self.disk_hits = self.misses = self.evictions = 0
+
+
+render_cache = RenderCache.from_env()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=render_cache._after_fork)
@@ -0,0 +1,502 @@
+"""
+Process pool for CPU-heavy renders.
+
+Rendering holds the GIL for most of a request, so one GIF render used to
+stall every other request thread. Renders now run in worker processes that
+load the fonts once at startup. The number of renders running or waiting is
+bounded: when it is full, new requests are turned away immediately with a
+Retry-After hint instead of queueing without limit. A render given up on
+(timed out, or its client gone) is told to stop at its next frame, so it
+frees its worker and slot instead of finishing for nobody.
+"""
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+import math
+import multiprocessing
+import os
+import select
+import threading
+import time
+from .fonts import font_registry
+from .instrumentation import collect
+
+DEFAULT_TIMEOUT = 30
+
+# Weight of the latest render in the average used for Retry-After
+DURATION_SMOOTHING = 0.2
+
+# Seconds between checks on a streaming worker that has not sent anything,
+# or on a stream whose reader has not taken any
+STREAM_POLL_SECONDS = 0.5
+
+# Most bytes of a stream read from its pipe at once
+STREAM_READ_BYTES = 1 << 20
+
+
+class RenderRejected(Exception):
+    """A render that could not be run; status is the HTTP status to report."""
+
+    status = 503
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ServerBusy(RenderRejected):
+    """Every worker is busy and the job queue is full."""
+
+    status = 429
+
+
+class RenderTimeout(RenderRejected):
+    """A render did not finish within the executor's timeout."""
+
+    status = 503
+
+
+class RenderCancelled(Exception):
+    """Raised in a worker by a render that was given up on."""
+
+
+# In a worker process: one flag per job slot, set when the job in that slot
+# is cancelled, and the (slot, deadline) of the job running
+_cancel_flags = None
+_running = None
+
+
+def _warm_worker(cancel_flags=None):
+    # Parse the fonts once per worker instead of on its first render
+    global _cancel_flags
+    _cancel_flags = cancel_flags
+    font_registry.preload()
+
+
+def check_cancelled():
+    """
+    Raise RenderCancelled when the render running in this worker was
+    cancelled or is past its deadline. Renders call this between frames;
+    outside of a worker job it does nothing.
+    """
+    if _running is None:
+        return
+    job, deadline = _running
+    if _cancel_flags[job]:
+        raise RenderCancelled('Render was cancelled')
+    if deadline is not None and time.monotonic() > deadline:
+        raise RenderCancelled('Render is past its deadline')
+
+
+def _run_job(job, deadline, function, *args):
+    global _running
+    _running = (job, deadline)
+    try:
+        return function(*args)
+    finally:
+        _running = None
+
+
+def _render_job(generator, text, params):
+    with collect() as timings:
+        data = generator(text, **params).getvalue()
+    return data, timings.stages
+
+
+def _render_batch_job(groups):
+    # [(text, [(generator, params), ...]), ...]: renders of the same text run
+    # back to back so they share its cached layout. Failures are reported
+    # per render.
+    results = []
+    for text, renders in groups:
+        for generator, params in renders:
+            try:
+                data, stages = _render_job(generator, text, params)
+                results.append((True, data, stages))
+            except RenderCancelled:
+                raise
+            except Exception as e:
+                results.append((False, str(e), {}))
+    return results
+
+
+def _stream_job(generator, text, params, conn):
+    # Write each chunk to the pipe as soon as it is encoded; the stream
+    # ends when the pipe is closed, and the stage times (or the error) go
+    # to the future. The pipe only buffers a little, so a slow client slows
+    # the render down instead of piling frames up in memory, and a closed
+    # pipe means the client went away. Writes never block, so a client too
+    # slow to take the stream before the deadline stops the render too:
+    # the request thread waiting on that client cannot.
+    fd = conn.fileno()
+    os.set_blocking(fd, False)
+    try:
+        with collect() as timings:
+            for chunk in generator(text, **params):
+                view = memoryview(chunk)
+                while view:
+                    check_cancelled()
+                    if select.select([], [fd], [], STREAM_POLL_SECONDS)[1]:
+                        view = view[os.write(fd, view):]
+        return timings.stages
+    except (BrokenPipeError, ConnectionResetError, RenderCancelled):
+        return None
+    finally:
+        conn.close()
+
+
+class RenderExecutor:
+    """Bounded process pool running generate_* functions."""
+
+    def __init__(self, workers=None, max_queue=None, timeout=DEFAULT_TIMEOUT):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if max_queue is None:
+            max_queue = workers * 2
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._pool = None
+        self._reset_state()
+
+    @classmethod
+    def from_env(cls):
+        """Create an executor configured through TEXTFX_* variables."""
+        workers = os.environ.get('TEXTFX_WORKERS')
+        max_queue = os.environ.get('TEXTFX_QUEUE_SIZE')
+        return cls(
+            workers=int(workers) if workers else None,
+            max_queue=int(max_queue) if max_queue else None,
+            timeout=float(os.environ.get('TEXTFX_RENDER_TIMEOUT', DEFAULT_TIMEOUT))
+        )
+
+    def _reset_state(self):
+        self._lock = threading.Lock()
+        # One slot per job running or waiting in the pool, and a cancel flag
+        # per slot shared with the workers
+        slots = max(1, self.workers + self.max_queue)
+        self._slots = threading.BoundedSemaphore(slots)
+        self._cancel_flags = multiprocessing.RawArray('b', slots)
+        self._free_jobs = list(range(slots))
+        self._jobs = {}
+        self._pending = 0
+        self._seconds = 0.0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def render(self, generator, text, params):
+        """
+        Run generator(text, **params) in a worker process and return
+        (encoded bytes, stage times). Raises ServerBusy when the queue is
+        full and RenderTimeout when the render takes longer than the timeout.
+        """
+        if self.workers <= 0:
+            # Pool disabled: render in the calling thread
+            return _render_job(generator, text, params)
+
+        future = self.submit(generator, text, params)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            self.cancel(future)
+            raise self.timed_out()
+        except RenderCancelled:
+            # The worker reached the deadline before we did
+            raise self.timed_out()
+        except BrokenProcessPool:
+            raise self.pool_broken()
+
+    def submit(self, generator, text, params):
+        """
+        Queue generator(text, **params) on a worker process without waiting
+        for it. Raises ServerBusy like render(); the returned future holds
+        (encoded bytes, stage times). Callers apply the timeout themselves
+        (see timed_out()) and give up on the render with cancel(); the
+        render also stops by itself once past the timeout. Requires a
+        process pool (workers > 0).
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise ServerBusy('Too many renders in progress, try again later',
+                             self.retry_after())
+        started = time.monotonic()
+        try:
+            return self._start(started, started + self.timeout, _render_job, generator, text, params)
+        except (BrokenProcessPool, RuntimeError):
+            raise RenderRejected('Render workers are restarting, try again later')
+
+    def cancel(self, future):
+        """
+        Give up on a render from submit() or a stream: one that has not
+        started is dropped, and a running one stops at its next frame,
+        freeing its worker and slot.
+        """
+        if future.cancel():
+            return
+        with self._lock:
+            job = self._jobs.get(future)
+            if job is not None:
+                self._cancel_flags[job] = 1
+
+    def _start(self, started, deadline, function, *args):
+        # Queue function(*args) on the pool under a free job slot, for a
+        # caller holding a slot of the semaphore. The slot is only freed
+        # once the worker is done, so renders that outlive their timeout
+        # still count against the queue.
+        with self._lock:
+            job = self._free_jobs.pop()
+        self._cancel_flags[job] = 0
+        try:
+            future = self._get_pool().submit(_run_job, job, deadline, function, *args)
+        except (BrokenProcessPool, RuntimeError):
+            with self._lock:
+                self._free_jobs.append(job)
+            self._slots.release()
+            self._discard_pool()
+            raise
+        with self._lock:
+            self._pending += 1
+            self._jobs[future] = job
+        future.add_done_callback(lambda future: self._finished(future, started))
+        return future
+
+    def timed_out(self):
+        """Count a render that missed the timeout; returns the RenderTimeout to raise."""
+        with self._lock:
+            self.timeouts += 1
+        return RenderTimeout(f'Render did not finish within {self.timeout:g} seconds',
+                             self.retry_after())
+
+    def pool_broken(self):
+        """Drop a pool whose worker died; returns the RenderRejected to raise."""
+        self._discard_pool()
+        return RenderRejected('A render worker stopped unexpectedly, try again later')
+
+    def stream(self, generator, text, params, on_stages=None):
+        """
+        Run a streaming generator(text, **params), which yields encoded
+        chunks, in a worker process. Admission happens right away (raising
+        ServerBusy like render()); the returned iterator then yields chunks
+        as the worker produces them. Closing the iterator early, or a
+        client too slow to take the stream within the timeout, stops the
+        render. on_stages(stage times) is called when the stream completes.
+        """
+        if self.workers <= 0:
+            return self._stream_inline(generator, text, params, on_stages)
+
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise ServerBusy('Too many renders in progress, try again later',
+                             self.retry_after())
+        self._get_pool()
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        started = time.monotonic()
+        try:
+            future = self._start(started, started + self.timeout,
+                                 _stream_job, generator, text, params, writer)
+        except (BrokenProcessPool, RuntimeError):
+            reader.close()
+            writer.close()
+            raise RenderRejected('Render workers are restarting, try again later')
+        return self._stream_chunks(future, reader, writer, started, on_stages)
+
+    @staticmethod
+    def _stream_inline(generator, text, params, on_stages):
+        with collect() as timings:
+            chunks = generator(text, **params)
+        while True:
+            with collect() as chunk_timings:
+                chunk = next(chunks, None)
+            for name, seconds in chunk_timings.stages.items():
+                timings.stages[name] = timings.stages.get(name, 0.0) + seconds
+            if chunk is None:
+                break
+            yield chunk
+        if on_stages is not None:
+            on_stages(timings.stages)
+
+    def _stream_chunks(self, future, reader, writer, started, on_stages):
+        deadline = started + self.timeout
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise self.timed_out()
+                if not reader.poll(min(remaining, STREAM_POLL_SECONDS)):
+                    if future.done() and not reader.poll():
+                        break
+                    continue
+                chunk = os.read(reader.fileno(), STREAM_READ_BYTES)
+                if not chunk:
+                    break
+                if not writer.closed:
+                    # The worker holds its own end now; with ours closed, the
+                    # worker closing its end (or dying) shows up as end of file
+                    writer.close()
+                yield chunk
+            stages = self._stream_result(future, deadline)
+            if on_stages is not None:
+                on_stages(stages)
+        finally:
+            # Closing our end makes the worker stop at its next send, and
+            # cancelling it at its next frame
+            reader.close()
+            writer.close()
+            if not future.done():
+                self.cancel(future)
+
+    def _stream_result(self, future, deadline):
+        # Stage times of a stream whose pipe was closed, or the error that
+        # stopped it
+        try:
+            stages = future.result(timeout=max(0, deadline - time.monotonic()))
+        except FutureTimeout:
+            raise self.timed_out()
+        except BrokenProcessPool:
+            raise self.pool_broken()
+        if stages is None:
+            # The worker gave up at its deadline
+            raise self.timed_out()
+        return stages
+
+    def render_batch(self, jobs):
+        """
+        Run jobs of [(text, [(generator, params), ...]), ...], yielding
+        (job index, [(ok, bytes or error message, stage times), ...]) as
+        jobs finish, with one result per render in job order.
+        A batch keeps at most one job per worker in flight and waits for
+        free queue slots instead of being rejected, so it only uses the
+        capacity single requests leave over.
+        """
+        if self.workers <= 0:
+            for i, groups in enumerate(jobs):
+                yield i, _render_batch_job(groups)
+            return
+
+        pending = iter(enumerate(jobs))
+        in_flight = {}
+        try:
+            while True:
+                while len(in_flight) < self.workers:
+                    job = next(pending, None)
+                    if job is None:
+                        break
+                    i, groups = job
+                    count = sum(len(renders) for _, renders in groups)
+                    future = self._submit_batch_job(groups)
+                    if isinstance(future, str):
+                        yield i, [(False, future, {})] * count
+                    else:
+                        in_flight[future] = (i, count)
+                if not in_flight:
+                    return
+
+                done, _ = wait(in_flight, timeout=self.timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    # Nothing finished within the timeout: give up on every
+                    # job in flight (they keep their slots until they stop)
+                    for future, (i, count) in in_flight.items():
+                        self.cancel(future)
+                        yield i, [(False, f'Render did not finish within {self.timeout:g} seconds', {})] * count
+                    with self._lock:
+                        self.timeouts += len(in_flight)
+                    in_flight.clear()
+                    continue
+                for future in done:
+                    i, count = in_flight.pop(future)
+                    try:
+                        results = future.result()
+                    except BrokenProcessPool:
+                        self._discard_pool()
+                        results = [(False, 'A render worker stopped unexpectedly', {})] * count
+                    except Exception as e:
+                        results = [(False, str(e), {})] * count
+                    yield i, results
+        finally:
+            for future in in_flight:
+                self.cancel(future)
+
+    def _submit_batch_job(self, groups):
+        # Returns the future, or an error message when the job was not queued
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.rejected += 1
+            return 'Too many renders in progress'
+        try:
+            return self._start(time.monotonic(), None, _render_batch_job, groups)
+        except (BrokenProcessPool, RuntimeError):
+            return 'Render workers are restarting'
+
+    def _finished(self, future, started):
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self._free_jobs.append(self._jobs.pop(future))
+            self._pending -= 1
+            self.completed += 1
+            if self._seconds:
+                self._seconds += (elapsed - self._seconds) * DURATION_SMOOTHING
+            else:
+                self._seconds = elapsed
+        self._slots.release()
+
+    def queue_wait(self):
+        """Seconds a render submitted now should wait for a free worker."""
+        with self._lock:
+            waiting = self._pending + 1 - self.workers
+            return self._seconds * max(0, waiting) / max(1, self.workers)
+
+    def retry_after(self):
+        """Seconds until the queued renders should have drained."""
+        with self._lock:
+            backlog = self._seconds * self._pending / max(1, self.workers)
+        return max(1, math.ceil(backlog))
+
+    def start(self):
+        """Start the worker processes now instead of on the first render."""
+        if self.workers > 0:
+            self._get_pool()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 initializer=_warm_worker,
+                                                 initargs=(self._cancel_flags,))
+                # Fork the workers now: forked later, a worker would inherit
+                # the pipes of streams in progress and keep their reader
+                # open after it was closed, so closing never stopped them
+                self._pool.submit(os.getpid)
+            return self._pool
+
+    def _discard_pool(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        """Return pool size, queue usage and job counters."""
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'max_queue': self.max_queue,
+                'pending': self._pending,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'avg_seconds': round(self._seconds, 4)
+            }
+
+    def _after_fork(self):
+        # A forked server worker must start its own pool; the parent's pool
+        # processes and its bookkeeping threads do not exist in the child
+        self._pool = None
+        self._reset_state()
+
+
+render_executor = RenderExecutor.from_env()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=render_executor._after_fork)
@@ -0,0 +1,124 @@
+"""
+Process-wide font registry.
+
+Font faces are parsed from disk once per (path, size) and then shared by every
+render in the process. Preloading the registry before gunicorn forks its
+workers lets them inherit the parsed faces instead of loading their own.
+"""
+from PIL import ImageFont
+import os
+import threading
+
+DEFAULT_FONT_PATHS = [
+    "C:\\Windows\\Fonts\\arial.ttf",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/System/Library/Fonts/Helvetica.ttc"
+]
+
+# Font sizes picked by get_dynamic_dimensions
+PRELOAD_SIZES = (14, 12, 10)
+
+# Extra font files (os.pathsep separated) searched before the defaults
+FONT_PATHS_ENV = 'TEXTFX_FONT_PATHS'
+
+
+class FontRegistry:
+    """Thread-safe cache of loaded font faces keyed by (font path, size)."""
+
+    def __init__(self, font_paths=None):
+        self._lock = threading.Lock()
+        self._fonts = {}
+        self._font_paths = list(DEFAULT_FONT_PATHS if font_paths is None else font_paths)
+        self._default_path = None
+        self._default_path_resolved = False
+        self.hits = 0
+        self.misses = 0
+
+    def add_font_path(self, path):
+        """Register an extra font file, preferred over the ones already known."""
+        with self._lock:
+            if path in self._font_paths:
+                self._font_paths.remove(path)
+            self._font_paths.insert(0, path)
+            self._default_path_resolved = False
+
+    def default_path(self):
+        """Return the first font file that exists on disk, or None."""
+        with self._lock:
+            return self._resolve_default_path()
+
+    def _resolve_default_path(self):
+        # Probe the disk once; callers must hold the lock
+        if not self._default_path_resolved:
+            self._default_path = next(
+                (path for path in self._font_paths if os.path.exists(path)), None
+            )
+            self._default_path_resolved = True
+        return self._default_path
+
+    def get(self, size=14, path=None):
+        """Get the font face for path (default: first available font) and size."""
+        with self._lock:
+            if path is None:
+                path = self._resolve_default_path()
+            key = (path, size)
+            font = self._fonts.get(key)
+            if font is not None:
+                self.hits += 1
+                return font
+            self.misses += 1
+            # Parsing happens under the lock so a face is never loaded twice
+            font = self._load(path, size)
+            self._fonts[key] = font
+            return font
+
+    @staticmethod
+    def _load(path, size):
+        if path is None:
+            return ImageFont.load_default()
+        try:
+            return ImageFont.truetype(path, size)
+        except Exception:
+            return ImageFont.load_default()
+
+    def preload(self, sizes=PRELOAD_SIZES, paths=None):
+        """Load every (path, size) combination up front."""
+        for path in paths or [None]:
+            for size in sizes:
+                self.get(size, path)
+
+    def stats(self):
+        """Return hit/miss counters and the number of loaded faces."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'loaded': len(self._fonts),
+                'default_path': self._default_path
+            }
+
+    def clear(self):
+        """Drop every loaded face and reset the counters."""
+        with self._lock:
+            self._fonts.clear()
+            self._default_path_resolved = False
+            self.hits = 0
+            self.misses = 0
+
+    def _after_fork(self):
+        # A lock held by another thread at fork time would never be released
+        # in the child. Faces are inherited; counters restart per worker.
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+def _configured_font_paths():
+    extra = [p for p in os.environ.get(FONT_PATHS_ENV, '').split(os.pathsep) if p]
+    return extra + DEFAULT_FONT_PATHS
+
+
+font_registry = FontRegistry(_configured_font_paths())
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=font_registry._after_fork)
@@ -0,0 +1,117 @@
+"""
+Output formats and the encoder options shared by every effect.
+
+Still images are PNG or WebP, animations GIF, animated WebP or APNG, or
+their frames as a PNG or WebP sprite sheet or raw RGBA (see sprites.py). An
+encoding is a dict of format, lossless, quality and effort. Renderers take
+it as their encoding parameter, where None keeps the effect's own format
+(PNG or the palette GIF encoder) with default options.
+"""
+from PIL import Image, PngImagePlugin
+import io
+from .instrumentation import stage
+
+STILL_FORMATS = ('png', 'webp')
+ANIMATED_FORMATS = ('gif', 'webp', 'apng')
+# Frames of an animation, only given when asked for by name
+FRAME_FORMATS = ('sprite-png', 'sprite-webp', 'rgba')
+WEBP_FORMATS = ('webp', 'sprite-webp')
+
+MIMETYPES = {
+    'png': 'image/png',
+    'gif': 'image/gif',
+    'webp': 'image/webp',
+    'apng': 'image/apng',
+    'sprite-png': 'image/png',
+    'sprite-webp': 'image/webp',
+    'rgba': 'application/octet-stream',
+}
+
+EXTENSIONS = {
+    'png': 'png',
+    'gif': 'gif',
+    'webp': 'webp',
+    'apng': 'png',
+    'sprite-png': 'png',
+    'sprite-webp': 'webp',
+    'rgba': 'rgba',
+}
+
+# Animation formats the Accept header may pick. Animated WebP and APNG are
+# left out: in the format benchmarks both come out larger than the palette
+# GIF, even lossy WebP, and take several times as long to encode. They are
+# still served when asked for by name
+NEGOTIATED_ANIMATED_FORMATS = ('gif',)
+
+# lossless and quality (0-100) only apply to WebP; effort (0-6) is the
+# WebP method and maps onto the zlib level of PNG and APNG. The GIF
+# encoder takes none of them
+DEFAULT_OPTIONS = {'lossless': True, 'quality': 80, 'effort': 4}
+MAX_EFFORT = 6
+
+# Lossless animated WebP came out over three times the size of the GIF and
+# took more than ten times as long, so animations default to lossy
+ANIMATED_WEBP_OPTIONS = dict(DEFAULT_OPTIONS, lossless=False, effort=3)
+
+
+def make_encoding(image_format, animated=False, **options):
+    """
+    Complete encoding for image_format; unset options take their defaults,
+    those of ANIMATED_WEBP_OPTIONS for an animated WebP.
+    """
+    defaults = ANIMATED_WEBP_OPTIONS if animated and image_format == 'webp' else DEFAULT_OPTIONS
+    return dict(defaults, **options, format=image_format)
+
+
+def _save_options(encoding):
+    if encoding['format'] in WEBP_FORMATS:
+        return {
+            'format': 'WEBP',
+            'lossless': encoding['lossless'],
+            'quality': encoding['quality'],
+            'method': encoding['effort'],
+        }
+    # The default effort gives zlib's default level 6, like a plain save
+    return {'format': 'PNG', 'compress_level': round(encoding['effort'] * 9 / MAX_EFFORT)}
+
+
+def encode_image(image, encoding=None):
+    """
+    Encode a still image (PIL image or RGBA array) as PNG or WebP, or a
+    WebP sprite sheet.
+    Returns a BytesIO object.
+    """
+    if not isinstance(image, Image.Image):
+        image = Image.fromarray(image)
+    options = _save_options(encoding or make_encoding('png'))
+    img_io = io.BytesIO()
+    with stage('encode'):
+        image.save(img_io, **options)
+    img_io.seek(0)
+    return img_io
+
+
+def encode_animation(frames, duration, encoding, loop=0):
+    """
+    Encode (height, width, 4) uint8 RGBA frames as animated WebP or APNG.
+    duration is a delay in milliseconds, or one per frame. Unlike GIF,
+    alpha is kept in full and there is no palette.
+    Returns a BytesIO object.
+    """
+    # Frames may be reused buffers, so each one is copied into its own image
+    images = [Image.fromarray(frame).copy() for frame in frames]
+    options = _save_options(encoding)
+    if encoding['format'] == 'webp':
+        # The canvas starts out transparent
+        options['background'] = (0, 0, 0, 0)
+    else:
+        # Frames replace what they cover instead of blending over it, so
+        # pixels that turn transparent are cleared
+        options['disposal'] = PngImagePlugin.Disposal.OP_NONE
+        options['blend'] = PngImagePlugin.Blend.OP_SOURCE
+    img_io = io.BytesIO()
+    with stage('encode'):
+        images[0].save(img_io, save_all=True, append_images=images[1:],
+                       duration=duration, loop=loop, **options)
+    img_io.seek(0)
+    return img_io
@@ -0,0 +1,81 @@
+"""
+Frame scheduling within one animation.
+
+The frames of an animation are independent of each other once its random
+draws are made, but used to be rendered one after another, so a single
+large render kept one core busy. On canvases of at least
+PARALLEL_MIN_PIXELS, frames now render on a pool of threads a few frames
+ahead of the encoder, which still takes them in order. The heavy work of a
+frame is NumPy and Pillow array code that releases the GIL, and threads
+share the request's glyphs and draws without copying them. Smaller
+canvases render inline, where handing frames to a thread would cost more
+than it saves.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+from .executor import check_cancelled
+
+# Threads rendering the frames of one animation (1 renders inline)
+FRAME_THREADS = int(os.environ.get('TEXTFX_FRAME_THREADS', min(4, os.cpu_count() or 1)))
+
+# Smallest canvas, in pixels, whose frames are rendered in parallel
+PARALLEL_MIN_PIXELS = int(os.environ.get('TEXTFX_PARALLEL_MIN_PIXELS', 100000))
+
+_lock = threading.Lock()
+_pool = None
+
+
+def _get_pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=FRAME_THREADS,
+                                       thread_name_prefix='textfx-frame')
+        return _pool
+
+
+def parallel(pixels):
+    """Whether frames of a canvas of pixels are rendered on the thread pool."""
+    return FRAME_THREADS > 1 and pixels >= PARALLEL_MIN_PIXELS
+
+
+def render_frames(render_frame, num_frames, pixels):
+    """
+    Yield render_frame(i) for every frame i in order. On large canvases
+    frames render on the thread pool, at most FRAME_THREADS ahead of the
+    one being consumed; render_frame must then be safe to call from
+    several threads at once. Closing the iterator early drops the frames
+    not yet started, and a render cancelled by its executor stops before
+    its next frame.
+    """
+    if not parallel(pixels):
+        for frame in range(num_frames):
+            check_cancelled()
+            yield render_frame(frame)
+        return
+
+    pool = _get_pool()
+    pending = []
+    try:
+        for frame in range(num_frames):
+            check_cancelled()
+            pending.append(pool.submit(render_frame, frame))
+            if len(pending) > FRAME_THREADS:
+                yield pending.pop(0).result()
+        while pending:
+            yield pending.pop(0).result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _after_fork():
+    # The pool's threads do not exist in a forked child
+    global _pool, _lock
+    _pool = None
+    _lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
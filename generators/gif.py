@@ -0,0 +1,287 @@
+"""
+Palette-aware animated GIF encoder.
+
+Every animation uses one global palette: either computed by the effect (when
+its colors are known analytically) or sampled across all frames. Pixels are
+mapped to palette indices with a vectorized lookup table instead of running
+Pillow's quantizer per frame. Each frame only encodes the rectangle that
+changed since the previous one, and frame disposal is chosen so that
+transparent pixels stay transparent.
+"""
+from PIL import Image, GifImagePlugin
+import io
+import itertools
+import struct
+import numpy as np
+from .instrumentation import timed
+
+# Palette index reserved for transparent pixels
+TRANSPARENT_INDEX = 255
+MAX_COLORS = 255
+
+# Color precision (bits per channel) of the index lookup table
+LUT_BITS = 6
+
+# Pixels sampled across all frames when building a palette
+PALETTE_SAMPLES = 65536
+
+DISPOSAL_NONE = 1
+DISPOSAL_BACKGROUND = 2
+
+
+@timed('quantize')
+def build_lut(palette):
+    """
+    Map every color (at LUT_BITS per channel) to its nearest palette index.
+    Returns a (levels, levels, levels) uint8 array indexed by [r, g, b].
+    """
+    levels = 1 << LUT_BITS
+    shift = 8 - LUT_BITS
+    # Centre of every LUT cell
+    cube = np.indices((levels, levels, levels), dtype=np.uint16).reshape(3, -1).T
+    cube = ((cube << shift) + (1 << shift >> 1)).astype(np.uint8)
+    cube_img = Image.fromarray(cube.reshape(-1, levels * 8, 3), 'RGB')
+    palette_img = Image.new('P', (1, 1))
+    palette_img.putpalette(np.asarray(palette, dtype=np.uint8).tobytes())
+    indices = cube_img.quantize(palette=palette_img, dither=Image.Dither.NONE)
+    return np.asarray(indices).reshape(levels, levels, levels)
+
+
+@timed('quantize')
+def sample_palette(frames, colors=MAX_COLORS, alpha_threshold=1):
+    """
+    Build one palette from the visible pixels of every RGBA frame.
+    Returns a (n, 3) uint8 array with n <= colors.
+    """
+    samples = []
+    per_frame = max(1, PALETTE_SAMPLES // max(1, len(frames)))
+    for frame in frames:
+        visible = frame[frame[..., 3] >= alpha_threshold][:, :3]
+        if len(visible) > per_frame:
+            visible = visible[::len(visible) // per_frame]
+        samples.append(visible)
+    samples = np.concatenate(samples) if samples else np.zeros((0, 3), np.uint8)
+    if len(samples) == 0:
+        return np.zeros((1, 3), dtype=np.uint8)
+    sample_img = Image.fromarray(samples.reshape(1, -1, 3), 'RGB')
+    quantized = sample_img.quantize(colors=colors, method=Image.Quantize.FASTOCTREE)
+    palette = np.array(quantized.getpalette()[:colors * 3], dtype=np.uint8)
+    return palette.reshape(-1, 3)
+
+
+@timed('quantize')
+def rgba_to_indices(frame, lut, alpha_threshold=1):
+    """
+    Map an RGBA frame to palette indices through a lookup table.
+    Pixels with alpha below alpha_threshold become TRANSPARENT_INDEX.
+    """
+    shift = 8 - LUT_BITS
+    indices = lut[frame[..., 0] >> shift, frame[..., 1] >> shift, frame[..., 2] >> shift]
+    indices[frame[..., 3] < alpha_threshold] = TRANSPARENT_INDEX
+    return indices
+
+
+def _bbox(mask):
+    # (left, top, right, bottom) of the True pixels, or None
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+
+def _union(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+class GifWriter:
+    """
+    Incremental animated GIF writer over a global palette.
+
+    Frames are (height, width) uint8 index arrays using TRANSPARENT_INDEX for
+    transparency. One frame is held back so its disposal method can be chosen
+    once the following frame is known.
+    """
+
+    def __init__(self, fp, size, palette, loop=0):
+        self.fp = fp
+        self.size = size
+        self._pending = None  # [rect, data, duration]
+        self._canvas = None   # indices shown once the pending frame is drawn
+        self._first = None
+        self.frame_count = 0
+        self._write_header(palette, loop)
+
+    def _write_header(self, palette, loop):
+        palette = np.asarray(palette, dtype=np.uint8).reshape(-1, 3)[:MAX_COLORS]
+        table = np.zeros((256, 3), dtype=np.uint8)
+        table[:len(palette)] = palette
+        width, height = self.size
+        self.fp.write(
+            b'GIF89a'
+            + struct.pack('<HHBBB', width, height, 0xF7, TRANSPARENT_INDEX, 0)
+            + table.tobytes()
+        )
+        if loop is not None:
+            self.fp.write(b'!\xff\x0bNETSCAPE2.0\x03\x01' + struct.pack('<H', loop) + b'\x00')
+
+    @timed('encode')
+    def add_frame(self, indices, duration):
+        """Queue the next frame; the previous one is written out."""
+        indices = np.ascontiguousarray(indices, dtype=np.uint8)
+        if self._pending is None:
+            # The first frame always covers the whole canvas
+            self._first = indices.copy()
+            self._pending = [(0, 0) + self.size, self._first, duration]
+            self._canvas = self._first
+            return
+
+        canvas = self._canvas
+        if not self._can_overlay(canvas, indices):
+            self._flush(DISPOSAL_BACKGROUND)
+            rect = _bbox(indices != TRANSPARENT_INDEX) or (0, 0, 1, 1)
+            self._pending = [rect, self._crop(indices, rect), duration]
+            self._canvas = indices.copy()
+            return
+
+        changed = indices != canvas
+        rect = _bbox(changed)
+        if rect is None:
+            # Identical to the previous frame: just show that one longer
+            self._pending[2] += duration
+            return
+        self._flush(DISPOSAL_NONE)
+        data = self._crop(indices, rect).copy()
+        # Unchanged pixels let the previous frame show through
+        data[~self._crop(changed, rect)] = TRANSPARENT_INDEX
+        self._pending = [rect, data, duration]
+        self._canvas = indices.copy()
+
+    @staticmethod
+    def _can_overlay(canvas, indices):
+        # Drawing over the canvas cannot turn a visible pixel transparent
+        return not np.any((indices == TRANSPARENT_INDEX) & (canvas != TRANSPARENT_INDEX))
+
+    @staticmethod
+    def _crop(array, rect):
+        left, top, right, bottom = rect
+        return array[top:bottom, left:right]
+
+    def _flush(self, disposal):
+        rect, data, duration = self._pending
+        if disposal == DISPOSAL_BACKGROUND:
+            # Restoring the background must clear everything visible, so the
+            # frame has to cover all visible pixels of the canvas
+            visible = _bbox(self._canvas != TRANSPARENT_INDEX)
+            full = _union(rect, visible)
+            if full != rect:
+                rect = full
+                data = self._crop(self._canvas, rect)
+        self._write_frame(rect, data, duration, disposal)
+        self._pending = None
+
+    def _write_frame(self, rect, data, duration, disposal):
+        im = Image.fromarray(np.ascontiguousarray(data), 'L')
+        for chunk in GifImagePlugin.getdata(
+            im,
+            offset=rect[:2],
+            duration=duration,
+            disposal=disposal,
+            transparency=TRANSPARENT_INDEX
+        ):
+            self.fp.write(chunk)
+        self.frame_count += 1
+
+    @timed('encode')
+    def close(self):
+        """Write the last frame and the trailer."""
+        if self._pending is not None:
+            # The animation loops back onto the first frame
+            if self._can_overlay(self._canvas, self._first):
+                self._flush(DISPOSAL_NONE)
+            else:
+                self._flush(DISPOSAL_BACKGROUND)
+        self.fp.write(b';')
+
+
+def iter_gif(index_frames, size, palette, duration, loop=0):
+    """
+    Encode palette index frames as an animated GIF, yielding the encoded
+    bytes as soon as each frame is written. Frames are pulled one at a time,
+    so a frame generator never has more than two frames alive. The header
+    comes with the first frame, so a render that fails before it yields
+    nothing and can still be answered with an error.
+    duration is a delay in milliseconds, or one per frame.
+    """
+    out = io.BytesIO()
+
+    def take():
+        data = out.getvalue()
+        out.seek(0)
+        out.truncate()
+        return data
+
+    writer = GifWriter(out, size, palette, loop)
+    for i, indices in enumerate(index_frames):
+        frame_duration = duration[i] if isinstance(duration, (list, tuple)) else duration
+        writer.add_frame(indices, frame_duration)
+        data = take()
+        if data:
+            yield data
+    writer.close()
+    yield take()
+
+
+def encode_gif(index_frames, size, palette, duration, loop=0):
+    """
+    Encode palette index frames as an animated GIF.
+    duration is a delay in milliseconds, or one per frame.
+    Returns a BytesIO object containing the GIF.
+    """
+    return io.BytesIO(b''.join(iter_gif(index_frames, size, palette, duration, loop)))
+
+
+def iter_rgba_gif(frames, duration, palette=None, colors=MAX_COLORS,
+                  alpha_threshold=1, loop=0, palette_frames=None):
+    """
+    Encode (height, width, 4) uint8 RGBA frames as an animated GIF, yielding
+    the encoded bytes as frames are written.
+    Without a palette, one of up to colors entries is sampled from the first
+    palette_frames frames (all of them when None). Only those frames are
+    held at once, so a bounded palette_frames keeps memory bounded too.
+    Pixels with any coverage are drawn opaque, like Pillow's own RGBA to
+    palette conversion.
+    """
+    frames = iter(frames)
+    if palette is None:
+        head = list(itertools.islice(frames, palette_frames))
+        palette = sample_palette(head, colors, alpha_threshold)
+    else:
+        head = [next(frames)]
+    lut = build_lut(palette)
+    height, width = head[0].shape[:2]
+
+    def index_frames():
+        while head:
+            yield rgba_to_indices(head.pop(0), lut, alpha_threshold)
+        for frame in frames:
+            yield rgba_to_indices(frame, lut, alpha_threshold)
+
+    return iter_gif(index_frames(), (width, height), palette, duration, loop)
+
+
+def encode_rgba_gif(frames, duration, palette=None, colors=MAX_COLORS,
+                    alpha_threshold=1, loop=0):
+    """
+    Encode (height, width, 4) uint8 RGBA frames as an animated GIF.
+    Without a palette, one of up to colors entries is sampled across all
+    frames. Pixels with any coverage are drawn opaque, like Pillow's own
+    RGBA to palette conversion.
+    Returns a BytesIO object containing the GIF.
+    """
+    return io.BytesIO(b''.join(iter_rgba_gif(frames, duration, palette, colors,
+                                             alpha_threshold, loop)))
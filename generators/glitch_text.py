@@ -1,8 +1,13 @@
-from PIL import Image, ImageDraw, ImageFont, ImageChops, ImageFilter
+from PIL import Image, ImageFilter
 import io
 import numpy as np
-import random
-from .utils import prepare_text_layout
+import zlib
+from .utils import prepare_text_layout, render_text_mask, row_strips, blur_margin, STRIP_ROWS
+from .atlas import get_atlas
+from .gif import iter_rgba_gif
+from .formats import encode_animation, FRAME_FORMATS
+from .sprites import iter_frame_output
+from .frames import render_frames
 
 # Zalgo-like combining characters for corruption effect
 ZALGO_CHARS = [
@@ -11,122 +16,364 @@ ZALGO_CHARS = [
                     list(range(0x20D0, 0x20FF))     # Combining Diacritical Marks for Symbols
 ]
 
-def corrupt_text(text, intensity=0.3):
+# Colors in the animation's global palette; the glitch look is mostly
+# white, red, cyan and magenta over dim bloom
+PALETTE_COLORS = 128
+
+# Leading frames the palette is sampled from before streaming starts
+PALETTE_FRAMES = 4
+
+# Length of the animation (50ms per frame = 20fps)
+GLITCH_FRAMES = 20
+FRAME_DURATION = 50
+
+# Room around the text for the layer offsets and glitch line shifts
+PADDING = 30
+
+# Corrupted copies of the text drawn over it, and the rows shifted sideways
+# in every frame
+LAYER_INTENSITIES = (0.2, 0.3, 0.4)
+GLITCH_LINES = 5
+MAX_LINE_HEIGHT = 3
+
+# Layer colors (r, g, b, a) over the white text
+LAYER_COLORS = ((255, 0, 0, 80), (0, 255, 255, 80), (255, 0, 255, 80))
+
+BLOOM_RADIUS = 1
+
+def text_seed(text):
+    """Stable default seed for text, so identical requests render identically."""
+    return zlib.crc32(text.encode('utf-8'))
+
+def corrupt_text(text, intensity=0.3, rng=None):
     """Add zalgo-like corruption to text."""
-    result = ""
-    for char in text:
-        result += char
-        # Add random combining characters
-        num_corruptions = int(random.random() * 5 * intensity) + 1
-        for _ in range(num_corruptions):
-            result += random.choice(ZALGO_CHARS)
-    return result
-
-def create_glitch_frame(lines, width, height, font, line_height, padding, frame_num):
-    """Create a single frame of the glitch animation."""
-    base = Image.new('RGBA', (width + padding, height + padding), (0, 0, 0, 0))
-    draw = ImageDraw.Draw(base)
+    if rng is None:
+        rng = np.random.default_rng()
+    counts, marks = draw_corruption(len(text), intensity, rng)
+    parts = []
+    start = 0
+    for char, count in zip(text, counts):
+        parts.append(char)
+        parts.extend(ZALGO_CHARS[mark] for mark in marks[start:start + count])
+        start += count
+    return "".join(parts)
+
+def draw_corruption(num_chars, intensity, rng):
+    """
+    Pick the combining marks added after each of num_chars characters.
+    Returns (marks per character, ZALGO_CHARS indices of all marks in order).
+    """
+    counts = (rng.random(num_chars) * 5 * intensity).astype(np.int64) + 1
+    marks = rng.integers(0, len(ZALGO_CHARS), int(counts.sum()))
+    return counts, marks
+
+def layer_intensities(frames):
+    """Corruption intensity of every layer in frames: a (len(frames), layers) array."""
+    # Vary corruption intensity with time
+    intensity_mod = (np.sin(np.asarray(frames) * 0.2) + 1) * 0.2
+    return np.add.outer(intensity_mod, LAYER_INTENSITIES)
+
+def draw_glitch(rng, num_frames, num_chars, first_frame=0):
+    """
+    Make every random choice of num_frames frames in one draw per kind: the
+    combining marks added to each character of each corrupted layer, and
+    the height of each glitch line.
+    Returns (marks per character (frames, layers, chars), ZALGO_CHARS
+    indices of all marks in order, line heights (frames, GLITCH_LINES)).
+    """
+    intensities = layer_intensities(np.arange(first_frame, first_frame + num_frames))
+    draws = rng.random((num_frames, len(LAYER_INTENSITIES), num_chars))
+    counts = (draws * 5 * intensities[..., None]).astype(np.int64) + 1
+    marks = rng.integers(0, len(ZALGO_CHARS), int(counts.sum()))
+    heights = rng.integers(1, MAX_LINE_HEIGHT + 1, (num_frames, GLITCH_LINES))
+    return counts, marks, heights
+
+def split_glitch_draws(counts, marks, heights):
+    """
+    Split draw_glitch() results into per-frame (counts, marks per layer,
+    heights) tuples for create_glitch_frame.
+    """
+    layer_marks = np.split(marks, np.cumsum(counts.sum(axis=2).ravel())[:-1])
+    layers = counts.shape[1]
+    return [(counts[frame], layer_marks[frame * layers:(frame + 1) * layers], heights[frame])
+            for frame in range(len(counts))]
+
+def make_scratch(shape):
+    """
+    Buffers create_glitch_frame reuses for every frame of a canvas shape,
+    each one strip of rows high: float planes for compositing (alpha,
+    transmittance, layer alpha and three premultiplied color planes) and
+    the visible pixels, plus the rows of a glitch line.
+    """
+    height, width = shape
+    rows = max(1, min(STRIP_ROWS, height))
+    return (np.empty((6, rows, width), dtype=np.float32),
+            np.empty((rows, width), dtype=bool),
+            np.empty((MAX_LINE_HEIGHT, width, 4), dtype=np.uint8))
+
+def shift_rows(rows, shift, scratch):
+    """np.roll(rows, shift, axis=1) in place, through a small scratch buffer."""
+    width = rows.shape[1]
+    shift %= width
+    if shift == 0 or len(rows) == 0:
+        return
+    saved = scratch[:len(rows)]
+    saved[...] = rows
+    rows[:, shift:] = saved[:, :width - shift]
+    rows[:, :shift] = saved[:, width - shift:]
+
+def prepare_glitch_glyphs(lines, width, height, font, line_height, padding):
+    """
+    Per-request state shared by every frame: the clean text mask, the atlas
+    indices of every character and the line each character belongs to.
+    Returns (text_mask, char_ids, char_lines, mark_ids)
+    """
+    origin = padding // 2
+    text_mask = render_text_mask(lines, width + padding, height + padding,
+                                 font, line_height, (origin, origin))
+    atlas = get_atlas(font)
+    chars = "".join(lines)
+    char_ids = atlas.lookup(chars)
+    char_lines = np.repeat(np.arange(len(lines)), [len(line) for line in lines])
+    mark_ids = atlas.lookup(ZALGO_CHARS)
+    return text_mask, char_ids, char_lines, mark_ids
+
+def render_corrupted_layer(font, glyphs, counts, marks, origin, line_height, transmittance, top=0):
+    """
+    Blit every line corrupted with combining marks onto a float32
+    transmittance buffer (1 - coverage), starting at origin. counts and
+    marks are the marks after each character, as from draw_corruption().
+    The buffer holds the canvas rows from top on.
+    The same as drawing corrupt_text() of each line, without FreeType.
+    """
+    xs, ys, ids = place_corrupted_layer(font, glyphs, counts, marks, origin, line_height)
+    return get_atlas(font).stamp(transmittance, xs, ys - top, ids)
+
+def place_corrupted_layer(font, glyphs, counts, marks, origin, line_height):
+    """
+    Pen positions of every glyph of a corrupted layer, characters
+    interleaved with their marks. Returns (xs, ys, atlas ids).
+    """
+    _, char_ids, char_lines, mark_ids = glyphs
+    if len(char_ids) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    atlas = get_atlas(font)
+    
+    # Interleave each character with its marks
+    glyph_counts = counts + 1
+    ids = np.empty(int(glyph_counts.sum()), dtype=np.int64)
+    char_slots = np.arange(len(char_ids)) + np.cumsum(counts) - counts
+    is_char = np.zeros(len(ids), dtype=bool)
+    is_char[char_slots] = True
+    ids[is_char] = char_ids
+    ids[~is_char] = mark_ids[marks]
+    glyph_lines = np.repeat(char_lines, glyph_counts)
+    
+    # Pen positions restart at every line; missing marks draw a box and
+    # advance the pen like FreeType does
+    advances = atlas.advances(ids)
+    pens = np.cumsum(advances) - advances
+    line_starts = np.flatnonzero(np.diff(glyph_lines, prepend=-1))
+    pens -= np.repeat(pens[line_starts], np.diff(np.append(line_starts, len(ids))))
+    
+    xs = origin[0] + ((pens + 32) >> 6)
+    ys = origin[1] + glyph_lines * line_height
+    return xs, ys, ids
+
+def composite_strip(atlas, text_mask, layers, top, scratch, out):
+    """
+    Composite the colored glitch layers over the white text for the canvas
+    rows from top, as many as out holds, into the RGBA rows out. layers are
+    (color, xs, ys, ids) of each layer's glyphs.
+    """
+    planes, visible, _ = scratch
+    rows = len(out)
+    alpha, transmittance, layer_alpha = planes[:3, :rows]
+    premultiplied = planes[3:, :rows]
+    visible = visible[:rows]
+    
+    # Main text in white, composited in premultiplied float space. Every
+    # plane is a reused scratch buffer, updated in place
+    np.divide(text_mask[top:top + rows], np.float32(255), out=alpha)
+    premultiplied[:] = alpha
+    
+    for color, xs, ys, ids in layers:
+        transmittance.fill(1)
+        atlas.stamp(transmittance, xs, ys - top, ids)
+        
+        # Layer alpha is the glyph coverage scaled by the color's alpha
+        np.subtract(1, transmittance, out=layer_alpha)
+        layer_alpha *= color[3] / 255
+        keep = np.subtract(1, layer_alpha, out=transmittance)
+        for plane in premultiplied:
+            plane *= keep
+        alpha *= keep
+        # keep is spent, its buffer holds each color's contribution
+        for plane, value in zip(premultiplied, color[:3]):
+            plane += np.multiply(layer_alpha, np.float32(value) / np.float32(255), out=transmittance)
+        alpha += layer_alpha
+    
+    # Back to straight alpha; fully transparent pixels stay black
+    visible = np.greater(alpha, 0, out=visible)
+    temp = transmittance
+    for channel, plane in enumerate(premultiplied):
+        temp.fill(0)
+        np.divide(plane, alpha, out=temp, where=visible)
+        temp *= 255
+        out[..., channel] = np.rint(temp, out=temp)
+    np.multiply(alpha, 255, out=temp)
+    out[..., 3] = np.rint(temp, out=temp)
+    return out
+
+def apply_bloom(img_array, rows=STRIP_ROWS):
+    """
+    Blend a blur of an RGBA frame into it (30% blur), in place, a strip of
+    rows at a time. Each strip is blurred with enough rows around it that
+    the result matches blurring the whole frame.
+    """
+    margin = blur_margin(BLOOM_RADIUS)
+    height = len(img_array)
+    # Unblended rows just above the current strip
+    above = img_array[:0].copy()
+    for top, bottom in row_strips(height, rows):
+        source = img_array[top:min(height, bottom + margin)]
+        halo = len(above)
+        if halo:
+            source = np.concatenate([above, source])
+        above = np.concatenate([above, img_array[top:bottom]])[-margin:]
+        strip = Image.fromarray(source)
+        strip = Image.blend(strip, strip.filter(ImageFilter.GaussianBlur(radius=BLOOM_RADIUS)), 0.3)
+        img_array[top:bottom] = np.asarray(strip)[halo:halo + bottom - top]
+    return img_array
+
+def create_glitch_frame(lines, width, height, font, line_height, padding, frame_num,
+                        rng=None, glyphs=None, bloom=True, draws=None, scratch=None):
+    """
+    Create a single frame of the glitch animation. draws are the frame's
+    random choices from split_glitch_draws(); without them they are drawn
+    from rng. scratch holds buffers from make_scratch() to reuse.
+    """
+    if glyphs is None:
+        glyphs = prepare_glitch_glyphs(lines, width, height, font, line_height, padding)
+    if draws is None:
+        if rng is None:
+            rng = np.random.default_rng()
+        draws = split_glitch_draws(*draw_glitch(rng, 1, len(glyphs[1]), frame_num))[0]
+    text_mask = glyphs[0]
+    if scratch is None:
+        scratch = make_scratch(text_mask.shape)
+    layer_counts, layer_marks, line_heights = draws
     
     # Use frame number to create varying effects
     time_offset = frame_num * 0.2
     
-    for i, line in enumerate(lines):
-        y = i * line_height + padding//2
-        
-        # Create three versions of corrupted text with different intensities
-        # Vary corruption intensity with time
-        intensity_mod = (np.sin(time_offset) + 1) * 0.2
-        corrupted_text1 = corrupt_text(line, 0.2 + intensity_mod)
-        corrupted_text2 = corrupt_text(line, 0.3 + intensity_mod)
-        corrupted_text3 = corrupt_text(line, 0.4 + intensity_mod)
-        
-        # Draw main text
-        draw.text((padding//2, y), line, font=font, fill=(255, 255, 255, 255))
-        
-        # Draw glitch layers with animated offsets
-        base_offsets = [(-2, -1), (2, 1), (-1, 2)]
-        offsets = [
-            (x + int(np.sin(time_offset + idx) * 2), 
-             y + int(np.cos(time_offset + idx) * 2))
-            for idx, (x, y) in enumerate(base_offsets)
-        ]
-        
-        colors = [
-            (255, 0, 0, 80),
-            (0, 255, 255, 80),
-            (255, 0, 255, 80)
-        ]
-        corrupted_texts = [corrupted_text1, corrupted_text2, corrupted_text3]
-        
-        for offset, color, glitched_text in zip(offsets, colors, corrupted_texts):
-            draw.text((padding//2 + offset[0], y + offset[1]), 
-                     glitched_text, font=font, fill=color)
+    # Glitch layers with animated offsets
+    base_offsets = [(-2, -1), (2, 1), (-1, 2)]
+    offsets = [
+        (x + int(np.sin(time_offset + idx) * 2), 
+         y + int(np.cos(time_offset + idx) * 2))
+        for idx, (x, y) in enumerate(base_offsets)
+    ]
+    
+    layers = []
+    for (dx, dy), color, counts, marks in zip(offsets, LAYER_COLORS, layer_counts, layer_marks):
+        origin = (padding//2 + dx, padding//2 + dy)
+        layers.append((color,) + place_corrupted_layer(font, glyphs, counts, marks, origin, line_height))
     
-    # Convert to numpy array for additional glitch effects
-    img_array = np.array(base)
+    # Composite a strip of rows at a time, so the float planes only span
+    # one strip however long the text is
+    atlas = get_atlas(font)
+    img_array = np.empty(text_mask.shape + (4,), dtype=np.uint8)
+    for top, bottom in row_strips(len(text_mask), len(scratch[1])):
+        composite_strip(atlas, text_mask, layers, top, scratch, img_array[top:bottom])
     
     # Add controlled glitch lines that move with time
-    num_glitch_lines = 5
-    for _ in range(num_glitch_lines):
+    for i, glitch_height in enumerate(line_heights):
         # Position glitch lines using frame number
-        y_pos = int(np.sin(time_offset + _ * 1.5) * height/3 + height/2)
-        glitch_height = np.random.randint(1, 4)
-        glitch_shift = int(np.sin(time_offset * 2 + _) * 8)
+        y_pos = int(np.sin(time_offset + i * 1.5) * height/3 + height/2)
+        glitch_shift = int(np.sin(time_offset * 2 + i) * 8)
         
         # Shift a horizontal slice of the image
         slice_start = max(0, y_pos)
         slice_end = min(height + padding, y_pos + glitch_height)
-        img_array[slice_start:slice_end] = np.roll(img_array[slice_start:slice_end], glitch_shift, axis=1)
+        shift_rows(img_array[slice_start:slice_end], glitch_shift, scratch[2])
     
-    # Add scan lines that move
-    scan_lines = np.ones_like(img_array)
+    # Add scan lines that move. The 0.9 attenuation was always applied
+    # through a uint8 array, which truncates it to 0: the rows are cleared
     scan_offset = int(frame_num * 2) % 2
-    scan_lines[(2 + scan_offset)::4, :, :] = 0.9
-    img_array = (img_array * scan_lines).astype(np.uint8)
-    
-    # Convert back to PIL Image for final effects
-    glitch_img = Image.fromarray(img_array)
+    img_array[(2 + scan_offset)::4] = 0
     
-    # Add subtle bloom effect
-    bloom_layer = glitch_img.copy()
-    bloom_layer = bloom_layer.filter(ImageFilter.GaussianBlur(radius=1))
-    glitch_img = Image.blend(glitch_img, bloom_layer, 0.3)
+    # Add subtle bloom effect, blended straight into the frame
+    if bloom:
+        apply_bloom(img_array)
     
-    return glitch_img
+    return Image.fromarray(img_array)
 
-def generate_glitch_text(text):
+def glitch_frames(text, seed=None, num_frames=GLITCH_FRAMES, bloom=True):
     """
-    Generate text with an animated glitch effect on transparent background.
-    Returns a BytesIO object containing the animated GIF.
+    Yield the RGBA frames of the glitch animation one at a time.
+    The same text and seed always produce the same frames; seed defaults
+    to a hash of the text.
     """
     # Get text layout information
     lines, width, height, font, line_height = prepare_text_layout(text)
-    padding = 30
-    
-    # Create multiple frames
-    frames = []
-    num_frames = 20  # Number of frames in animation
-    
-    for frame in range(num_frames):
-        frame_img = create_glitch_frame(lines, width, height, font, line_height, padding, frame)
-        # Convert to P mode (palette) for better GIF compatibility
-        frame_img = frame_img.convert('RGBA').convert('P', palette=Image.ADAPTIVE, colors=255)
-        frames.append(frame_img)
-    
-    # Save as animated GIF
-    img_io = io.BytesIO()
-    # Save first frame
-    frames[0].save(
-        img_io, 
-        format='GIF',
-        save_all=True,
-        append_images=frames[1:],
-        duration=50,  # 50ms per frame = 20fps
-        loop=0,
-        optimize=True,
-        disposal=2,  # Clear each frame before rendering next
-        transparency=255  # Set last palette index as transparent
-    )
-    img_io.seek(0)
-    
-    return img_io 
\ No newline at end of file
+    padding = PADDING
+    
+    # Per-render random state keeps output reproducible and thread-safe
+    if seed is None:
+        seed = text_seed(text)
+    rng = np.random.default_rng(seed)
+    
+    # The clean text and glyph indices are the same in every frame
+    glyphs = prepare_glitch_glyphs(lines, width, height, font, line_height, padding)
+    
+    # Every random choice of the animation, drawn up front
+    draws = split_glitch_draws(*draw_glitch(rng, num_frames, len(glyphs[1])))
+    
+    # One set of scratch buffers per frame rendering at the same time
+    scratches = []
+    
+    def render(frame):
+        try:
+            scratch = scratches.pop()
+        except IndexError:
+            scratch = make_scratch(glyphs[0].shape)
+        try:
+            return np.asarray(create_glitch_frame(lines, width, height, font, line_height,
+                                                  padding, frame, glyphs=glyphs, bloom=bloom,
+                                                  draws=draws[frame], scratch=scratch))
+        finally:
+            scratches.append(scratch)
+    
+    yield from render_frames(render, num_frames, glyphs[0].size)
+
+def iter_glitch_text(text, seed=None, num_frames=GLITCH_FRAMES, duration=FRAME_DURATION,
+                     colors=PALETTE_COLORS, bloom=True, encoding=None):
+    """
+    Stream the glitch GIF: yields the encoded bytes as each frame is
+    rendered and written. Animated WebP and APNG encodings and WebP sprite
+    sheets are yielded in one piece once every frame is encoded.
+    """
+    frames = glitch_frames(text, seed, num_frames, bloom)
+    if encoding is not None and encoding['format'] in FRAME_FORMATS:
+        return iter_frame_output(frames, num_frames, encoding)
+    if encoding is not None and encoding['format'] != 'gif':
+        return iter([encode_animation(frames, duration, encoding).getvalue()])
+    # One palette sampled from the first frames, so encoding can start
+    # before the rest are rendered
+    return iter_rgba_gif(frames, duration=duration, colors=colors,
+                         palette_frames=PALETTE_FRAMES)
+
+def generate_glitch_text(text, seed=None, num_frames=GLITCH_FRAMES, duration=FRAME_DURATION,
+                         colors=PALETTE_COLORS, bloom=True, encoding=None):
+    """
+    Generate text with an animated glitch effect on transparent background.
+    The same text and seed always produce the same animation; seed defaults
+    to a hash of the text. num_frames, duration (ms per frame), colors
+    (GIF palette size) and bloom trade quality for render time.
+    Returns a BytesIO object containing the animated GIF (or encoding's
+    animation).
+    """
+    return io.BytesIO(b''.join(iter_glitch_text(text, seed, num_frames, duration,
+                                                colors, bloom, encoding)))
@@ -1,106 +1,71 @@
-from PIL import Image, ImageDraw, ImageFont
 import io
-import os
 import numpy as np
-from .utils import prepare_text_layout
+from .utils import (prepare_text_layout, render_text_mask, row_strips, sine_gradient_colors,
+                    sine_gradient_frames, sine_gradient_palette, sine_gradient_frame_indices,
+                    colorize_mask, colorize_mask_frames)
+from .gif import iter_gif, TRANSPARENT_INDEX
+from .formats import encode_image, encode_animation, FRAME_FORMATS
+from .sprites import iter_frame_output
+from .frames import render_frames
 
-def generate_gradient_text(text):
+def generate_gradient_text(text, encoding=None):
     """
     Generate text with RGB gradient effect on transparent background.
-    Returns a BytesIO object containing the PNG image.
+    Returns a BytesIO object containing the PNG (or encoding's) image.
     """
     # Get text layout information
     lines, width, height, font, line_height = prepare_text_layout(text)
     
-    # Create the actual image with transparent background
-    img = Image.new('RGBA', (width, height), (0, 0, 0, 0))
-    draw = ImageDraw.Draw(img)
+    # Rasterize and colorize the text a strip of rows at a time, straight
+    # into the image
+    colors = sine_gradient_colors(width)
+    img_array = np.empty((height, width, 4), dtype=np.uint8)
+    for top, bottom in row_strips(height):
+        mask = render_text_mask(lines, width, height, font, line_height, rows=(top, bottom))
+        colorize_mask(mask, colors, out=img_array[top:bottom])
     
-    # Draw each line of text in white
-    for i, line in enumerate(lines):
-        y = i * line_height
-        draw.text((0, y), line, fill=(255, 255, 255, 255), font=font)
-    
-    # Convert to numpy array for easier manipulation
-    img_array = np.array(img)
-    
-    # Create gradient array
-    x = np.linspace(0, 2*np.pi, width)
-    r = np.sin(x) * 127 + 128
-    g = np.sin(x + 2*np.pi/3) * 127 + 128
-    b = np.sin(x + 4*np.pi/3) * 127 + 128
-    
-    # Apply gradient only to non-transparent pixels
-    for i in range(width):
-        mask = img_array[:, i, 3] > 0
-        img_array[mask, i, 0] = r[i]
-        img_array[mask, i, 1] = g[i]
-        img_array[mask, i, 2] = b[i]
-    
-    # Convert back to PIL Image
-    gradient_img = Image.fromarray(img_array)
-    
-    # Save the image to a BytesIO object
-    img_io = io.BytesIO()
-    gradient_img.save(img_io, format='PNG')
-    img_io.seek(0)
+    return encode_image(img_array, encoding)
+
+def animated_gradient_frames(lines, width, height, font, line_height, num_frames, palette_size):
+    """
+    Yield the palette index frames of the scrolling gradient one at a time.
+    """
+    # The text never moves, so rasterize it once for every frame
+    mask = render_text_mask(lines, width, height, font, line_height)
     
-    return img_io
+    # Only the gradient phase changes between frames, and its colors are
+    # known up front: map every column straight to a global palette index
+    frame_indices = sine_gradient_frame_indices(width, num_frames, palette_size)
+    ink = mask > 0
+    yield from render_frames(lambda frame: np.where(ink, frame_indices[frame], TRANSPARENT_INDEX),
+                             len(frame_indices), ink.size)
 
-def generate_animated_gradient_text(text, num_frames=30):
+def iter_animated_gradient_text(text, num_frames=30, duration=50, encoding=None):
     """
-    Generate animated text with scrolling RGB gradient effect.
-    Returns a BytesIO object containing the animated GIF.
+    Stream the animated gradient GIF: yields the encoded bytes as each
+    frame is rendered and written. Animated WebP and APNG encodings and
+    WebP sprite sheets are yielded in one piece once every frame is encoded.
     """
     # Get text layout information
     lines, width, height, font, line_height = prepare_text_layout(text)
-    
-    frames = []
-    
-    # Create base frames
-    for frame in range(num_frames):
-        # Create the image with transparent background
-        img = Image.new('RGBA', (width, height), (0, 0, 0, 0))
-        draw = ImageDraw.Draw(img)
-        
-        # Draw each line of text in white
-        for i, line in enumerate(lines):
-            y = i * line_height
-            draw.text((0, y), line, fill=(255, 255, 255, 255), font=font)
-        
-        # Convert to numpy array for easier manipulation
-        img_array = np.array(img)
-        
-        # Create scrolling gradient array
-        phase = 2 * np.pi * frame / num_frames  # Phase shift for animation
-        x = np.linspace(0, 2*np.pi, width) + phase
-        r = np.sin(x) * 127 + 128
-        g = np.sin(x + 2*np.pi/3) * 127 + 128
-        b = np.sin(x + 4*np.pi/3) * 127 + 128
-        
-        # Apply gradient only to non-transparent pixels
-        for i in range(width):
-            mask = img_array[:, i, 3] > 0
-            img_array[mask, i, 0] = r[i]
-            img_array[mask, i, 1] = g[i]
-            img_array[mask, i, 2] = b[i]
-        
-        # Convert back to PIL Image
-        gradient_frame = Image.fromarray(img_array)
-        frames.append(gradient_frame)
-    
-    # Save the animation to a BytesIO object
-    img_io = io.BytesIO()
-    # Save as GIF with 50ms delay between frames (20 fps)
-    frames[0].save(
-        img_io,
-        format='GIF',
-        save_all=True,
-        append_images=frames[1:],
-        duration=50,
-        loop=0,
-        optimize=False
-    )
-    img_io.seek(0)
-    
-    return img_io 
\ No newline at end of file
+    if encoding is not None and encoding['format'] != 'gif':
+        # Full color and alpha: no palette needed
+        mask = render_text_mask(lines, width, height, font, line_height)
+        frames = colorize_mask_frames(mask, sine_gradient_frames(width, num_frames))
+        if encoding['format'] in FRAME_FORMATS:
+            return iter_frame_output(frames, num_frames, encoding)
+        return iter([encode_animation(frames, duration, encoding).getvalue()])
+    palette = sine_gradient_palette()
+    frames = animated_gradient_frames(lines, width, height, font, line_height,
+                                      num_frames, len(palette))
+    return iter_gif(frames, (width, height), palette, duration)
+
+def generate_animated_gradient_text(text, num_frames=30, duration=50, encoding=None):
+    """
+    Generate animated text with scrolling RGB gradient effect.
+    num_frames sets the smoothness of the scroll and duration the delay
+    between frames in milliseconds.
+    Returns a BytesIO object containing the animated GIF (or encoding's
+    animation).
+    """
+    return io.BytesIO(b''.join(iter_animated_gradient_text(text, num_frames, duration, encoding)))
@@ -0,0 +1,262 @@
+"""
+Per-stage render timing and Prometheus metrics.
+
+A render is split into stages: layout, rasterize, effect, quantize and
+encode. Code marks its stage with the timed decorator or the stage()
+context manager; time not claimed by any stage counts as effect. Stages
+keep their own (exclusive) time, so a rasterization inside an effect loop
+is not counted twice.
+
+Timing only runs inside collect(). Outside of it, and everywhere when
+TEXTFX_TIMING=0, a stage costs one flag check.
+"""
+from contextvars import ContextVar
+import functools
+import os
+import threading
+import time
+
+STAGES = ('layout', 'rasterize', 'effect', 'quantize', 'encode')
+
+# Time not claimed by a stage
+DEFAULT_STAGE = 'effect'
+
+ENABLED = os.environ.get('TEXTFX_TIMING', '1') != '0'
+
+_timer = ContextVar('stage_timer', default=None)
+
+
+class StageTimer:
+    """Exclusive time per stage of one render, in seconds."""
+
+    def __init__(self):
+        self.stages = {}
+        self._stack = [DEFAULT_STAGE]
+        self._mark = time.perf_counter()
+
+    def _switch(self):
+        now = time.perf_counter()
+        top = self._stack[-1]
+        self.stages[top] = self.stages.get(top, 0.0) + now - self._mark
+        self._mark = now
+
+    def push(self, name):
+        self._switch()
+        self._stack.append(name)
+
+    def pop(self):
+        self._switch()
+        self._stack.pop()
+
+    def finish(self):
+        """Close the running stage and return the stage times."""
+        self._switch()
+        return self.stages
+
+
+class _Stage:
+    __slots__ = ('name', 'timer')
+
+    def __init__(self, name):
+        self.name = name
+        self.timer = None
+
+    def __enter__(self):
+        self.timer = _timer.get()
+        if self.timer is not None:
+            self.timer.push(self.name)
+
+    def __exit__(self, *exc):
+        if self.timer is not None:
+            self.timer.pop()
+
+
+class _NoStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_STAGE = _NoStage()
+
+
+def stage(name):
+    """Context manager attributing the time spent inside it to a stage."""
+    if not ENABLED:
+        return _NO_STAGE
+    return _Stage(name)
+
+
+def timed(name):
+    """Decorator attributing the time spent in a function to a stage."""
+    def decorate(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            timer = _timer.get()
+            if timer is None:
+                return func(*args, **kwargs)
+            timer.push(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timer.pop()
+        return wrapper
+    return decorate
+
+
+class collect:
+    """
+    Time the stages of everything run inside the block:
+
+        with collect() as timings:
+            render()
+        timings.stages  # {'layout': 0.001, ...}
+
+    timings.stages stays empty when timing is disabled.
+    """
+
+    def __enter__(self):
+        self.stages = {}
+        if ENABLED:
+            self._timer = StageTimer()
+            self._token = _timer.set(self._timer)
+        return self
+
+    def __exit__(self, *exc):
+        if ENABLED:
+            _timer.reset(self._token)
+            self.stages = self._timer.finish()
+
+
+def server_timing(stages, total=None, cache=None, first_chunk=None):
+    """Format stage times (seconds) as a Server-Timing header value."""
+    parts = [f'{name};dur={stages[name] * 1000:.2f}' for name in STAGES if name in stages]
+    if total is not None:
+        parts.append(f'total;dur={total * 1000:.2f}')
+    if first_chunk is not None:
+        parts.append(f'first-chunk;dur={first_chunk * 1000:.2f}')
+    if cache is not None:
+        parts.append(f'cache;desc="{cache}"')
+    return ', '.join(parts)
+
+
+# Histogram buckets: seconds per stage and render, bytes per output
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class Histogram:
+    """Prometheus histogram with labels."""
+
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, labels, value):
+        # Callers must hold the registry lock
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def lines(self):
+        yield f'# HELP {self.name} {self.help_text}'
+        yield f'# TYPE {self.name} histogram'
+        for labels, series in sorted(self._series.items()):
+            label_text = ','.join(f'{k}="{v}"' for k, v in zip(self.label_names, labels))
+            for bound, count in zip(self.buckets, series):
+                yield f'{self.name}_bucket{{{label_text},le="{bound:g}"}} {count}'
+            yield f'{self.name}_bucket{{{label_text},le="+Inf"}} {series[-1]}'
+            yield f'{self.name}_sum{{{label_text}}} {series[-2]:.6f}'
+            yield f'{self.name}_count{{{label_text}}} {series[-1]}'
+
+
+class RenderMetrics:
+    """Per-process render histograms and request counters."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stage_seconds = Histogram(
+            'textfx_render_stage_seconds', 'Render time per effect and stage.',
+            ('effect', 'stage'), SECONDS_BUCKETS)
+        self.render_seconds = Histogram(
+            'textfx_render_seconds', 'Wall time of renders (cache misses) per effect.',
+            ('effect',), SECONDS_BUCKETS)
+        self.output_bytes = Histogram(
+            'textfx_output_bytes', 'Encoded image size per effect.',
+            ('effect',), BYTES_BUCKETS)
+        self.requests = {}  # (effect, cache) -> count
+        self.admission = {}  # (effect, outcome) -> count
+
+    def observe_render(self, effect, stages, total, size):
+        """Record a fresh render: its stage times, wall time and output size."""
+        with self._lock:
+            for name, seconds in stages.items():
+                self.stage_seconds.observe((effect, name), seconds)
+            if total is not None:
+                self.render_seconds.observe((effect,), total)
+            if size is not None:
+                self.output_bytes.observe((effect,), size)
+
+    def count_request(self, effect, cache):
+        """
+        Count an image served from the cache ('hit'), rendered ('miss') or
+        taken from a render already in progress ('coalesced').
+        """
+        with self._lock:
+            key = (effect, cache)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def count_admission(self, effect, outcome):
+        """Count a render that admission control 'degraded' or 'refused'."""
+        with self._lock:
+            key = (effect, outcome)
+            self.admission[key] = self.admission.get(key, 0) + 1
+
+    def prometheus(self, samples=()):
+        """
+        Render every metric in the Prometheus text format. samples is a list
+        of (name, type, help, value) read by the caller at scrape time, such
+        as cache and queue counters.
+        """
+        lines = []
+        with self._lock:
+            for histogram in (self.stage_seconds, self.render_seconds, self.output_bytes):
+                lines.extend(histogram.lines())
+            lines.append('# HELP textfx_images_total Images served per effect and cache result.')
+            lines.append('# TYPE textfx_images_total counter')
+            for (effect, cache), count in sorted(self.requests.items()):
+                lines.append(f'textfx_images_total{{effect="{effect}",cache="{cache}"}} {count}')
+            lines.append('# HELP textfx_admission_total Renders degraded or refused by admission control.')
+            lines.append('# TYPE textfx_admission_total counter')
+            for (effect, outcome), count in sorted(self.admission.items()):
+                lines.append(f'textfx_admission_total{{effect="{effect}",outcome="{outcome}"}} {count}')
+        for name, kind, help_text, value in samples:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def _after_fork(self):
+        # Series are per process; a forked worker starts from zero
+        self.__init__()
+
+
+render_metrics = RenderMetrics()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=render_metrics._after_fork)
@@ -0,0 +1,141 @@
+"""
+Glyph metrics index for fast text measurement.
+
+Measuring text through ImageDraw.textbbox costs a throwaway image and a full
+FreeType layout pass per call. FontMetrics caches per-glyph advances and ink
+extents, kerning pairs and the line height of one font face, and reproduces
+Pillow's basic-layout bounding box from those tables. Anything the tables
+cannot answer exactly falls back to Pillow, so results always match what
+Pillow renders.
+"""
+from PIL import Image, ImageDraw, ImageFont
+import threading
+
+# Entries kept per cache before it is reset (user text is unbounded)
+MAX_CACHE_ENTRIES = 50000
+
+# Shared 1x1 canvas for measurements that need ImageDraw (multiline text)
+_measure_draw = ImageDraw.Draw(Image.new('RGBA', (1, 1), (0, 0, 0, 0)))
+
+
+def _pixel(value):
+    """Round a 26.6 fixed point value to whole pixels like FreeType's PIXEL()."""
+    return (value + 32) >> 6
+
+
+class FontMetrics:
+    """Cached glyph metrics for a single font face."""
+
+    def __init__(self, font):
+        self.font = font
+        # Table lookups only reproduce Pillow's basic (non-shaping) layout
+        self.exact = (
+            isinstance(font, ImageFont.FreeTypeFont)
+            and font.layout_engine == ImageFont.Layout.BASIC
+        )
+        self._glyphs = {}
+        self._kerning = {}
+        self._words = {}
+        _, self.line_height = self.text_size("Ay")
+
+    def _glyph(self, char):
+        # (advance in 26.6, left, top, right, bottom, right is ink) for a char
+        glyph = self._glyphs.get(char)
+        if glyph is None:
+            if len(self._glyphs) >= MAX_CACHE_ENTRIES:
+                self._glyphs.clear()
+            advance = int(round(self.font.getlength(char) * 64))
+            left, top, right, bottom = self.font.getbbox(char)
+            # getbbox reports max(advance, ink right); only a larger value is
+            # known to be the ink edge itself
+            glyph = (advance, left, top, right, bottom, right > _pixel(advance))
+            self._glyphs[char] = glyph
+        return glyph
+
+    def _kern(self, first, second):
+        # Kerning adjustment in 26.6 between two adjacent characters
+        pair = first + second
+        delta = self._kerning.get(pair)
+        if delta is None:
+            if len(self._kerning) >= MAX_CACHE_ENTRIES:
+                self._kerning.clear()
+            delta = (
+                int(round(self.font.getlength(pair) * 64))
+                - self._glyph(first)[0]
+                - self._glyph(second)[0]
+            )
+            self._kerning[pair] = delta
+        return delta
+
+    def text_bbox(self, text):
+        """Return the (left, top, right, bottom) box Pillow reports for text."""
+        if not self.exact or not text or "\n" in text:
+            return _measure_draw.textbbox((0, 0), text, font=self.font)
+
+        position = 0
+        x_min = 0
+        x_max = 0
+        bound = 0  # upper bound from glyphs whose ink edge is not known
+        top = bottom = None
+        previous = None
+        for char in text:
+            advance, left, g_top, right, g_bottom, right_is_ink = self._glyph(char)
+            if previous is not None:
+                position += self._kern(previous, char)
+            px = _pixel(position)
+            if px + left < x_min:
+                x_min = px + left
+            if right_is_ink:
+                if px + right > x_max:
+                    x_max = px + right
+            elif px + right > bound:
+                bound = px + right
+            if top is None or g_top < top:
+                top = g_top
+            if bottom is None or g_bottom > bottom:
+                bottom = g_bottom
+            position += advance
+            previous = char
+
+        x_max = max(x_max, _pixel(position))
+        if bound > x_max:
+            # A glyph might reach past the pen; only FreeType knows its ink
+            return self.font.getbbox(text)
+        return x_min, top, x_max, bottom
+
+    def text_size(self, text):
+        """Return (width, height) of text."""
+        left, top, right, bottom = self.text_bbox(text)
+        return right - left, bottom - top
+
+    def text_width(self, text):
+        """Return the width of text."""
+        left, _, right, _ = self.text_bbox(text)
+        return right - left
+
+    def word_width(self, word):
+        """Return the width of a word followed by its separating space."""
+        width = self._words.get(word)
+        if width is None:
+            if len(self._words) >= MAX_CACHE_ENTRIES:
+                self._words.clear()
+            width = self.text_width(word + " ")
+            self._words[word] = width
+        return width
+
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def get_metrics(font):
+    """Get the shared FontMetrics index for a font face."""
+    key = (getattr(font, 'path', None), getattr(font, 'size', None), id(font))
+    metrics = _metrics.get(key)
+    if metrics is None:
+        with _metrics_lock:
+            metrics = _metrics.get(key)
+            if metrics is None:
+                metrics = FontMetrics(font)
+                _metrics[key] = metrics
+    return metrics
@@ -1,38 +1,57 @@
-from PIL import Image, ImageDraw, ImageFont, ImageFilter
-import io
-import os
+from PIL import Image, ImageFilter
 import numpy as np
-from .utils import prepare_text_layout
+from .utils import prepare_text_layout, render_text_mask, colorize_mask, alpha_composite, blur_margin
+from .metrics import get_metrics
+from .formats import encode_image
 
-def generate_neon_text(text):
+GLOW_COLOR = (0, 255, 255, 50)  # Cyan glow
+GLOW_RADIUS = 2
+GLOW_LAYERS = 3
+
+def glow_radii(radius=GLOW_RADIUS, layers=GLOW_LAYERS):
+    """Blur radii of the glow layers, from radius down to a sharp layer."""
+    if layers < 1:
+        raise ValueError("layers must be at least 1")
+    if layers == 1:
+        return [radius]
+    return [radius * (layers - 1 - j) / (layers - 1) for j in range(layers)]
+
+def generate_neon_text(text, glow_color=GLOW_COLOR, radius=GLOW_RADIUS, layers=GLOW_LAYERS,
+                       encoding=None):
     """
     Generate text with a neon glow effect on transparent background.
-    Returns a BytesIO object containing the PNG image.
+    glow_color is an (r, g, b, a) tuple; the glow is built from layers
+    blurs whose radii run from radius down to the sharp text.
+    Returns a BytesIO object containing the PNG (or encoding's) image.
     """
+    radii = glow_radii(radius, layers)
+
     # Get text layout information
     lines, width, height, font, line_height = prepare_text_layout(text)
-    
+
     # Create base image with some padding for glow
-    base = Image.new('RGBA', (width, height), (0, 0, 0, 0))
-    draw = ImageDraw.Draw(base)
-    
-    # Draw the glow layers for each line
-    glow_color = (0, 255, 255, 50)  # Cyan glow
+    base = np.zeros((height, width, 4), dtype=np.uint8)
+
+    # Blur only the box around each line's ink; a blur never reaches further
+    # than the margin, so the result matches blurring the whole canvas
+    margin = blur_margin(max(radii))
+    metrics = get_metrics(font)
     for i, line in enumerate(lines):
         y = i * line_height
-        for j in range(3):
-            glow = Image.new('RGBA', (width, height), (0, 0, 0, 0))
-            glow_draw = ImageDraw.Draw(glow)
-            glow_draw.text((0, y), line, font=font, fill=glow_color)
-            glow = glow.filter(ImageFilter.GaussianBlur(radius=2-j))
-            base = Image.alpha_composite(base, glow)
-        
-        # Draw the main text for this line
-        draw.text((0, y), line, font=font, fill=(0, 255, 255, 255))  # Bright cyan
-    
-    # Save to BytesIO
-    img_io = io.BytesIO()
-    base.save(img_io, format='PNG')
-    img_io.seek(0)
-    
-    return img_io 
\ No newline at end of file
+        left, top, right, bottom = metrics.text_bbox(line)
+        x0 = max(0, left - margin)
+        y0 = max(0, y + top - margin)
+        x1 = min(width, right + margin)
+        y1 = min(height, y + bottom + margin)
+        if x0 >= x1 or y0 >= y1:
+            continue
+
+        # Every glow layer starts from the same colorized line
+        line_mask = render_text_mask([line], x1 - x0, y1 - y0, font, line_height, (-x0, y - y0))
+        glow_layer = Image.fromarray(colorize_mask(line_mask, glow_color[:3], glow_color[3]))
+        region = base[y0:y1, x0:x1]
+        for glow_radius in radii:
+            glow = glow_layer.filter(ImageFilter.GaussianBlur(radius=glow_radius))
+            alpha_composite(region, np.asarray(glow))
+
+    return encode_image(base, encoding)
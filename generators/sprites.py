@@ -0,0 +1,132 @@
+"""
+Frame output of animations for clients that animate them themselves (CSS
+steps() or a canvas).
+
+A sprite sheet packs every frame into one PNG or WebP image, and a raw
+frame stream is the RGBA frames back to back. Both are described by a
+small manifest (frame size, count and duration) and skip the GIF's palette
+quantization and LZW encoding entirely. Raw frames are not encoded at all;
+PNG sheets are written here a row of frames at a time, so both stream as
+the frames are rendered.
+"""
+import math
+import struct
+import zlib
+import numpy as np
+from .formats import encode_image, DEFAULT_OPTIONS, MAX_EFFORT
+from .instrumentation import stage
+
+# Longest side of a sprite sheet (the largest WebP image)
+MAX_SHEET_SIDE = 16383
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# PNG filter type of every row: each byte minus the one a pixel to its left
+FILTER_SUB = 1
+
+
+def sheet_grid(width, height, num_frames):
+    """
+    Columns and rows of a sprite sheet of num_frames width x height frames.
+    Frames fill the sheet row by row, in a single column unless the sheet
+    would be taller than MAX_SHEET_SIDE.
+    """
+    per_column = max(1, MAX_SHEET_SIDE // max(1, height))
+    columns = math.ceil(num_frames / per_column)
+    rows = math.ceil(num_frames / columns)
+    if columns * width > MAX_SHEET_SIDE or height > MAX_SHEET_SIDE:
+        raise ValueError(f'Sprite sheet would be larger than {MAX_SHEET_SIDE} pixels, '
+                         f'use shorter text, fewer frames or rgba')
+    return columns, rows
+
+
+def frame_manifest(image_format, width, height, num_frames, duration):
+    """
+    Manifest of frame output: frame size, frame count and milliseconds per
+    frame, plus the grid of a sprite sheet. Frame i of a sheet is at column
+    i % columns, row i // columns.
+    """
+    manifest = {'format': image_format, 'width': width, 'height': height,
+                'frames': num_frames, 'duration': duration}
+    if image_format != 'rgba':
+        manifest['columns'], manifest['rows'] = sheet_grid(width, height, num_frames)
+    return manifest
+
+
+def iter_sheet_rows(frames, num_frames):
+    """
+    Yield (columns, rows, band) for every row of a sprite sheet of frames,
+    where band is a (height, columns * width, 4) uint8 array of the row's
+    frames, transparent where the last row has none. The band is reused.
+    """
+    band = None
+    filled = 0
+    for frame in frames:
+        height, width = frame.shape[:2]
+        if band is None:
+            columns, rows = sheet_grid(width, height, num_frames)
+            band = np.empty((height, columns * width, 4), dtype=np.uint8)
+        band[:, filled * width:(filled + 1) * width] = frame
+        filled += 1
+        if filled == columns:
+            yield columns, rows, band
+            filled = 0
+    if filled:
+        band[:, filled * width:] = 0
+        yield columns, rows, band
+
+
+def _png_chunk(kind, data):
+    return (struct.pack('>I', len(data)) + kind + data
+            + struct.pack('>I', zlib.crc32(data, zlib.crc32(kind))))
+
+
+def iter_png_sheet(frames, num_frames, effort=DEFAULT_OPTIONS['effort']):
+    """
+    Stream a PNG sprite sheet of RGBA frames, yielding each row of frames
+    as soon as it is compressed. Pixels are Sub filtered and compressed
+    with run-length matching, which suits the long runs of transparent and
+    solid pixels of a sheet and is several times faster than Pillow's PNG
+    encoder. Effort above the default switches to full deflate matching
+    for a somewhat smaller sheet.
+    """
+    level = round(effort * 9 / MAX_EFFORT)
+    strategy = zlib.Z_RLE if effort <= DEFAULT_OPTIONS['effort'] else zlib.Z_DEFAULT_STRATEGY
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS, 9, strategy)
+    head = b''
+    filtered = None
+    for columns, rows, band in iter_sheet_rows(frames, num_frames):
+        with stage('encode'):
+            height, width = band.shape[:2]
+            if filtered is None:
+                header = struct.pack('>IIBBBBB', width, height * rows, 8, 6, 0, 0, 0)
+                head = PNG_SIGNATURE + _png_chunk(b'IHDR', header)
+                # Every line starts with its filter type
+                filtered = np.empty((height, 1 + width * 4), dtype=np.uint8)
+                filtered[:, 0] = FILTER_SUB
+            pixels = band.reshape(height, width * 4)
+            filtered[:, 1:5] = pixels[:, :4]
+            np.subtract(pixels[:, 4:], pixels[:, :-4], out=filtered[:, 5:])
+            data = compressor.compress(filtered)
+        if data:
+            yield head + _png_chunk(b'IDAT', data)
+            head = b''
+    with stage('encode'):
+        tail = _png_chunk(b'IDAT', compressor.flush()) + _png_chunk(b'IEND', b'')
+    yield head + tail
+
+
+def iter_frame_output(frames, num_frames, encoding):
+    """
+    Encode (height, width, 4) uint8 RGBA frames in encoding's frame format.
+    Raw frames and PNG sheets stream as the frames arrive; a WebP sheet is
+    yielded in one piece once every frame is in place.
+    """
+    if encoding['format'] == 'rgba':
+        for frame in frames:
+            yield np.ascontiguousarray(frame).tobytes()
+    elif encoding['format'] == 'sprite-png':
+        yield from iter_png_sheet(frames, num_frames, encoding['effort'])
+    else:
+        sheet = np.concatenate([band.copy() for _, _, band in iter_sheet_rows(frames, num_frames)])
+        yield encode_image(sheet, encoding).getvalue()
@@ -0,0 +1,66 @@
+"""
+Startup timing.
+
+Records how long a server process took to become ready (loading the app,
+its fonts and warmup renders, and booting a forked worker) and how long
+its first request took. Unlike render metrics, phases timed in the master
+before it forks are kept by the workers, so each one reports the whole
+path to its first request.
+"""
+from contextlib import contextmanager
+import os
+import threading
+import time
+
+
+class StartupTimer:
+    """Seconds per startup phase, in the order they ran, and of the first request."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.phases = {}
+        self.first_request = None
+
+    @contextmanager
+    def phase(self, name):
+        """Time the enclosed block as phase name."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def record(self, name, seconds):
+        """Add seconds to phase name."""
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def request_done(self, seconds):
+        """Record a request; returns True when it was the first one of the process."""
+        with self._lock:
+            if self.first_request is not None:
+                return False
+            self.first_request = seconds
+            return True
+
+    def stats(self):
+        """Phase and first request times in seconds, and their total until ready."""
+        with self._lock:
+            return {
+                'phases': {name: round(seconds, 4) for name, seconds in self.phases.items()},
+                'ready_seconds': round(sum(self.phases.values()), 4),
+                'first_request_seconds': (None if self.first_request is None
+                                          else round(self.first_request, 4))
+            }
+
+    def _after_fork(self):
+        # The master's phases are part of the worker's startup; its first
+        # request is not
+        self._lock = threading.Lock()
+        self.first_request = None
+
+
+startup_timer = StartupTimer()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=startup_timer._after_fork)
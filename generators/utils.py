@@ -1,37 +1,44 @@
-from PIL import Image, ImageDraw, ImageFont
-import os
+from PIL import Image, ImageDraw
+from collections import OrderedDict
+import functools
+import math
+import threading
+import numpy as np
+from .fonts import font_registry
+from .metrics import get_metrics
+from .instrumentation import timed
+
+# Upper bound for frames colorized in a single pass (bytes)
+FRAME_CHUNK_BYTES = 16 * 1024 * 1024
+
+# Rows of a color field computed per pass, bounding its float temporaries
+FIELD_ROWS = 64
+
+# Canvas rows effects render at once, so their temporaries are bounded
+# by the canvas width rather than by how long the text is
+STRIP_ROWS = 128
+
+# Budget for color fields kept per canvas size (bytes)
+FIELD_CACHE_BYTES = 32 * 1024 * 1024
+
+# Text layouts kept per process (the same text is often rendered with
+# several effects)
+LAYOUT_CACHE_SIZE = 256
 
 def get_font(base_size=14):
-    """Get the font with specified base size."""
-    try:
-        font_paths = [
-            "C:\\Windows\\Fonts\\arial.ttf",
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
-            "/System/Library/Fonts/Helvetica.ttc"
-        ]
-        font = None
-        for path in font_paths:
-            if os.path.exists(path):
-                font = ImageFont.truetype(path, base_size)
-                break
-        if font is None:
-            font = ImageFont.load_default()
-    except Exception:
-        font = ImageFont.load_default()
-    return font
+    """Get the font with specified base size from the shared font registry."""
+    return font_registry.get(base_size)
 
 def calculate_text_dimensions(text, font):
-    """Calculate text dimensions using a temporary image."""
-    temp_img = Image.new('RGBA', (1, 1), (0, 0, 0, 0))
-    temp_draw = ImageDraw.Draw(temp_img)
-    text_bbox = temp_draw.textbbox((0, 0), text, font=font)
-    return text_bbox[2] - text_bbox[0], text_bbox[3] - text_bbox[1]
+    """Calculate text dimensions from the font's cached glyph metrics."""
+    return get_metrics(font).text_size(text)
 
 def smart_text_wrap(text, target_width, font):
     """
     Wrap text to fit within target_width, breaking at word boundaries.
     Now uses a more natural approach to line breaks.
     """
+    metrics = get_metrics(font)
     words = text.split()
     lines = []
     current_line = []
@@ -39,7 +46,7 @@ def smart_text_wrap(text, target_width, font):
 
     for word in words:
         # Calculate width with space
-        word_width, _ = calculate_text_dimensions(word + " ", font)
+        word_width = metrics.word_width(word)
         
         if current_line and current_width + word_width > target_width:
             # Line would be too long, start a new line
@@ -57,10 +64,10 @@ def smart_text_wrap(text, target_width, font):
     
     return lines
 
-def get_dynamic_dimensions(text):
+def _target_dimensions(text):
     """
-    Calculate dynamic dimensions based on text length.
-    Returns (target_width, height, font_size)
+    Pick the font size and wrap width for text.
+    Returns (target_width, font_size, font)
     """
     text_length = len(text)
     
@@ -74,18 +81,24 @@ def get_dynamic_dimensions(text):
     
     font = get_font(font_size)
     
-    # First calculate the full text width
-    full_width, _ = calculate_text_dimensions(text, font)
-    
     # Set maximum width based on text length
     if text_length > 500:
         target_width = 800
     elif text_length > 200:
         target_width = 600
-    elif full_width > 400:
-        target_width = 400
     else:
-        target_width = full_width
+        # Only short texts need the full text width
+        full_width, _ = calculate_text_dimensions(text, font)
+        target_width = min(full_width, 400)
+    
+    return target_width, font_size, font
+
+def get_dynamic_dimensions(text):
+    """
+    Calculate dynamic dimensions based on text length.
+    Returns (target_width, height, font_size)
+    """
+    target_width, font_size, font = _target_dimensions(text)
     
     # Calculate number of lines needed
     temp_lines = smart_text_wrap(text, target_width, font)
@@ -101,14 +114,22 @@ def get_dynamic_dimensions(text):
     
     return target_width, height, font_size
 
+@timed('layout')
 def prepare_text_layout(text):
     """
     Prepare text layout with dynamic sizing and wrapping.
     Returns (wrapped_lines, width, height, font, line_height)
     """
-    # Get initial dimensions
-    target_width, height, font_size = get_dynamic_dimensions(text)
-    font = get_font(font_size)
+    lines, width, height, font, line_height = _cached_layout(text)
+    return list(lines), width, height, font, line_height
+
+@functools.lru_cache(maxsize=LAYOUT_CACHE_SIZE)
+def _cached_layout(text):
+    # Get initial dimensions (the height estimate of get_dynamic_dimensions
+    # is not needed here, so the text is only wrapped once)
+    target_width, _, font = _target_dimensions(text)
+    target_width = max(target_width, 100)
+    metrics = get_metrics(font)
     
     # Wrap text
     lines = smart_text_wrap(text, target_width, font)
@@ -116,17 +137,229 @@ def prepare_text_layout(text):
     # Calculate actual width needed
     max_line_width = 0
     for line in lines:
-        line_width, _ = calculate_text_dimensions(line, font)
-        max_line_width = max(max_line_width, line_width)
+        max_line_width = max(max_line_width, metrics.text_width(line))
     
     # Add padding to width
     width = max_line_width + 20  # Add some horizontal padding
     
     # Calculate proper line height with padding
-    _, single_line_height = calculate_text_dimensions("Ay", font)  # Use "Ay" to get proper height with ascenders/descenders
-    line_height = int(single_line_height * 1.5)  # 1.5x line spacing
+    # ("Ay" gives the proper height with ascenders/descenders)
+    line_height = int(metrics.line_height * 1.5)  # 1.5x line spacing
     
     # Recalculate total height with proper spacing
     total_height = (line_height * len(lines)) + 20  # Add padding at top and bottom
     
-    return lines, width, total_height, font, line_height 
\ No newline at end of file
+    return tuple(lines), width, total_height, font, line_height
+
+def blur_margin(radius):
+    """Pixels a GaussianBlur of radius can spread ink beyond its source."""
+    # Pillow approximates the Gaussian with three extended box blurs
+    return 3 * (math.ceil(radius) + 1)
+
+def row_strips(height, rows=STRIP_ROWS):
+    """(top, bottom) of the horizontal strips of rows that cover height rows."""
+    return [(top, min(top + rows, height)) for top in range(0, height, rows)]
+
+@timed('rasterize')
+def render_text_mask(lines, width, height, font, line_height, origin=(0, 0), rows=None):
+    """
+    Rasterize the text lines once as an 8-bit alpha mask.
+    With rows=(top, bottom), only those rows of the canvas are rasterized,
+    drawing just the lines whose ink reaches them.
+    Returns a (height, width) uint8 array, or (bottom - top, width).
+    """
+    top, bottom = rows or (0, height)
+    mask = Image.new('L', (width, bottom - top), 0)
+    draw = ImageDraw.Draw(mask)
+    metrics = get_metrics(font)
+    x, y = origin
+    for i, line in enumerate(lines):
+        line_y = y + i * line_height
+        if rows is not None:
+            _, ink_top, _, ink_bottom = metrics.text_bbox(line)
+            if line_y + ink_bottom <= top or line_y + ink_top >= bottom:
+                continue
+        draw.text((x, line_y - top), line, fill=255, font=font)
+    return np.array(mask)
+
+def sine_gradient_colors(width, phase=0.0):
+    """
+    Colors of the scrolling RGB sine gradient, one per column.
+    Returns a (width, 3) uint8 array.
+    """
+    x = np.linspace(0, 2*np.pi, width) + phase
+    colors = np.empty((width, 3), dtype=np.uint8)
+    # Assigning floats into uint8 truncates, like the per-pixel writes did
+    colors[:, 0] = np.sin(x) * 127 + 128
+    colors[:, 1] = np.sin(x + 2*np.pi/3) * 127 + 128
+    colors[:, 2] = np.sin(x + 4*np.pi/3) * 127 + 128
+    return colors
+
+def sine_gradient_frames(width, num_frames):
+    """
+    Gradient colors for every frame of the scrolling animation, each frame
+    shifted by an equal phase step.
+    Returns a (num_frames, width, 3) uint8 array.
+    """
+    phase = 2 * np.pi * np.arange(num_frames) / num_frames
+    x = np.linspace(0, 2*np.pi, width) + phase[:, None]
+    colors = np.empty((num_frames, width, 3), dtype=np.uint8)
+    colors[..., 0] = np.sin(x) * 127 + 128
+    colors[..., 1] = np.sin(x + 2*np.pi/3) * 127 + 128
+    colors[..., 2] = np.sin(x + 4*np.pi/3) * 127 + 128
+    return colors
+
+def sine_gradient_palette(size=255):
+    """
+    Sine gradient colors at size evenly spaced phases, usable as a global
+    palette for any frame of the scrolling animation.
+    Returns a (size, 3) uint8 array.
+    """
+    x = 2 * np.pi * np.arange(size) / size
+    palette = np.empty((size, 3), dtype=np.uint8)
+    palette[:, 0] = np.sin(x) * 127 + 128
+    palette[:, 1] = np.sin(x + 2*np.pi/3) * 127 + 128
+    palette[:, 2] = np.sin(x + 4*np.pi/3) * 127 + 128
+    return palette
+
+def sine_gradient_frame_indices(width, num_frames, size=255):
+    """
+    Index into sine_gradient_palette(size) of every column in every frame,
+    mapped directly from the gradient phase.
+    Returns a (num_frames, width) uint8 array.
+    """
+    phase = 2 * np.pi * np.arange(num_frames) / num_frames
+    x = np.linspace(0, 2*np.pi, width) + phase[:, None]
+    return (np.rint(x * (size / (2*np.pi))).astype(np.int64) % size).astype(np.uint8)
+
+def rainbow_hue_factors(width):
+    """
+    Per-column HSV factors of the horizontal rainbow.
+    Each channel is chroma times one of (1, x, 0) depending on the hue
+    region, so returns a (width, 3) float64 array of those multipliers.
+    """
+    hue = (np.arange(width) * 0.02) % 1.0
+    x = 1 - np.abs((hue * 6) % 2 - 1)
+    region = np.searchsorted([1/6, 2/6, 3/6, 4/6, 5/6], hue, side='right')
+    ones = np.ones_like(hue)
+    zeros = np.zeros_like(hue)
+    table = np.array([
+        [ones, x, zeros],   # red -> yellow
+        [x, ones, zeros],   # yellow -> green
+        [zeros, ones, x],   # green -> cyan
+        [zeros, x, ones],   # cyan -> blue
+        [x, zeros, ones],   # blue -> magenta
+        [ones, zeros, x]    # magenta -> red
+    ])
+    return table[region, :, np.arange(width)]
+
+def rainbow_wave_colors(width, height):
+    """
+    Colors of the rainbow wave pattern for every pixel.
+    Returns a (height, width, 3) uint8 array.
+    """
+    x = np.arange(width)
+    factors = rainbow_hue_factors(width)
+    colors = np.empty((height, width, 3), dtype=np.uint8)
+    for top in range(0, height, FIELD_ROWS):
+        y = np.arange(top, min(top + FIELD_ROWS, height))[:, None]
+        # Wave brightness is the HSV chroma
+        chroma = np.sin(x * 0.1 + y * 0.2) * 0.5 + 0.5
+        for c in range(3):
+            colors[top:top + len(y), :, c] = (chroma * factors[:, c]) * 255
+    return colors
+
+_fields = OrderedDict()
+_fields_size = 0
+_fields_lock = threading.Lock()
+
+def cached_field(name, width, height, build):
+    """
+    Get a color field that only depends on the canvas size, calling
+    build(width, height) on a miss. Fields are kept in an LRU bounded by
+    FIELD_CACHE_BYTES and returned read-only.
+    """
+    global _fields_size
+    key = (name, width, height)
+    with _fields_lock:
+        field = _fields.get(key)
+        if field is not None:
+            _fields.move_to_end(key)
+            return field
+
+    field = build(width, height)
+    field.flags.writeable = False
+    with _fields_lock:
+        if key not in _fields and field.nbytes <= FIELD_CACHE_BYTES:
+            _fields[key] = field
+            _fields_size += field.nbytes
+            while _fields_size > FIELD_CACHE_BYTES:
+                _, evicted = _fields.popitem(last=False)
+                _fields_size -= evicted.nbytes
+    return field
+
+def colorize_mask(mask, colors, alpha=255, out=None):
+    """
+    Colorize an 8-bit text mask into an RGBA array.
+    colors broadcasts against (height, width, 3): a (3,) solid color, a
+    (width, 3) color per column or a (height, width, 3) color per pixel.
+    alpha scales the mask the way Pillow draws a translucent fill.
+    Returns a (height, width, 4) uint8 array (out when given), transparent
+    black off the text.
+    """
+    height, width = mask.shape
+    rgba = np.empty((height, width, 4), dtype=np.uint8) if out is None else out
+    ink = (mask > 0)[..., None]
+    np.multiply(ink, colors, out=rgba[..., :3], casting='unsafe')
+    if alpha == 255:
+        rgba[..., 3] = mask
+    else:
+        # Pillow's MULDIV255 rounding
+        scaled = mask.astype(np.uint16) * alpha + 128
+        rgba[..., 3] = (scaled + (scaled >> 8)) >> 8
+    return rgba
+
+def colorize_mask_frames(mask, frame_colors, max_chunk_bytes=FRAME_CHUNK_BYTES):
+    """
+    Colorize one text mask with a (num_frames, width, 3) per-frame column
+    color table. Frames are produced in chunks of one broadcast each, so
+    memory stays bounded by max_chunk_bytes however many frames there are.
+    Yields (height, width, 4) uint8 arrays; each is only valid until the
+    next one is requested.
+    """
+    height, width = mask.shape
+    num_frames = len(frame_colors)
+    chunk = max(1, min(num_frames, max_chunk_bytes // max(1, height * width * 4)))
+    buffer = np.empty((chunk, height, width, 4), dtype=np.uint8)
+    # Alpha and ink coverage are the same for every frame
+    buffer[..., 3] = mask
+    ink = (mask > 0)[None, :, :, None]
+    for start in range(0, num_frames, chunk):
+        count = min(chunk, num_frames - start)
+        frames = buffer[:count]
+        np.multiply(ink, frame_colors[start:start + count, None], out=frames[..., :3], casting='unsafe')
+        for frame in frames:
+            yield frame
+
+def alpha_composite(dst, src):
+    """
+    Composite an RGBA uint8 array over dst in place, with the same integer
+    rounding as Image.alpha_composite. dst and src have the same shape, so a
+    layer can be composited onto just the region of dst it covers.
+    """
+    src_a = src[..., 3].astype(np.uint32)
+    dst_a = dst[..., 3].astype(np.uint32)
+    drawn = src_a > 0
+    if not drawn.any():
+        return dst
+    # Pillow's 7 bit fixed point blend
+    out_a255 = src_a * 255 + dst_a * (255 - src_a)
+    coef1 = (src_a * (255 * 255 << 7)) // np.maximum(out_a255, 1)
+    coef2 = (255 << 7) - coef1
+    for c in range(3):
+        blended = src[..., c] * coef1 + dst[..., c] * coef2 + (0x80 << 7)
+        blended = (((blended >> 8) + blended) >> 8) >> 7
+        np.copyto(dst[..., c], blended, where=drawn, casting='unsafe')
+    out_a = out_a255 + 0x80
+    np.copyto(dst[..., 3], ((out_a >> 8) + out_a) >> 8, where=drawn, casting='unsafe')
+    return dst
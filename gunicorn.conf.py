@@ -0,0 +1,65 @@
+"""
+gunicorn configuration, read from the working directory:
+
+    gunicorn app:app
+
+The app is loaded, its fonts parsed and the warmup renders run once in the
+master (see app.warm_up()), before it forks the workers. Workers inherit
+the warm fonts, layout caches and NumPy and Pillow code paths instead of
+paying for them on their first request, and so do workers started later by
+a restart or scale-up. Each worker starts its render processes before it
+takes requests. Startup phases and the first request of every worker are
+logged, and reported on /api/v1/stats and /metrics.
+"""
+import os
+import time
+
+from generators.executor import render_executor
+from generators.startup import startup_timer
+
+_loading = time.perf_counter()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 1754)}"
+preload_app = True
+
+# Every worker runs its own render processes, so one worker already keeps
+# all cores busy; its threads wait on renders and serve cache hits
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+worker_class = 'gthread'
+threads = render_executor.workers + render_executor.max_queue + 4
+
+
+def on_starting(server):
+    # The app was imported since this file was read
+    startup_timer.record('load', time.perf_counter() - _loading)
+
+
+def when_ready(server):
+    from app import warm_up
+    renders = warm_up()
+    phases = startup_timer.stats()['phases']
+    server.log.info('Loaded in %.2fs, fonts in %.2fs, %d warmup renders in %.2fs',
+                    phases.get('load', 0), phases['fonts'], renders, phases.get('warmup', 0))
+
+
+def post_fork(server, worker):
+    worker.textfx_forked = time.perf_counter()
+
+
+def post_worker_init(worker):
+    render_executor.start()
+    startup_timer.record('boot', time.perf_counter() - worker.textfx_forked)
+    worker.log.info('Worker %s ready in %.3fs (%.2fs since the master started loading)',
+                    worker.pid, startup_timer.phases['boot'], startup_timer.stats()['ready_seconds'])
+
+
+def pre_request(worker, req):
+    if startup_timer.first_request is None:
+        req.textfx_started = time.perf_counter()
+
+
+def post_request(worker, req, environ, resp):
+    started = getattr(req, 'textfx_started', None)
+    if started is not None and startup_timer.request_done(time.perf_counter() - started):
+        worker.log.info('Worker %s served its first request (%s) in %.3fs',
+                        worker.pid, req.path, startup_timer.first_request)
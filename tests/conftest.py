@@ -0,0 +1,17 @@
+import os
+import sys
+
+# Render in the test process and skip the startup warmup
+os.environ.setdefault('TEXTFX_WORKERS', '0')
+os.environ.setdefault('TEXTFX_WARMUP', '0')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from app import app as flask_app
+
+
+@pytest.fixture
+def client():
+    return flask_app.test_client()
@@ -0,0 +1,69 @@
+import io
+
+import pytest
+from PIL import Image
+
+import app as app_module
+from generators import admission
+from generators.glitch_text import GLITCH_FRAMES, FRAME_DURATION
+
+
+@pytest.fixture
+def under_load(monkeypatch):
+    """Every render waits a second for a worker, over a half second budget."""
+    monkeypatch.setattr(admission, 'LATENCY_BUDGET', 0.5)
+    monkeypatch.setattr(app_module.render_executor, 'queue_wait', lambda: 1.0)
+
+
+@pytest.mark.parametrize('path', ['/api/v1/neon', '/api/v1/glitch.gif'])
+def test_text_above_the_limit_is_refused(client, monkeypatch, path):
+    monkeypatch.setattr(admission, 'MAX_TEXT_CHARS', 10)
+    response = client.get(path, query_string={'text': 'x' * 11})
+    assert response.status_code == 413
+    assert response.json == {'error': "'text' is limited to 10 characters"}
+    assert client.get(path, query_string={'text': 'y' * 10}).status_code == 200
+
+
+@pytest.mark.parametrize('path', ['/api/v1/neon', '/api/v1/glitch.gif'])
+def test_cost_above_the_limit_is_refused(client, monkeypatch, path):
+    # Cheaper than any render: every estimate is above it
+    monkeypatch.setattr(admission, 'MAX_RENDER_COST', admission.BASE_COST / 2)
+    response = client.get(path, query_string={'text': 'too costly'})
+    assert response.status_code == 413
+    assert 'exceeds the 0.001s limit' in response.json['error']
+    assert 'ETag' not in response.headers
+
+
+def test_degraded_render_is_marked_and_cached_briefly(client, under_load):
+    response = client.get('/api/v1/neon', query_string={'text': 'degraded neon'})
+    assert response.status_code == 200
+    assert response.headers['X-TextFX-Quality'] == 'degraded; layers=1'
+    assert response.headers['Cache-Control'] == f'public, max-age={app_module.DEGRADED_MAX_AGE}'
+
+
+def test_degraded_animation_keeps_its_length(client, under_load):
+    response = client.get('/api/v1/glitch.gif', query_string={'text': 'degraded glitch'})
+    assert response.status_code == 200
+    frames = GLITCH_FRAMES // 2
+    assert response.headers['X-TextFX-Quality'] == (
+        f'degraded; bloom=0; colors=64; duration={FRAME_DURATION * 2}; num_frames={frames}')
+    assert 'immutable' not in response.headers['Cache-Control']
+    im = Image.open(io.BytesIO(response.data))
+    durations = []
+    for i in range(im.n_frames):
+        im.seek(i)
+        durations.append(im.info['duration'])
+    assert sum(durations) == GLITCH_FRAMES * FRAME_DURATION
+
+
+def test_full_quality_once_load_drops(client, monkeypatch):
+    with monkeypatch.context() as load:
+        load.setattr(admission, 'LATENCY_BUDGET', 0.5)
+        load.setattr(app_module.render_executor, 'queue_wait', lambda: 1.0)
+        degraded = client.get('/api/v1/neon', query_string={'text': 'load drops'})
+    response = client.get('/api/v1/neon', query_string={'text': 'load drops'})
+    assert response.status_code == 200
+    assert 'X-TextFX-Quality' not in response.headers
+    assert response.headers['Cache-Control'].endswith(', immutable')
+    assert response.headers['ETag'] != degraded.headers['ETag']
+    assert response.data != degraded.data
@@ -0,0 +1,54 @@
+import io
+import json
+import zipfile
+
+
+def read_zip(response):
+    archive = zipfile.ZipFile(io.BytesIO(response.data))
+    return archive, json.loads(archive.read('manifest.json'))['items']
+
+
+def test_malformed_items_fail_alone(client):
+    response = client.post('/api/v1/batch', json=[
+        {'effect': ['neon']},
+        {'effect': {'name': 'neon'}},
+        {'effect': 'neon', 'params': ['radius']},
+        {'effect': 'sparkle'},
+        {'effect': 'neon', 'text': 'fine'},
+        {'effect': 'gradient', 'text': 'also fine'},
+    ])
+    assert response.status_code == 200
+    archive, items = read_zip(response)
+    assert [item.get('error') for item in items] == [
+        "'effect' must be a string",
+        "'effect' must be a string",
+        "'params' must be an object",
+        "Unknown effect 'sparkle'",
+        None,
+        None,
+    ]
+    for item in items[4:]:
+        assert archive.read(item['file']).startswith(b'\x89PNG')
+
+
+def test_non_list_body_is_rejected(client):
+    response = client.post('/api/v1/batch', json={'effect': 'neon'})
+    assert response.status_code == 400
+
+
+def test_integer_params_are_not_coerced(client):
+    response = client.post('/api/v1/batch', json=[
+        {'effect': 'neon', 'params': {'radius': 2.9}},
+        {'effect': 'neon', 'params': {'radius': True}},
+        {'effect': 'neon', 'params': {'radius': '2'}},
+        {'effect': 'neon', 'params': {'radius': 2}},
+    ])
+    assert response.status_code == 200
+    archive, items = read_zip(response)
+    assert [item.get('error') for item in items] == [
+        "'radius' must be an integer",
+        "'radius' must be an integer",
+        None,
+        None,
+    ]
+    assert client.get('/api/v1/neon?text=hi&radius=2.9').status_code == 400
@@ -0,0 +1,35 @@
+import json
+import os
+
+import bulk_render
+
+
+def test_malformed_lines_are_reported_and_skipped(tmp_path, capsys):
+    lines = [
+        json.dumps({'effect': ['neon'], 'text': 'bad'}),
+        json.dumps({'effect': 'neon', 'params': ['radius']}),
+        'not json',
+        json.dumps({'effect': 'neon', 'text': 'good', 'name': 'good.png'}),
+        json.dumps({'effect': 'neon', 'text': 'good', 'name': 'good.png'}),
+    ]
+    progress = bulk_render.run(lines, str(tmp_path), workers=1, quiet=True)
+    assert (progress.rendered, progress.skipped, progress.failed) == (1, 1, 3)
+    assert os.path.exists(tmp_path / 'good.png')
+    errors = capsys.readouterr().err
+    assert "line 1: 'effect' must be a string" in errors
+    assert "line 2: 'params' must be an object" in errors
+
+
+def test_conflicting_names_settle(tmp_path, capsys):
+    lines = [
+        json.dumps({'text': 'first', 'name': 'a.png'}),
+        json.dumps({'text': 'second', 'name': 'a.png'}),
+    ]
+    progress = bulk_render.run(lines, str(tmp_path), workers=1, quiet=True)
+    assert (progress.rendered, progress.skipped, progress.failed) == (1, 0, 1)
+    assert "line 2: duplicate name 'a.png' with different content" in capsys.readouterr().err
+    data = (tmp_path / 'a.png').read_bytes()
+
+    progress = bulk_render.run(lines, str(tmp_path), workers=1, quiet=True)
+    assert (progress.rendered, progress.skipped, progress.failed) == (0, 1, 1)
+    assert (tmp_path / 'a.png').read_bytes() == data
@@ -0,0 +1,120 @@
+import hashlib
+import os
+import subprocess
+import sys
+
+import pytest
+
+from generators import cache
+from generators.cache import RenderCache, make_key
+from generators.glitch_text import generate_glitch_text
+
+PARAMS = {'glow_color': (0, 255, 255, 255), 'radius': 4, 'layers': 3}
+
+# Every query parameter of every image route, with a value other than its
+# default: each must give the image its own ETag
+ROUTE_PARAMS = [
+    ('/api/v1/gradient-text', {}, [('format', 'webp')]),
+    ('/api/v1/gradient-text', {'format': 'webp'},
+     [('quality', '50'), ('lossless', 'false'), ('effort', '1')]),
+    ('/api/v1/neon', {}, [('color', 'ff00ff'), ('color', 'ff00ff80'), ('radius', '5'),
+                          ('layers', '1'), ('format', 'webp')]),
+    ('/api/v1/rainbow-wave', {}, [('format', 'webp')]),
+    ('/api/v1/gradient-text.gif', {}, [('frames', '10'), ('duration', '100'),
+                                       ('format', 'webp'), ('format', 'apng'),
+                                       ('format', 'sprite-png'), ('format', 'rgba')]),
+    ('/api/v1/gradient-text.gif', {'format': 'webp'},
+     [('quality', '50'), ('lossless', 'true'), ('effort', '1')]),
+    ('/api/v1/glitch.gif', {}, [('seed', '7'), ('format', 'webp'), ('format', 'sprite-webp')]),
+]
+
+
+def test_key_covers_version_effect_text_and_params(monkeypatch):
+    key = make_key('neon', 'Hello', PARAMS)
+    assert make_key('neon', 'Hello', dict(reversed(list(PARAMS.items())))) == key
+    others = [make_key('gradient', 'Hello', PARAMS), make_key('neon', 'Hello!', PARAMS),
+              make_key('neon', 'hello', PARAMS), make_key('neon', 'Hello')]
+    for name, value in [('glow_color', (0, 255, 255, 128)), ('radius', 5), ('layers', 2),
+                        ('encoding', {'format': 'webp'})]:
+        others.append(make_key('neon', 'Hello', dict(PARAMS, **{name: value})))
+    monkeypatch.setattr(cache, 'RENDERER_VERSION', cache.RENDERER_VERSION + '.1')
+    others.append(make_key('neon', 'Hello', PARAMS))
+    assert len({key, *others}) == len(others) + 1
+
+
+@pytest.mark.parametrize('path, query, changes', ROUTE_PARAMS)
+def test_every_query_parameter_changes_the_etag(client, path, query, changes):
+    def etag(**args):
+        response = client.get(path, query_string=dict(query, **dict({'text': 'Hi'}, **args)))
+        assert response.status_code == 200, response.data[:200]
+        return response.headers['ETag']
+
+    tags = [etag(), etag(text='Ho')] + [etag(**{name: value}) for name, value in changes]
+    assert len(set(tags)) == len(tags)
+
+
+def test_negotiated_format_changes_the_etag(client):
+    png = client.get('/api/v1/neon?text=Hi')
+    webp = client.get('/api/v1/neon?text=Hi', headers={'Accept': 'image/webp'})
+    assert webp.mimetype == 'image/webp'
+    assert png.headers['ETag'] != webp.headers['ETag']
+
+
+def test_memory_tier_evicts_least_recently_used():
+    render_cache = RenderCache(max_bytes=10)
+    render_cache.put('a', b'aaaa')
+    render_cache.put('b', b'bbbb')
+    assert render_cache.get('a') == b'aaaa'
+    render_cache.put('c', b'cccc')
+    assert render_cache.get('b') is None
+    assert render_cache.get('a') == b'aaaa' and render_cache.get('c') == b'cccc'
+    # Replacing an entry only counts its new size
+    render_cache.put('a', b'aa')
+    # Larger than the whole budget: never stored
+    render_cache.put('d', b'd' * 11)
+    assert render_cache.get('d') is None
+    stats = render_cache.stats()
+    assert (stats['entries'], stats['bytes'], stats['evictions']) == (2, 6, 1)
+
+
+def test_disk_tier_is_shared_between_instances(tmp_path):
+    writer = RenderCache(max_bytes=0, disk_dir=str(tmp_path))
+    key = make_key('neon', 'Hello', PARAMS)
+    writer.put(key, b'image')
+    assert writer.stats()['entries'] == 0
+
+    reader = RenderCache(disk_dir=str(tmp_path))
+    assert reader.get(key) == b'image'
+    assert reader.get(key) == b'image'
+    stats = reader.stats()
+    assert (stats['disk_hits'], stats['hits'], stats['misses']) == (1, 1, 0)
+    assert reader.get(make_key('neon', 'Hello')) is None
+
+
+def test_disk_tier_prunes_oldest_entries(tmp_path):
+    render_cache = RenderCache(max_bytes=0, disk_dir=str(tmp_path), disk_max_bytes=25)
+    keys = [make_key('neon', f'text {i}') for i in range(3)]
+    for age, key in enumerate(keys):
+        render_cache.put(key, b'x' * 10)
+        path = os.path.join(str(tmp_path), key[:2], key)
+        os.utime(path, (1000 + age, 1000 + age))
+    render_cache.prune_disk()
+    assert [render_cache.get(key) for key in keys] == [None, b'x' * 10, b'x' * 10]
+
+
+def test_glitch_output_is_deterministic():
+    data = generate_glitch_text('Hello, World!').getvalue()
+    assert generate_glitch_text('Hello, World!').getvalue() == data
+    assert generate_glitch_text('Hello, World!', seed=1).getvalue() != data
+    assert generate_glitch_text('Hello, World!', seed=1).getvalue() == \
+        generate_glitch_text('Hello, World!', seed=1).getvalue()
+    # Another process (another worker, or after a restart) renders the same
+    # bytes, so the disk tier and ETags stay valid across them
+    script = ('import hashlib, sys; from generators.glitch_text import generate_glitch_text; '
+              "sys.stdout.write(hashlib.sha256(generate_glitch_text('Hello, World!').getvalue())"
+              '.hexdigest())')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONHASHSEED='123')
+    digest = subprocess.run([sys.executable, '-c', script], cwd=root, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    assert digest == hashlib.sha256(data).hexdigest()
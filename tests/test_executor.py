@@ -0,0 +1,103 @@
+import threading
+import time
+
+import pytest
+
+import app as app_module
+from generators.executor import RenderExecutor, check_cancelled
+
+
+def stuck_render(text, **params):
+    # Never finishes on its own: only cancellation or the deadline stop it
+    while True:
+        check_cancelled()
+        time.sleep(0.01)
+
+
+def stuck_stream(text, **params):
+    yield b'GIF89a'
+    while True:
+        check_cancelled()
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def executor(monkeypatch):
+    """Swap in a real process pool of one worker and one queue slot."""
+    executors = []
+
+    def make(timeout):
+        executor = RenderExecutor(workers=1, max_queue=1, timeout=timeout)
+        monkeypatch.setattr(app_module, 'render_executor', executor)
+        executors.append(executor)
+        return executor
+
+    yield make
+    for executor in executors:
+        executor._discard_pool()
+
+
+def wait_until_idle(executor, seconds=5):
+    deadline = time.monotonic() + seconds
+    while executor.stats()['pending'] and time.monotonic() < deadline:
+        time.sleep(0.02)
+    return executor.stats()['pending'] == 0
+
+
+def test_full_queue_is_turned_away_and_timeouts_free_their_slots(client, monkeypatch, executor):
+    executor = executor(timeout=0.5)
+    monkeypatch.setattr(app_module, 'generate_neon_text', stuck_render)
+    responses = []
+
+    def request(i):
+        responses.append(client.get('/api/v1/neon', query_string={'text': f'stuck {i}'}))
+
+    # One render running and one queued fill every slot
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + 5
+    while executor.stats()['pending'] < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    busy = client.get('/api/v1/neon', query_string={'text': 'turned away'})
+    for thread in threads:
+        thread.join()
+
+    assert busy.status_code == 429
+    assert int(busy.headers['Retry-After']) >= 1
+    assert [response.status_code for response in responses] == [503, 503]
+    for response in responses:
+        assert int(response.headers['Retry-After']) >= 1
+        assert 'did not finish within 0.5 seconds' in response.json['error']
+
+    # The stuck renders stop at their deadline and give their slots back
+    assert wait_until_idle(executor)
+    stats = executor.stats()
+    assert (stats['completed'], stats['rejected'], stats['timeouts']) == (2, 1, 2)
+    assert client.get('/api/v1/gradient-text', query_string={'text': 'after'}).status_code == 200
+    assert wait_until_idle(executor)
+
+
+def test_closed_stream_cancels_its_render(client, monkeypatch, executor):
+    executor = executor(timeout=30)
+    monkeypatch.setattr(app_module, 'iter_glitch_text', stuck_stream)
+    response = client.get('/api/v1/glitch.gif', query_string={'text': 'abandoned'}, buffered=False)
+    assert response.status_code == 200
+    assert next(response.response).startswith(b'GIF89a')
+    assert executor.stats()['pending'] == 1
+    # The client going away stops the render long before its timeout
+    response.close()
+    assert wait_until_idle(executor)
+    assert executor.stats()['timeouts'] == 0
+
+
+def test_cancelled_render_frees_its_slot(executor):
+    executor = executor(timeout=30)
+    running = executor.submit(stuck_render, 'running', {})
+    queued = executor.submit(stuck_render, 'queued', {})
+    assert executor.stats()['pending'] == 2
+    executor.cancel(queued)
+    executor.cancel(running)
+    assert wait_until_idle(executor)
+    data, _ = executor.render(app_module.generate_gradient_text, 'free again', {})
+    assert data.startswith(b'\x89PNG')
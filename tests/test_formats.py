@@ -0,0 +1,40 @@
+import pytest
+
+from generators.formats import make_encoding
+
+TEXT = 'Hello, World!'
+
+
+@pytest.mark.parametrize('path', ['/api/v1/glitch.gif', '/api/v1/gradient-text.gif'])
+@pytest.mark.parametrize('accept', ['image/webp', 'image/apng', 'image/webp,image/apng,image/*;q=0.8'])
+def test_negotiated_animation_is_no_larger_than_gif(client, path, accept):
+    gif = client.get(path, query_string={'text': TEXT})
+    negotiated = client.get(path, query_string={'text': TEXT}, headers={'Accept': accept})
+    assert gif.status_code == negotiated.status_code == 200
+    assert len(negotiated.data) <= len(gif.data)
+
+
+def test_animations_do_not_vary_on_accept(client):
+    response = client.get('/api/v1/glitch.gif', query_string={'text': TEXT},
+                          headers={'Accept': 'image/webp'})
+    assert response.mimetype == 'image/gif'
+    assert 'Accept' not in response.vary
+
+
+def test_animations_in_webp_when_asked_for(client):
+    response = client.get('/api/v1/glitch.gif', query_string={'text': TEXT, 'format': 'webp'})
+    assert response.status_code == 200
+    assert response.mimetype == 'image/webp'
+
+
+def test_still_images_negotiate_webp(client):
+    response = client.get('/api/v1/neon', query_string={'text': TEXT},
+                          headers={'Accept': 'image/webp'})
+    assert response.mimetype == 'image/webp'
+    assert 'Accept' in response.vary
+
+
+def test_animated_webp_defaults_to_lossy():
+    assert not make_encoding('webp', animated=True)['lossless']
+    assert make_encoding('webp')['lossless']
+    assert make_encoding('apng', animated=True)['lossless']
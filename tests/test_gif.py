@@ -0,0 +1,123 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from generators import gif, gradient_text
+from generators.gif import TRANSPARENT_INDEX, DISPOSAL_BACKGROUND, DISPOSAL_NONE, encode_gif
+from generators.glitch_text import generate_glitch_text
+from generators.gradient_text import generate_animated_gradient_text
+
+
+@pytest.fixture
+def encoded(monkeypatch):
+    """Record the palette and index frames every GIF is encoded from."""
+    calls = []
+    iter_gif = gif.iter_gif
+
+    def recording_iter_gif(index_frames, size, palette, duration, loop=0):
+        call = {'frames': [], 'palette': np.asarray(palette), 'duration': duration}
+        calls.append(call)
+
+        def record():
+            for indices in index_frames:
+                call['frames'].append(np.array(indices))
+                yield indices
+
+        return iter_gif(record(), size, palette, duration, loop)
+
+    for module in (gif, gradient_text):
+        monkeypatch.setattr(module, 'iter_gif', recording_iter_gif)
+    return calls
+
+
+def expected_frames(frames, palette, duration):
+    """
+    RGBA frames a player shows for palette index frames, with repeats
+    merged into one frame shown for their combined duration.
+    """
+    table = np.zeros((256, 4), dtype=np.uint8)
+    table[:len(palette), :3] = palette[:, :3]
+    table[:, 3] = 255
+    table[TRANSPARENT_INDEX] = 0
+    shown = []
+    for i, indices in enumerate(frames):
+        delay = duration[i] if isinstance(duration, (list, tuple)) else duration
+        if shown and np.array_equal(shown[-1][0], indices):
+            shown[-1][2] += delay
+        else:
+            shown.append([indices, table[indices], delay])
+    return [(rgba, delay) for _, rgba, delay in shown]
+
+
+def assert_round_trip(data, frames, palette, duration, loop=0):
+    expected = expected_frames(frames, palette, duration)
+    im = Image.open(io.BytesIO(data))
+    assert im.n_frames == len(expected)
+    assert im.info['loop'] == loop
+    disposals = []
+    last = None
+    for i, (rgba, delay) in enumerate(expected):
+        im.seek(i)
+        assert im.info['duration'] == delay
+        disposals.append(im.disposal_method)
+        shown = np.asarray(im.convert('RGBA'))
+        visible = rgba[..., 3] > 0
+        assert np.array_equal(shown[..., 3] > 0, visible), f'frame {i} alpha'
+        assert np.array_equal(shown[visible][:, :3], rgba[visible][:, :3]), f'frame {i} colors'
+        last = shown
+    # Looping back draws the first frame over what the last one leaves
+    # behind, so nothing visible may remain where the first is transparent
+    if disposals[-1] == DISPOSAL_NONE:
+        assert not np.any(last[..., 3][expected[0][0][..., 3] == 0])
+    return disposals
+
+
+@pytest.mark.parametrize('text', ['Hello, World!', 'glitch\nover two lines', 'Ωμέγα 😀'])
+def test_glitch_round_trip(encoded, text):
+    data = generate_glitch_text(text).getvalue()
+    [call] = encoded
+    disposals = assert_round_trip(data, call['frames'], call['palette'], call['duration'])
+    # Glitch slices and scan lines uncover pixels, which needs a clear
+    assert DISPOSAL_BACKGROUND in disposals
+
+
+@pytest.mark.parametrize('text', ['Hello, World!', 'gradient\nover two lines'])
+def test_animated_gradient_round_trip(encoded, text):
+    data = generate_animated_gradient_text(text, num_frames=12, duration=70).getvalue()
+    [call] = encoded
+    assert_round_trip(data, call['frames'], call['palette'], call['duration'])
+
+
+def test_disposal_to_background_and_merged_frames():
+    palette = np.array([[255, 0, 0], [0, 255, 0], [0, 0, 255]], dtype=np.uint8)
+    frames = [np.full((6, 8), TRANSPARENT_INDEX, dtype=np.uint8) for _ in range(7)]
+    frames[0][1:5, 1:7] = 0
+    # One pixel changes: only that rectangle is written
+    frames[1][1:5, 1:7] = 0
+    frames[1][1, 1] = 2
+    # Shrinks: pixels turn transparent, so the frame before is cleared,
+    # all of it and not only the rectangle it was written with
+    frames[2][2:4, 2:4] = 1
+    # Same as the one before: shown longer instead of written again
+    frames[3][2:4, 2:4] = 1
+    # Grows again over the kept canvas
+    frames[4][2:4, 2:6] = 2
+    # Moves: only a corner stays visible
+    frames[5][0, 0] = 1
+    # Empty frame, then the loop back onto the first
+    durations = [10, 20, 30, 40, 50, 60, 70]
+    data = encode_gif(frames, (8, 6), palette, durations, loop=3).getvalue()
+    disposals = assert_round_trip(data, frames, palette, durations, loop=3)
+    assert disposals == [DISPOSAL_NONE, DISPOSAL_BACKGROUND, DISPOSAL_NONE,
+                         DISPOSAL_BACKGROUND, DISPOSAL_BACKGROUND, DISPOSAL_NONE]
+
+
+def test_loop_back_clears_pixels_the_first_frame_lacks():
+    palette = np.array([[255, 0, 0], [0, 255, 0]], dtype=np.uint8)
+    frames = [np.full((4, 4), TRANSPARENT_INDEX, dtype=np.uint8) for _ in range(2)]
+    frames[0][1:3, 1:3] = 0
+    frames[1][:, :] = 1
+    data = encode_gif(frames, (4, 4), palette, 40).getvalue()
+    assert assert_round_trip(data, frames, palette, 40) == [DISPOSAL_NONE, DISPOSAL_BACKGROUND]
@@ -0,0 +1,77 @@
+import os
+
+import pytest
+from PIL import Image, ImageDraw, ImageFont
+
+from generators.fonts import DEFAULT_FONT_PATHS, PRELOAD_SIZES
+from generators.metrics import FontMetrics
+from generators.utils import calculate_text_dimensions, smart_text_wrap
+
+FONT_PATHS = [path for path in DEFAULT_FONT_PATHS if os.path.exists(path)]
+for name in ('DejaVuSerif.ttf', 'DejaVuSansMono.ttf', 'DejaVuSans-Bold.ttf'):
+    path = os.path.join('/usr/share/fonts/truetype/dejavu', name)
+    if os.path.exists(path):
+        FONT_PATHS.append(path)
+
+FONTS = [ImageFont.truetype(path, size) for path in FONT_PATHS for size in PRELOAD_SIZES + (48,)]
+FONTS += [ImageFont.load_default(size) for size in PRELOAD_SIZES]
+
+TEXTS = [
+    # Kerning pairs
+    'AVATAR', 'To Wa Yo', 'LT Ty P. F, r.',
+    # Glyphs that reach past their advance or start left of the pen
+    'fj', 'jjj', 'f', 'ƒ', 'Ŧ', '/\\/', 'VAW', '_|_', ' lead', 'trail ',
+    # Combining marks, non-ASCII and glyphs the font does not have
+    'éé', 'Ωμέγα Ελλάδα', 'Привет, мир', 'Zürich Ŀ ĳ ß',
+    '😀 emoji 🎉', '中文字', '\t\x00',
+    # Multiline
+    'first\nsecond line', 'a\n\nb', '\n',
+    '',
+    'The quick brown fox jumps over the lazy dog. Sphinx of black quartz, judge my vow.',
+]
+
+_draw = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+
+
+def font_id(font):
+    path = font.path if isinstance(font.path, str) else 'default'
+    return f'{os.path.basename(path)}-{font.size}'
+
+
+def pillow_size(text, font):
+    left, top, right, bottom = _draw.textbbox((0, 0), text, font=font)
+    return right - left, bottom - top
+
+
+def pillow_wrap(text, target_width, font):
+    """Word wrap measured entirely with ImageDraw.textbbox."""
+    lines = []
+    current_line = []
+    current_width = 0
+    for word in text.split():
+        word_width, _ = pillow_size(word + ' ', font)
+        if current_line and current_width + word_width > target_width:
+            lines.append(' '.join(current_line))
+            current_line = [word]
+            current_width = word_width
+        else:
+            current_line.append(word)
+            current_width += word_width
+    if current_line:
+        lines.append(' '.join(current_line))
+    return lines
+
+
+@pytest.mark.parametrize('font', FONTS, ids=font_id)
+def test_text_size_matches_pillow(font):
+    metrics = FontMetrics(font)
+    for text in TEXTS:
+        assert metrics.text_bbox(text) == _draw.textbbox((0, 0), text, font=font), text
+        assert calculate_text_dimensions(text, font) == pillow_size(text, font), text
+
+
+@pytest.mark.parametrize('font', FONTS, ids=font_id)
+def test_wrap_matches_pillow(font):
+    text = ' '.join(TEXTS)
+    for target_width in (1, 40, 120, 300, 800):
+        assert smart_text_wrap(text, target_width, font) == pillow_wrap(text, target_width, font)
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+import app as app_module
+from generators.gif import iter_gif
+
+PALETTE = [(0, 0, 0), (255, 255, 255)]
+
+
+def frames(fail_at):
+    for i in range(3):
+        if i == fail_at:
+            raise ValueError('frame failed')
+        yield np.full((4, 4), i % 2, dtype=np.uint8)
+
+
+def failing_stream(fail_at):
+    def streamer(text, **params):
+        return iter_gif(frames(fail_at), (4, 4), PALETTE, 50)
+    return streamer
+
+
+def test_gif_header_waits_for_first_frame():
+    chunks = iter_gif(frames(0), (4, 4), PALETTE, 50)
+    with pytest.raises(ValueError):
+        next(chunks)
+
+
+def test_gif_stream_is_complete():
+    data = b''.join(iter_gif(frames(None), (4, 4), PALETTE, 50))
+    assert data.startswith(b'GIF89a') and data.endswith(b';')
+
+
+def test_first_frame_failure_is_an_error_response(client, monkeypatch):
+    monkeypatch.setattr(app_module, 'iter_glitch_text', failing_stream(0))
+    response = client.get('/api/v1/glitch.gif?text=first%20frame%20fails')
+    assert response.status_code == 400
+    assert response.json == {'error': 'frame failed'}
+
+
+def test_later_failure_cuts_the_body_short(client, monkeypatch):
+    # Headers went out with the first frame: the error can only end the body
+    monkeypatch.setattr(app_module, 'iter_glitch_text', failing_stream(2))
+    response = client.get('/api/v1/glitch.gif?text=later%20frame%20fails', buffered=False)
+    assert response.status_code == 200
+    with pytest.raises(ValueError):
+        response.get_data()